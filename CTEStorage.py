@@ -18,6 +18,13 @@ class CTEStorage:
             self.ctes[chat_id] = CachedTelegramEljur(chat_id=chat_id)
         return self.ctes[chat_id]
 
+    def add(self, ejuser: CachedTelegramEljur) -> CachedTelegramEljur:
+        """
+        Сохраняет уже созданный объект пользователя (например, после входа, без первичной загрузки сообщений)
+        """
+        self.ctes[ejuser.chat_id] = ejuser
+        return ejuser
+
     def purge_ejuser(self, chat_id: int) -> None:
         """
         Удаляет пользователя из хранилища
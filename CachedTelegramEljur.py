@@ -1,41 +1,49 @@
 import logging
-import os
 import time
-from base64 import b64encode
+from base64 import b64encode, b64decode
+from collections import defaultdict, deque
 from concurrent.futures.thread import ThreadPoolExecutor
-from copy import deepcopy
 from datetime import datetime
-from json import loads
+from itertools import chain
 from threading import Lock, Thread
-from typing import Optional, List, Union, Dict, Any
+from typing import Optional, List, Union, Dict, Any, Callable, Set, Iterable, Iterator, Tuple
 
 import pymongo
+from pymongo import UpdateOne
 from pymongo.errors import BulkWriteError
-from requests import post
+from requests import post, RequestException
 
+from attachments import mirror
+from codec import loads
 from constants import *
+from database import messages, cache_queue, data, homework
+from dbstats import bind
 from eljur import Eljur
-from utility import load_date, hash_string
-
-mongo = pymongo.MongoClient(os.environ.get('mongo_uri'))
-db = mongo[os.environ['database']]
-messages = db['messages']
-cache_queue = db['cache_queue']
-messages.create_index([("hash", pymongo.DESCENDING)], unique=True)
-data = db['data']
-homework = db['homework']
+from executor import require_eljur
+from metrics import message_body_cache_total, new_message_probes_total
+from ratelimit import vendor_limits
+from render import prerender, RENDER_VERSION
+from schoolcache import school_data
+from search import SearchIndex, MessageKey
+from summary import MessageSummary, SUMMARY_PROJECTION, thread_subject
+from storage import update_many_op, update_one_op
+from utility import load_date, chunks
+
 logger = logging.getLogger('CachedTelegramEljur')
 
 
 class CachedTelegramEljur(Eljur):
-    download_in_progress: bool  # индикатор того, что сообщения уже кэшируются
+    _download_lock: Lock  # занят, пока сообщения загружаются (download_messages_preview)
     msgs_load_limit: int  # Лимит по количеству сообщений для первичной загрузки в память, автоматически расширяется
     token: Optional[str]  # eljur токен пользователя
     chat_id: int  # идентификатор чата (Telegram, etc)
     cached_message_ids: Dict[str, List[str]]  # добавленные в кэш сообщения
     not_cached: List[dict]  # сообщения, которые предстоит добавить в кэш
-    msg_cache: Dict[str, List[dict]]  # кэш сообщений в памяти
+    msg_cache: Dict[str, List[MessageSummary]]  # кэш списков сообщений в памяти, новые сначала
     user_info: Optional[Dict[str, str]]  # ФИО пользователя {name: id, firstname: a, middlename: b, lastname: c}
+    token_state: str  # состояние токена из TokenState, с истекшим или отклоненным токеном элжур не опрашивается
+    _search_index: Optional[SearchIndex]  # поисковый индекс, строится при первом поиске
+    _watermarks: Optional[Dict[str, dict]]  # отметки проверки новых сообщений {папка: {total: n, newest: id}}
 
     def __init__(self, chat_id: int, no_messages: bool = False):
         super().__init__()
@@ -45,6 +53,8 @@ class CachedTelegramEljur(Eljur):
             super().__init__(self.token, self.vendor)
         else:
             super().__init__(self.token)
+        self.token_state = self.user_data('token_state') or TokenState.ACTIVE
+        self._token_expire = self.user_data('token_expire')
         self.msg_cache = {MessageFolder.INBOX: [], MessageFolder.SENT: []}
         self.msgs_load_limit = MESSAGES_PER_USER_ML
         self.not_cached = []
@@ -52,7 +62,10 @@ class CachedTelegramEljur(Eljur):
             item.pop('_id', None)
             self.not_cached.append(item)
         self.cached_message_ids = {MessageFolder.INBOX: [], MessageFolder.SENT: []}
-        self.download_in_progress = False
+        self._download_lock = Lock()
+        self._search_index = None
+        self._search_lock = Lock()
+        self._watermarks = None
         self.user_info = {
             'firstname': self.user_data('firstname'),
             'lastname': self.user_data('lastname'),
@@ -64,10 +77,17 @@ class CachedTelegramEljur(Eljur):
         if not no_messages:
             for folder_type in FOLDER_TYPES:
                 self.msg_cache[folder_type] = self.messages(folder=folder_type)
-                if not self.msg_cache[folder_type]:
-                    self.download_messages_preview(check_new_only=False, folder=folder_type)
+            if not all(self.msg_cache.values()) or self.user_data('sync_checkpoint'):  # первая или прерванная загрузка
+                self.download_messages_preview(check_new_only=False, folder=MessageFolder.INBOX)
         self._lock = Lock()
 
+    @property
+    def download_in_progress(self) -> bool:
+        """
+        Индикатор того, что сообщения уже кэшируются
+        """
+        return self._download_lock.locked()
+
     def user_data(self, field: str) -> Any:
         """
         Позволяет получить информацию о пользователи из коллекции "data"
@@ -105,7 +125,7 @@ class CachedTelegramEljur(Eljur):
         :param token: валидный токен eljur
         """
         self.token = token
-        super().__init__(token)
+        super().__init__(token, self._rdata['vendor'])
         document = data.find_one({'chat_id': self.chat_id})
         if document:
             data.find_one_and_update({'chat_id': self.chat_id}, {'$set': {'auth_token': token}})
@@ -120,7 +140,7 @@ class CachedTelegramEljur(Eljur):
         """
         document = data.find_one({'chat_id': self.chat_id})
         if document:
-            return document['token_expire']
+            return document.get('token_expire')
         return None
 
     @token_expire.setter
@@ -129,27 +149,35 @@ class CachedTelegramEljur(Eljur):
         Устанавливает дату, до которой токен активен
         :param expire: дата, до которой токен eljur будет работать
         """
+        self._token_expire = expire
         document = data.find_one({'chat_id': self.chat_id})
         if document:
             data.find_one_and_update({'chat_id': self.chat_id}, {'$set': {'token_expire': expire}})
         else:
             data.insert_one({'chat_id': self.chat_id, 'token_expire': expire})
 
-    def auth(self, login: str, password: str, vendor: str = 'eljur') -> bool:
+    def auth(self, login: str, password: str, vendor: str = 'eljur', update_profile: bool = True) -> bool:
         """
         Авторизовывает пользователя по логину и паролю
+        :param update_profile: обновить профиль пользователя (при переавторизации не требуется)
+        :return: True, если элжур принял логин и пароль
         """
-        r = post('https://api.eljur.ru/api/auth', data={
+        r = post(f'{self.api}/auth', data={
             'login': login,
             'password': password,
             'vendor': vendor,
             'devkey': '9235e26e80ac2c509c48fe62db23642c',  # 19c4bfc2705023fe080ce94ace26aec9
             'out_format': 'json'
-        })
+        }, timeout=ELJUR_REQUEST_TIMEOUT)
+        if r.status_code >= 500:
+            r.raise_for_status()  # элжур недоступен - о логине и пароле ничего не известно
         if r.status_code == 200:
-            tdata = loads(r.text)['response']['result']
+            tdata = loads(r.content)['response']['result']
+            self._rdata['vendor'] = vendor
             self.auth_token = tdata['token']
             self.token_expire = load_date(tdata['expires'])
+            self.token_state = TokenState.ACTIVE
+            profile = Eljur(token=tdata['token'], vendor=vendor).profile() if update_profile else {}
             data.find_one_and_update(
                 {
                     'chat_id': self.chat_id
@@ -157,10 +185,12 @@ class CachedTelegramEljur(Eljur):
                 {
                     '$set': {
                         'login': login,
-                        **Eljur(token=tdata['token'], vendor=vendor).profile(),
-                        'password': b64encode(bytes(password, encoding='utf-8'))
-                        # TODO: реализовать переавторизацию
-                    }
+                        'vendor': vendor,
+                        **(profile or {}),
+                        'password': b64encode(bytes(password, encoding='utf-8')),
+                        'token_state': TokenState.ACTIVE,
+                    },
+                    '$unset': {'reauth_failed': ''}
                 }
             )
             self.user_info = {
@@ -172,23 +202,67 @@ class CachedTelegramEljur(Eljur):
             return True
         return False
 
+    def reauth(self) -> bool:
+        """
+        Получает новый токен по сохраненным логину и паролю
+        :return: True, если токен обновлен, False - если сохраненных данных нет или элжур их не принял
+        """
+        document = data.find_one({'chat_id': self.chat_id}, {'login': True, 'password': True, 'vendor': True})
+        if not document or not document.get('login') or not document.get('password'):
+            return False
+        password = b64decode(document['password']).decode('utf-8')
+        return self.auth(login=document['login'], password=password, vendor=document.get('vendor') or 'eljur',
+                         update_profile=False)
+
+    def park_token(self, state: str) -> None:
+        """
+        Останавливает обращения к элжуру с токеном пользователя до переавторизации
+        :param state: причина из TokenState
+        """
+        if self.token_state == state:
+            return
+        self.token_state = state
+        data.update_one({'chat_id': self.chat_id}, {'$set': {'token_state': state, 'token_parked_at': time.time()}})
+        logger.warning('Токен пользователя %s недействителен (%s), опрос элжура приостановлен', self.chat_id, state,
+                       extra={'chat_id': self.chat_id})
+
+    def token_rejected(self) -> None:
+        self.park_token(TokenState.REJECTED)
+
+    @property
+    def token_usable(self) -> bool:
+        """
+        :return: можно ли обращаться к элжуру с токеном пользователя
+        """
+        if self.token_state != TokenState.ACTIVE:
+            return False
+        if self._token_expire and self._token_expire <= datetime.now():
+            self.park_token(TokenState.EXPIRED)
+            return False
+        return True
+
     def messages(self, folder: str) -> List[dict]:
         """
         Загружает необходимое (load_limit) количество сообщений из памяти или базы данных
         :param folder: папка (sent/inbox)
         :return: необходимое количество сообщений папки folder
         """
-        logger.debug(f'Подгружаю сообщения из базы для {self.chat_id}')
+        logger.debug('Подгружаю сообщения из базы для %s', self.chat_id)
         not_cached = list()
         if not self.msg_cache[folder] or len(self.msg_cache[folder]) < self.msgs_load_limit:
-            logger.debug(f'Аннулирование кэша для {self.chat_id}')
-            self.msg_cache[folder].clear()
-            for item in messages.find(
-                    {'chat_id': self.chat_id, 'folder': folder}
-            ).sort('date', pymongo.DESCENDING).limit(self.msgs_load_limit):
-                self.msg_cache[folder].append(item)
-                if not item['unread'] and 'text' not in item:
-                    not_cached.append({'chat_id': self.chat_id, 'folder': item['folder'], 'id': item['id']})
+            logger.debug('Аннулирование кэша для %s', self.chat_id)
+            documents = list(messages.find({'chat_id': self.chat_id, 'folder': folder}, SUMMARY_PROJECTION)
+                             .sort('date', pymongo.DESCENDING).limit(self.msgs_load_limit))
+            read_ids = [item['id'] for item in documents if not item['unread']]
+            without_text = {item['id'] for item in messages.find({'chat_id': self.chat_id, 'folder': folder,
+                                                                  'id': {'$in': read_ids},
+                                                                  'text': {'$exists': False}},
+                                                                 {'_id': False, 'id': True})} if read_ids else set()
+            self.msg_cache[folder] = [MessageSummary.from_document(item, cached=item['unread'] or
+                                                                   item['id'] not in without_text)
+                                      for item in documents]
+            not_cached = [{'chat_id': self.chat_id, 'folder': folder, 'id': msg_id} for msg_id in read_ids
+                          if msg_id in without_text]
         if not_cached:
             for item in not_cached:
                 cache_queue.update_one(item, {'$set': item}, upsert=True)
@@ -224,26 +298,25 @@ class CachedTelegramEljur(Eljur):
         """
         Добавляет одно сообщение с содержимым msg_data в папку folder (inbox/sent)
         """
-        messages.insert_one({'chat_id': self.chat_id,
-                             'folder': folder,
-                             'hash': hash_string(f'{self.chat_id}_{folder}_{msg_data["id"]}'),
-                             **msg_data})
+        messages.insert_one({'chat_id': self.chat_id, 'folder': folder, **msg_data})
 
     def mark_as_read(self, folder: str, msg_id: str):
         """
         Отмечает сообщение как прочитанное в кэше и базе
         """
         for msg in self.msg_cache[folder]:
-            if msg['id'] == msg_id:
-                msg['unread'] = False
+            if msg.id == msg_id:
+                msg.unread = False
                 break
         messages.find_one_and_update({'chat_id': self.chat_id, 'id': msg_id}, {'$set': {'unread': False}})
 
     def get_message(self, msg_id: str,
                     only_cache: bool = False,
-                    force_folder: Optional[str] = None, no_eljur_request: bool = False) -> Union[Optional[dict], str]:
+                    force_folder: Optional[str] = None, no_eljur_request: bool = False,
+                    view: bool = False) -> Union[Optional[dict], str]:
         """
         Пытается найти полную версию сообщения в базе
+        :param view: пользователь открывает сообщение - попадание или промах учитывается в message_body_cache_total
         """
         if type(msg_id) == tuple:
             msg_id, only_cache = msg_id
@@ -252,17 +325,34 @@ class CachedTelegramEljur(Eljur):
         if document and 'text' in document:
             if only_cache:
                 return msg_id
-            if not no_eljur_request and document['unread']:  # Прочтение сообщения на стороне eljur
+            if document.get('render_version') != RENDER_VERSION:  # текст не подготовлен или подготовлен прежней версией
+                rendered = prerender(document)
+                messages.update_one({'chat_id': self.chat_id, 'id': msg_id, 'folder': document['folder']},
+                                    {'$set': rendered})
+                document.update(rendered)
+            if view:
+                message_body_cache_total.inc(result='hit')
+            if not no_eljur_request and document['unread'] and self.available:  # Прочтение сообщения на стороне eljur
                 Thread(target=super().get_message, args=[msg_id], daemon=True).start()
             return document
         if only_cache and document and document['unread']:
-            logger.debug(f'{msg_id} не будет сохраняться сейчас, потому что оно ещё не прочтено')
+            logger.debug('%s не будет сохраняться сейчас, потому что оно ещё не прочтено', msg_id)
             return msg_id
         if no_eljur_request:
             return document
-        msg_data = super().get_message(msg_id=msg_id)
+        require_eljur()  # промах кэша учитывается один раз: в пуле элжура, где обработчик будет перезапущен
+        if view:
+            message_body_cache_total.inc(result='miss')
+        try:
+            msg_data = super().get_message(msg_id=msg_id)
+        except RequestException as e:
+            if only_cache:
+                raise
+            logger.warning('Элжур не отдал сообщение %s для %s, показываю превью: %s', msg_id, self.chat_id, e,
+                           extra={'chat_id': self.chat_id})
+            return document
         if not msg_data:
-            logging.error(f'Не удалось получить от элжура сообщение с id {msg_id}')
+            logger.error('Не удалось получить от элжура сообщение с id %s', msg_id, extra={'chat_id': self.chat_id})
             return None
         if force_folder:
             self._cache_full_message(msg_id=msg_id, msg_data=msg_data, folder=force_folder)
@@ -270,7 +360,8 @@ class CachedTelegramEljur(Eljur):
             self._cache_full_message(msg_id=msg_id, msg_data=msg_data, folder=MessageFolder.INBOX)
             self._cache_full_message(msg_id=msg_id, msg_data=msg_data, folder=MessageFolder.SENT)
         if not only_cache:
-            return self.get_message(msg_id=msg_id, force_folder=force_folder)
+            # сообщение уже прочитано в элжуре запросом выше, повторный запрос не нужен
+            return self.get_message(msg_id=msg_id, force_folder=force_folder, no_eljur_request=True)
         return msg_id
 
     def get_messages(self, folder: str = MessageFolder.INBOX, page: int = 1, limit: int = 6, unreadonly: bool = False) \
@@ -281,19 +372,19 @@ class CachedTelegramEljur(Eljur):
         :param page: номер страницы сообщений
         :param limit: максимальное количество сообщений на одной странице
         :param unreadonly: если True, возвращает только непрочитанные
-        :return: limit или менее сообщений в формате элжура {total: x, count: x, messages: [a, b, c]}
+        :return: limit или менее сообщений в формате элжура {total: x, count: x, messages: [a, b, c]},
+        сообщения - MessageSummary
         """
         result = dict()
         offset = limit * (page - 1)
         if len(self.msg_cache[folder]) < offset + limit:  # Требуется дозагрузка сообщений
             self.msgs_load_limit = offset + limit + 1
-            logger.debug(f'Лимит для {self.chat_id} изменен на {self.msgs_load_limit}')
-            msgs = deepcopy(self.messages(folder=folder))
+            logger.debug('Лимит для %s изменен на %s', self.chat_id, self.msgs_load_limit)
+            msgs = self.messages(folder=folder)
         else:
-            msgs = deepcopy(self.msg_cache[folder])
+            msgs = self.msg_cache[folder]
         if unreadonly:
-            msgs = [msg for msg in msgs if msg['unread']]
-        msgs = [msg for msg in msgs if msg['folder'] == folder]
+            msgs = [msg for msg in msgs if msg.unread]
         result['total'] = self.messages_count(folder=folder)
         result['messages'] = msgs[offset:offset + limit]
         result['count'] = len(result['messages'])
@@ -304,35 +395,54 @@ class CachedTelegramEljur(Eljur):
         Количество непрочитанных сообщений
         :return: количество непрочитанных сообщений пользователя
         """
-        return messages.count({'chat_id': self.chat_id, 'folder': folder, 'unread': True})
+        return messages.count_documents({'chat_id': self.chat_id, 'folder': folder, 'unread': True})
 
     def _cache_full_message(self, msg_id: str, folder: str, msg_data: dict) -> None:
         """
-        Добавляет сообщение в кэш
+        Добавляет сообщение в кэш вместе с подготовленным для Telegram текстом и строкой получателей
         """
         target = {'chat_id': self.chat_id, 'id': msg_id, 'folder': folder}
         if messages.find_one(target):
+            if 'html' not in msg_data:  # сообщение может кэшироваться в обе папки, текст готовится один раз
+                msg_data.update(prerender(msg_data))
             messages.find_one_and_update(target, {'$set': msg_data})
             cache_queue.delete_one(target)
+            if self._search_index is not None:
+                self._search_index.add({**msg_data, 'folder': folder, 'id': msg_id})
+            if msg_data.get('files'):
+                mirror.prefetch(msg_data['files'])
+            for msg in self.msg_cache[folder]:
+                if msg.id == msg_id:
+                    msg.cached = True
+                    break
             with self._lock:
                 if target in self.not_cached:
                     self.not_cached.remove(target)
                 else:
-                    logger.info(f'Кэширую сообщение {msg_id} по запросу пользователя {self.chat_id}')
+                    logger.info('Кэширую сообщение %s по запросу пользователя %s', msg_id, self.chat_id,
+                                extra={'chat_id': self.chat_id})
         else:
-            logger.info(f'Сообщение с id {msg_id} в {folder} НЕ ДОБАВЛЕНО в кэш для {self.chat_id} (не найдено в бд)')
+            logger.info('Сообщение с id %s в %s НЕ ДОБАВЛЕНО в кэш для %s (не найдено в бд)', msg_id, folder,
+                        self.chat_id, extra={'chat_id': self.chat_id})
 
     def cache_full_messages(self):
         """
         Кэширует полные сообщения пользователя (такие поля как текст и др.)
         """
-        logger.info(f'Работа по кэшированию сообщений для {self.chat_id} начата, осталось {len(self.not_cached)}')
+        if not self.available:
+            logger.info('Элжур недоступен, кэширование сообщений для %s отложено', self.chat_id,
+                        extra={'chat_id': self.chat_id})
+            return
+        if self.not_cached:
+            logger.info('Работа по кэшированию сообщений для %s начата, осталось %s', self.chat_id,
+                        len(self.not_cached), extra={'chat_id': self.chat_id})
         with ThreadPoolExecutor(max_workers=MESSAGES_CACHE_THREADS) as pool:
-            for msg_id in pool.map(lambda p: self.get_message(msg_id=p['id'],
-                                                              force_folder=p['folder'],
-                                                              only_cache=True),
+            for msg_id in pool.map(bind(lambda p: self.get_message(msg_id=p['id'],
+                                                                   force_folder=p['folder'],
+                                                                   only_cache=True)),
                                    self.not_cached):
-                logger.info(f"Сообщение для {self.chat_id} с id {msg_id} добавлено в базу")
+                logger.info('Сообщение для %s с id %s добавлено в базу', self.chat_id, msg_id,
+                            extra={'chat_id': self.chat_id, 'event': 'message_cached'})
 
     def message_ids(self, folder: str) -> List[str]:
         """
@@ -361,47 +471,366 @@ class CachedTelegramEljur(Eljur):
         """
         Проверяет существует ли в базе сообщение с id msg_id в папке folder
         """
-        res = messages.find_one({'hash': hash_string(f'{self.chat_id}_{folder}_{msg_id}')})
+        res = messages.find_one({'chat_id': self.chat_id, 'folder': folder, 'id': msg_id}, {'_id': True})
         if res:
             return True
         return False
 
-    def download_messages_preview(self, check_new_only: bool, folder: str, limit: int = 1000) -> List[dict]:
-        """
-        Обновляет кэш сообщений и возвращает список новых входящих сообщений
+    def download_messages_preview(self, check_new_only: bool, folder: str, limit: int = 1000,
+                                  on_page: Optional[Callable[[str, int, int], None]] = None,
+                                  folders: Iterable[str] = FOLDER_TYPES, ingested: Optional[List[str]] = None,
+                                  wait: bool = False) -> List[dict]:
+        """
+        Обновляет кэш сообщений: ответ элжура разбирается потоково, и сообщения записываются в базу пачками
+        по INGEST_BATCH (неупорядоченные upsert, дубликаты не прерывают запись) по мере чтения ответа.
+        limit=1000 - полная загрузка (см. _backfill), иначе загружается только первая страница каждой папки
+        :param check_new_only: проверка новых сообщений (иначе полная загрузка, прочитанные ставятся в очередь
+        кэширования текста)
+        :param folder: папка, для которой вызвана загрузка (загружаются обе)
+        :param limit: сообщений на странице, 1000 - загрузка всех страниц
+        :param on_page: вызывается после записи каждой страницы полной загрузки с аргументами (папка,
+        загружено сообщений папки, всего сообщений в папке)
+        :param folders: папки, первые страницы которых загружаются (полная загрузка - всегда обе)
+        :param ingested: сюда добавляются папки, первые страницы которых получены и записаны в базу
+        :param wait: если загрузка уже идет, дождаться ее и загрузить (иначе сразу вернуть пустой список)
+        :return: новые входящие сообщения (при полной загрузке - только первые msgs_load_limit)
+        """
+        if not self._download_lock.acquire(blocking=wait):
+            return []
+        new_inbox = []
+        try:
+            if limit == 1000:
+                if self._backfill(limit=limit, queue_read=not check_new_only, new_inbox=new_inbox, on_page=on_page):
+                    for msg_type in FOLDER_TYPES:
+                        data.update_one({'chat_id': self.chat_id}, {'$unset': {f'sync_checkpoint.{msg_type}': ''}})
+                        self.msg_cache[msg_type].clear()  # новые сообщения могли попасть в середину, перечитываем
+                        self.messages(folder=msg_type)
+                return new_inbox
+            for msg_type in folders:
+                if self.token_state != TokenState.ACTIVE:  # элжур отклонил токен
+                    return new_inbox
+                result = super().iter_messages(folder=msg_type, page=1, limit=limit)
+                if not result:
+                    continue
+                _, fresh = self._ingest(folder=msg_type, page_messages=result[1], queue_read=not check_new_only,
+                                        new_inbox=new_inbox)
+                self.msg_cache[msg_type] = [MessageSummary.from_document(msg) for msg in fresh] + \
+                    self.msg_cache[msg_type]
+                if ingested is not None:
+                    ingested.append(msg_type)
+        finally:
+            self._download_lock.release()
+        return new_inbox
+
+    def check_new_messages(self, limit: int = 100) -> List[dict]:
+        """
+        Проверка новых сообщений в два этапа. Сначала для каждой папки запрашивается одно последнее сообщение
+        (getmessages с limit=1), и его id и total сравниваются с отметкой, сохраненной при прошлой проверке.
+        Новое сообщение всегда становится последним, поэтому, пока id последнего не изменился и total не вырос,
+        новых сообщений нет. Страница из limit сообщений загружается только для изменившихся папок
+        :param limit: сообщений на странице, загружаемой при изменении
+        :return: новые входящие сообщения
         """
         if self.download_in_progress:
             return []
-        self.download_in_progress = True
-        new_messages = []
-        page_to = MAX_CACHE_PAGES - 1 if limit == 1000 else 1
+        if self._watermarks is None:
+            self._watermarks = self.user_data('messages_watermark') or {}
+        changed = dict()
         for msg_type in FOLDER_TYPES:
-            for page in range(1, page_to + 1):
-                msgs = super().get_messages(folder=msg_type, page=page, limit=limit)
-                if not msgs or 'messages' not in msgs:
-                    break
-                new_messages.extend([{'chat_id': self.chat_id,
-                                      'folder': msg_type,
-                                      'hash': hash_string(f'{self.chat_id}_{msg_type}_{msg["id"]}'), **msg}
-                                     for msg in msgs['messages']
-                                     if not self.message_exist(folder=msg_type, msg_id=msg['id'])])
-        self.msg_cache[folder] = new_messages + self.msg_cache[folder]
-        not_cached = []
-        if not check_new_only:
-            for msg in new_messages:
-                if not msg['unread']:
-                    not_cached.append({'chat_id': self.chat_id, 'folder': msg['folder'], 'id': msg['id']})
-        if new_messages:
+            if self.token_state != TokenState.ACTIVE:  # элжур отклонил токен
+                return []
+            probe = super().get_messages(folder=msg_type, page=1, limit=1)
+            if not probe:
+                continue
+            newest = probe.get('messages') or [{}]
+            mark = {'total': int(probe.get('total') or 0), 'newest': newest[0].get('id')}
+            stored = self._watermarks.get(msg_type)
+            if stored and stored['newest'] == mark['newest'] and stored['total'] >= mark['total']:
+                new_message_probes_total.inc(folder=msg_type, result='unchanged')
+                if stored['total'] != mark['total']:  # сообщения удалены
+                    self._set_watermark(msg_type, mark)
+                continue
+            new_message_probes_total.inc(folder=msg_type, result='changed')
+            changed[msg_type] = mark
+        if not changed:
+            return []
+        ingested = []
+        new_inbox = self.download_messages_preview(check_new_only=True, folder=MessageFolder.INBOX, limit=limit,
+                                                   folders=list(changed), ingested=ingested)
+        # отметка сдвигается только для записанных папок, остальные (ошибка элжура, идет полная загрузка)
+        # проверяются заново при следующем опросе
+        for msg_type in ingested:
+            self._set_watermark(msg_type, changed[msg_type])
+        return new_inbox
+
+    def _set_watermark(self, folder: str, mark: Dict[str, Any]) -> None:
+        self._watermarks[folder] = mark
+        data.update_one({'chat_id': self.chat_id}, {'$set': {f'messages_watermark.{folder}': mark}})
+
+    def _ingest(self, folder: str, page_messages: Iterable[dict], queue_read: bool,
+                new_inbox: List[dict]) -> Tuple[int, List[dict]]:
+        """
+        Записывает сообщения страницы в базу пачками по INGEST_BATCH по мере их получения
+        :param page_messages: сообщения страницы (в том числе итератор потокового разбора)
+        :param new_inbox: сюда добавляются новые входящие, пока их меньше msgs_load_limit
+        :return: (получено сообщений, новые сообщения)
+        """
+        received = 0
+        fresh = []
+        for batch in chunks(page_messages, INGEST_BATCH):
+            received += len(batch)
+            batch_new = self._store_page(folder=folder, page_messages=batch, queue_read=queue_read)
+            fresh.extend(batch_new)
+            if folder == MessageFolder.INBOX and len(new_inbox) < self.msgs_load_limit:
+                new_inbox.extend(batch_new[:self.msgs_load_limit - len(new_inbox)])
+        return received, fresh
+
+    def _page_stored(self, folder: str, page: int, limit: int, received: int, total: int,
+                     on_page: Optional[Callable[[str, int, int], None]]) -> None:
+        """
+        Сохраняет контрольную точку полной загрузки после записи страницы
+        """
+        data.update_one({'chat_id': self.chat_id}, {'$set': {f'sync_checkpoint.{folder}': page}})
+        if on_page:
+            on_page(folder, min((page - 1) * limit + received, total), total)
+
+    def _fetch_page(self, folder: str, page: int, limit: int) -> Optional[Tuple[Optional[dict], Iterator[dict]]]:
+        """
+        Запрашивает страницу сообщений для полной загрузки в пределах лимита запросов к школе. Ответ разбирается
+        потоково: читается только первое сообщение, остальные читает из соединения тот, кто записывает страницу
+        :return: (первое сообщение или None для пустой страницы, итератор остальных сообщений) или None, если элжур
+        вернул ошибку. Если страница не нужна, итератор нужно закрыть (close), чтобы закрыть соединение
+        """
+        vendor_limits.acquire(self._rdata['vendor'])
+        result = Eljur.iter_messages(self, folder=folder, page=page, limit=limit)
+        if result is None:
+            return None
+        _, page_messages = result
+        return next(page_messages, None), page_messages
+
+    def _stream_pages(self, folder: str, first: int, last: int, limit: int, queue_read: bool,
+                      new_inbox: List[dict], on_page: Optional[Callable[[str, int, int], None]]) -> Tuple[int, bool]:
+        """
+        Загружает страницы папки first..last по очереди, с потоковым разбором каждой
+        :return: (всего сообщений в папке по последнему ответу, полная ли последняя загруженная страница -
+        тогда за ней могут быть еще страницы)
+        """
+        total, more = 0, False
+        for page in range(first, last + 1):
+            if self.token_state != TokenState.ACTIVE:
+                return total, False
+            vendor_limits.acquire(self._rdata['vendor'])
+            result = super().iter_messages(folder=folder, page=page, limit=limit)
+            if not result:
+                return total, False
+            fields, page_messages = result
+            received, _ = self._ingest(folder=folder, page_messages=page_messages, queue_read=queue_read,
+                                       new_inbox=new_inbox)
+            total = int(fields.get('total') or 0)
+            more = received == limit
+            if received:
+                self._page_stored(folder, page, limit, received, total, on_page)
+            if not more:
+                break
+        return total, more
+
+    def _backfill(self, limit: int, queue_read: bool, new_inbox: List[dict],
+                  on_page: Optional[Callable[[str, int, int], None]]) -> bool:
+        """
+        Полная загрузка обеих папок. Первая страница каждой папки загружается потоково, из нее берется total;
+        остальные страницы обеих папок запрашиваются в BACKFILL_THREADS потоках в пределах лимита запросов к школе
+        (ratelimit.vendor_limits) и записываются в базу по порядку страниц. Запрошено не больше BACKFILL_THREADS
+        страниц сразу: следующая запрашивается после записи очередной, а сообщения страниц читаются из ответа
+        потоково при записи, поэтому в памяти не больше одной разбираемой страницы.
+        После каждой записанной страницы сохраняется контрольная точка, и прерванная загрузка продолжается
+        со следующей страницы
+        :return: False, если загрузка прервана из-за отклоненного токена
+        """
+        checkpoint = self.user_data('sync_checkpoint') or {}
+        last_page = MAX_CACHE_PAGES - 1
+        totals = dict()
+        pending = dict()  # папка -> страницы, которые загружаются параллельно
+        for msg_type in FOLDER_TYPES:
+            first = checkpoint.get(msg_type, 0) + 1
+            if first > last_page:
+                continue
+            totals[msg_type], more = self._stream_pages(msg_type, first, first, limit, queue_read, new_inbox, on_page)
+            if more:
+                pending[msg_type] = range(first + 1, max(first, min(last_page, -(-totals[msg_type] // limit))) + 1)
+        if self.token_state != TokenState.ACTIVE:
+            return False
+        tasks = iter([(msg_type, page) for msg_type, pages in pending.items() for page in pages])
+        window = deque()  # (папка, страница, future) - не больше BACKFILL_THREADS запрошенных страниц
+        stopped = set()  # папки, загрузка которых закончилась раньше последней страницы
+        abandoned = []  # запрошенные страницы остановленных папок, их соединения закрываются
+        with ThreadPoolExecutor(max_workers=BACKFILL_THREADS) as pool:
             try:
-                if not_cached:
-                    cache_queue.insert_many(deepcopy(not_cached))
+                while self.token_state == TokenState.ACTIVE:
+                    while len(window) < BACKFILL_THREADS:  # страница N + окно запрашивается после записи страницы N
+                        task = next(tasks, None)
+                        if task is None:
+                            break
+                        if task[0] not in stopped:
+                            window.append((*task, pool.submit(bind(self._fetch_page), *task, limit)))
+                    if not window:
+                        break
+                    msg_type, page, future = window.popleft()
+                    if msg_type in stopped:
+                        abandoned.append(future)
+                        continue
+                    result = future.result()
+                    if result is None or self.token_state != TokenState.ACTIVE:
+                        stopped.add(msg_type)
+                        continue
+                    first, rest = result
+                    received, _ = self._ingest(folder=msg_type, page_messages=chain((first,), rest) if first else rest,
+                                               queue_read=queue_read, new_inbox=new_inbox)
+                    if received:
+                        self._page_stored(msg_type, page, limit, received, totals[msg_type], on_page)
+                    if received < limit:
+                        stopped.add(msg_type)
+                    elif page + 1 == pending[msg_type].stop <= last_page:  # папка выросла во время загрузки
+                        self._stream_pages(msg_type, page + 1, last_page, limit, queue_read, new_inbox, on_page)
+            finally:
+                abandoned.extend(future for _, _, future in window)
+                for future in abandoned:
+                    future.cancel()
+        for future in abandoned:  # пул закрыт, все начатые запросы завершены
+            if not future.cancelled() and future.exception() is None and future.result():
+                future.result()[1].close()
+        return self.token_state == TokenState.ACTIVE
+
+    def sync_first_page(self, folder: str = MessageFolder.INBOX, limit: int = ONBOARDING_FIRST_PAGE) -> int:
+        """
+        Загружает и записывает в базу только первую страницу папки, чтобы последние сообщения были доступны сразу
+        после входа, до полной загрузки
+        :return: количество новых сообщений
+        """
+        msgs = super().get_messages(folder=folder, page=1, limit=limit)
+        if not msgs or 'messages' not in msgs:
+            return 0
+        new_messages = self._store_page(folder=folder, page_messages=msgs['messages'], queue_read=False)
+        self.msg_cache[folder] = [MessageSummary.from_document(msg) for msg in new_messages] + self.msg_cache[folder]
+        return len(new_messages)
+
+    def _store_page(self, folder: str, page_messages: List[dict], queue_read: bool) -> List[dict]:
+        """
+        Записывает страницу сообщений в базу: уже сохраненные отсеиваются одним запросом по индексу,
+        остальные добавляются одним неупорядоченным bulk_write ($setOnInsert - сообщение, записанное
+        одновременной загрузкой, не изменяется)
+        :param folder: папка сообщений
+        :param page_messages: сообщения страницы в формате элжура
+        :param queue_read: ставить ли новые прочитанные сообщения в очередь кэширования текста
+        :return: новые сообщения страницы (которых не было в базе)
+        """
+        if not page_messages:
+            return []
+        known = {msg['id'] for msg in messages.find({'chat_id': self.chat_id, 'folder': folder,
+                                                      'id': {'$in': [msg['id'] for msg in page_messages]}},
+                                                     {'_id': False, 'id': True})}
+        documents = [{'chat_id': self.chat_id, 'folder': folder, **msg} for msg in page_messages
+                     if msg['id'] not in known]
+        if not documents:
+            return []
+        operations = [update_one_op({'chat_id': self.chat_id, 'folder': folder, 'id': doc['id']},
+                                    {'$setOnInsert': {key: value for key, value in doc.items()
+                                                      if key not in ('chat_id', 'folder', 'id')}}, upsert=True)
+                      for doc in documents]
+        try:
+            upserted = messages.bulk_write(operations, ordered=False).upserted_ids.keys()
+        except BulkWriteError as bwe:  # одновременная загрузка того же сообщения - оно уже в базе
+            logger.warning('Ошибки записи страницы сообщений %s: %s', self.chat_id, bwe.details['writeErrors'][:3],
+                           extra={'chat_id': self.chat_id})
+            upserted = [item['index'] for item in bwe.details.get('upserted', [])]
+        new_messages = [documents[index] for index in sorted(upserted)]
+        if not new_messages:
+            return []
+        if queue_read:
+            not_cached = [{'chat_id': self.chat_id, 'folder': folder, 'id': msg['id']}
+                          for msg in new_messages if not msg['unread']]
+            if not_cached:
+                cache_queue.bulk_write([UpdateOne(item, {'$set': item}, upsert=True) for item in not_cached],
+                                       ordered=False)
                 self.not_cached.extend(not_cached)
-                messages.insert_many(new_messages)
-                # self.add_message_ids(folder=folder, ids=[msg['id'] for msg in new_messages])
-            except BulkWriteError as bwe:
-                logger.error(f'[0] BulkWriteError:\n{bwe.details}')
-        self.download_in_progress = False
-        return [msg for msg in new_messages if msg['folder'] == MessageFolder.INBOX]
+        if self._search_index is not None:
+            self._search_index.add_many(new_messages)
+        return new_messages
+
+    @property
+    def search_index(self) -> SearchIndex:
+        """
+        Поисковый индекс сообщений пользователя. При первом обращении строится по базе,
+        дальше пополняется при загрузке новых сообщений и их текстов
+        """
+        with self._search_lock:
+            if self._search_index is None:
+                begin = time.time()
+                index = SearchIndex()
+                index.add_many(messages.find({'chat_id': self.chat_id},
+                                             {'_id': False, 'folder': True, 'id': True, 'date': True, 'subject': True,
+                                              'user_from': True, 'users_to': True, 'short_text': True, 'text': True}))
+                self._search_index = index
+                logger.info('Поисковый индекс для %s построен за %.2f с (%s сообщений)', self.chat_id,
+                            time.time() - begin, len(index), extra={'chat_id': self.chat_id})
+        return self._search_index
+
+    def warm_search_index(self) -> None:
+        """
+        Строит поисковый индекс в фоне, чтобы первый поиск не ждал его построения
+        """
+        if self._search_index is None:
+            Thread(target=lambda: self.search_index, daemon=True, name=f'Search-Index-{self.chat_id}').start()
+
+    def search(self, query: str) -> List[MessageKey]:
+        """
+        Ищет сообщения обеих папок по теме, ФИО отправителя и получателей и тексту
+        :param query: поисковый запрос
+        :return: ключи (папка, id) найденных сообщений, новые сначала
+        """
+        return self.search_index.search(query)
+
+    def messages_by_keys(self, keys: List[MessageKey]) -> List[MessageSummary]:
+        """
+        Загружает краткие представления сообщений в порядке keys
+        :param keys: ключи (папка, id) сообщений
+        """
+        if not keys:
+            return []
+        found = {(msg['folder'], msg['id']): MessageSummary.from_document(msg, cached=True)
+                 for msg in messages.find({'chat_id': self.chat_id,
+                                           '$or': [{'folder': folder, 'id': msg_id} for folder, msg_id in keys]},
+                                          SUMMARY_PROJECTION)}
+        return [found[key] for key in keys if key in found]
+
+    def answered(self, summaries: List[MessageSummary]) -> Set[str]:
+        """
+        Определяет, на какие входящие сообщения пользователь ответил: следующее за ним сообщение цепочки
+        (messages_chain) - отправленное. Цепочки всех сообщений страницы загружаются одним запросом
+        :param summaries: сообщения страницы
+        :return: id входящих сообщений, на которые есть ответ
+        """
+        inbox = [msg for msg in summaries if msg.folder == MessageFolder.INBOX and msg.counterpart]
+        if not inbox:
+            return set()
+        subjects = {thread_subject(msg.subject) for msg in inbox}
+        threads = defaultdict(list)  # (тема цепочки, id собеседника) -> [(дата, папка)]
+        for msg in messages.find({'chat_id': self.chat_id,
+                                  'subject': {'$in': [*subjects, *(f'Re: {subject}' for subject in subjects)]}},
+                                 {'_id': False, 'folder': True, 'date': True, 'subject': True, 'user_from': True,
+                                  'users_to': True}):
+            participants = {msg['user_from'].get('name')} if msg.get('user_from') else set()
+            if len(msg.get('users_to') or []) == 1:
+                participants.add(msg['users_to'][0].get('name'))
+            timestamp = load_date(msg['date']).timestamp()
+            for participant in participants:
+                threads[(thread_subject(msg['subject']), participant)].append((timestamp, msg['folder']))
+        answered = set()
+        for msg in inbox:
+            thread = threads[(thread_subject(msg.subject), msg.counterpart)]
+            newer = [item for item in thread if item[0] > msg.timestamp]
+            if newer and min(newer)[1] == MessageFolder.SENT:
+                answered.add(msg.id)
+        return answered
 
     def messages_chain(self, msg_id: str, folder: str) -> List[Dict[str, Any]]:
         """
@@ -439,6 +868,28 @@ class CachedTelegramEljur(Eljur):
         chain.sort(key=lambda item: load_date(item['date']).timestamp())
         return chain[::-1]
 
+    def periods(self, show_disabled: bool = True) -> Optional[List[Dict[str, Optional[str]]]]:
+        """
+        Учебные периоды школы, общие для всех ее пользователей (из кэша данных школ)
+        :param show_disabled: возвращать ли ещё не наступившие периоды
+        """
+        return school_data.get(self._rdata['vendor'], 'periods', str(show_disabled).lower(),
+                               loader=lambda: super(CachedTelegramEljur, self).periods(show_disabled=show_disabled),
+                               ttl=PERIODS_TTL)
+
+    def message_receivers(self, group: Optional[str] = None) \
+            -> Optional[Dict[str, List[Dict[str, Union[List[Dict[str, str]], str]]]]]:
+        """
+        Возможные получатели сообщений (из кэша данных школ): все группы или одна группа
+        :param group: название группы пользователей из поля key
+        :return: список групп или пользователей группы
+        """
+        groups = school_data.get(self._rdata['vendor'], 'receivers', '', loader=super().message_receivers,
+                                 ttl=RECEIVERS_TTL)
+        if groups is None or not group:
+            return groups
+        return groups.get(group)
+
     def reply_message(self, replyto: str, text: str) -> bool:
         """
         Отправляет ответ на сообщение
@@ -450,19 +901,44 @@ class CachedTelegramEljur(Eljur):
         self.download_messages_preview(check_new_only=True, folder=MessageFolder.SENT, limit=1)
         return result
 
-    def update_read_state(self, folder: str) -> None:
+    def update_read_state(self, folder: str) -> int:
         """
-        Обновляет статус прочтения сообщений
+        Сверяет статус прочтения сообщений папки folder с элжуром.
+        Обновляются только сообщения, статус которых изменился: одним bulk_write в базе и на месте в кэше в памяти
+        :param folder: папка (sent/inbox)
+        :return: количество сообщений, у которых изменился статус
         """
         result = super().get_messages(folder=folder, limit=1000, unreadonly=True)
-        messages.update_many({'chat_id': self.chat_id, 'folder': folder, 'unread': True}, {'$set': {'unread': False}})
-        if 'messages' in result:
-            ids = [msg['id'] for msg in result['messages']]
-            if ids:
-                messages.update_many({'chat_id': self.chat_id, 'folder': folder, 'id': {'$in': ids}},
-                                     {'$set': {'unread': True}})
-        self.msg_cache[folder].clear()
-        self.messages(folder=folder)
+        if not result:
+            return 0
+        remote_unread = {msg['id'] for msg in result.get('messages', [])}
+        local_unread = {msg['id'] for msg in messages.find({'chat_id': self.chat_id, 'folder': folder, 'unread': True},
+                                                           {'id': True, '_id': False})}
+        became_unread = remote_unread - local_unread
+        became_read = local_unread - remote_unread
+        if int(result.get('total', 0)) > len(remote_unread):
+            # элжур отдал не все непрочитанные - про остальные ничего не известно
+            became_read.clear()
+        operations = []
+        if became_read:
+            operations.append(update_many_op({'chat_id': self.chat_id, 'folder': folder,
+                                              'id': {'$in': list(became_read)}},
+                                             {'$set': {'unread': False}}))
+        if became_unread:
+            operations.append(update_many_op({'chat_id': self.chat_id, 'folder': folder,
+                                              'id': {'$in': list(became_unread)}},
+                                             {'$set': {'unread': True}}))
+        if not operations:
+            return 0
+        messages.bulk_write(operations, ordered=False)
+        for msg in self.msg_cache[folder]:
+            if msg.id in became_read:
+                msg.unread = False
+            elif msg.id in became_unread:
+                msg.unread = True
+        logger.debug('Статус прочтения для %s в %s: %s прочитано, %s не прочитано', self.chat_id, folder,
+                     len(became_read), len(became_unread))
+        return len(became_read) + len(became_unread)
 
     @property
     def homework(self) -> Optional[Dict[str, dict]]:
@@ -476,7 +952,17 @@ class CachedTelegramEljur(Eljur):
             last_update = homework_data['last_update']
             mode_update = True
         if not last_update or time.time() - last_update > 60:
-            hw = super().homework()
+            try:
+                hw = super().homework()
+            except RequestException:
+                if not homework_data:
+                    raise
+                hw = None
+        else:
+            hw = None
+        if hw is None and not homework_data:
+            return None
+        if hw is not None:
             hw_db = dict()
             for key in list(hw.keys()):
                 hw_db[key.replace('.', '-')] = hw[key]
@@ -493,11 +979,10 @@ class CachedTelegramEljur(Eljur):
                 hw.pop(key, None)
             return hw
 
-    def starred_messages(self, folder):
-        starred = []
-        for message in messages.find({'chat_id': self.chat_id, 'folder': folder, 'starred': True}):
-            starred.append(message)
-        return starred
+    def starred_messages(self, folder) -> List[MessageSummary]:
+        return [MessageSummary.from_document(message, cached=True)
+                for message in messages.find({'chat_id': self.chat_id, 'folder': folder, 'starred': True},
+                                             SUMMARY_PROJECTION)]
 
     def star_message(self, msg_id: str, folder: str):
         messages.find_one_and_update({'chat_id': self.chat_id, 'folder': folder, 'id': msg_id},
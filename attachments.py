@@ -0,0 +1,251 @@
+"""
+Зеркало вложений элжура.
+
+Файл скачивается из элжура один раз и хранится на диске по sha256 содержимого (одинаковые файлы из разных
+сообщений и домашних заданий хранятся один раз), а в Telegram загружается тоже один раз: полученный file_id
+сохраняется и используется при всех следующих отправках. Так вложения доступны, даже когда элжур не отвечает.
+Кнопки вложений ссылаются на короткий ключ ссылки, который хранится в коллекции attachments.
+"""
+import hashlib
+import logging
+import os
+import shutil
+from pathlib import Path
+from tempfile import NamedTemporaryFile
+from queue import Queue
+from threading import Lock, Thread
+from typing import Optional, List, Dict, Set, Iterable
+
+import requests
+from pymongo import UpdateOne
+from telegram import Bot, InlineKeyboardButton, Message
+from telegram.error import BadRequest
+
+from callbacks import Action, encode
+from constants import ATTACHMENTS_DIR, ATTACHMENT_MAX_SIZE, ATTACHMENT_THREADS, ELJUR_REQUEST_TIMEOUT
+from database import attachments, attachment_blobs
+from metrics import registry
+
+logger = logging.getLogger('BOT')
+CHUNK_SIZE = 64 * 1024
+
+attachment_downloads_total = registry.counter('attachment_downloads_total', 'Скачивания вложений из элжура',
+                                              ('result',))
+attachment_sends_total = registry.counter('attachment_sends_total',
+                                          'Отправки вложений: telegram - по сохраненному file_id, upload - с диска',
+                                          ('source',))
+
+
+def url_key(url: str) -> str:
+    """
+    Короткий ключ ссылки для callback_data (ограничение Telegram - 64 байта)
+    """
+    return hashlib.sha1(url.encode('utf-8')).hexdigest()[:20]
+
+
+def file_sha256(path: Path) -> str:
+    digest = hashlib.sha256()
+    with open(path, 'rb') as file:
+        for chunk in iter(lambda: file.read(CHUNK_SIZE), b''):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+class AttachmentMirror:
+    def __init__(self, root: str = ATTACHMENTS_DIR, workers: int = ATTACHMENT_THREADS):
+        """
+        :param root: каталог хранилища файлов
+        :param workers: потоки фонового скачивания
+        """
+        self.root = Path(root)
+        self._workers = workers
+        self._queue = Queue()
+        self._started = False
+        self._registered: Set[str] = set()
+        self._local: Dict[Path, str] = dict()  # sha256 файлов из media
+        self._locks: Dict[str, Lock] = dict()
+        self._lock = Lock()
+
+    def path(self, sha: str) -> Path:
+        return self.root / sha[:2] / sha
+
+    def register(self, files: Iterable[Dict[str, str]]) -> List[str]:
+        """
+        Запоминает ссылки на вложения, чтобы кнопка могла сослаться на них коротким ключом
+        :param files: вложения в формате элжура [{filename: a, link: b}]
+        :return: ключи вложений в том же порядке
+        """
+        keys, operations = [], []
+        for file in files:
+            key = url_key(file['link'])
+            keys.append(key)
+            if key not in self._registered:
+                operations.append(UpdateOne({'_id': key},
+                                            {'$setOnInsert': {'url': file['link'], 'filename': file['filename']}},
+                                            upsert=True))
+        if operations:
+            attachments.bulk_write(operations, ordered=False)
+            with self._lock:
+                self._registered.update(keys)
+        return keys
+
+    def buttons(self, files: List[Dict[str, str]]) -> List[List[InlineKeyboardButton]]:
+        """
+        :param files: вложения в формате элжура [{filename: a, link: b}]
+        :return: ряды кнопок, по кнопке на вложение
+        """
+        return [[InlineKeyboardButton(f'📎 {file["filename"]}', callback_data=encode(Action.FILE, key))]
+                for file, key in zip(files, self.register(files))]
+
+    def prefetch(self, files: List[Dict[str, str]]) -> None:
+        """
+        Ставит скачивание вложений в фоновую очередь
+        """
+        keys = self.register(files)
+        if not keys:
+            return
+        with self._lock:
+            if not self._started:
+                self._started = True
+                for i in range(self._workers):
+                    Thread(target=self._work, daemon=True, name=f'Attachments-{i}').start()
+        for key in keys:
+            self._queue.put(key)
+
+    def _work(self) -> None:
+        while True:
+            key = self._queue.get()
+            try:
+                self.fetch(key)
+            except Exception as e:
+                logger.warning('Ошибка скачивания вложения %s: %s', key, e)
+
+    def fetch(self, key: str, force: bool = False) -> Optional[str]:
+        """
+        Скачивает вложение в хранилище, если его там ещё нет
+        :param key: ключ вложения
+        :param force: скачать заново, даже если содержимое уже известно
+        :return: sha256 содержимого или None, если скачать не удалось
+        """
+        with self._lock:
+            lock = self._locks.setdefault(key, Lock())
+        with lock:
+            document = attachments.find_one({'_id': key})
+            if not document:
+                return None
+            if not force and document.get('sha') and self.path(document['sha']).exists():
+                return document['sha']
+            sha = self._download(document['url'])
+            if sha:
+                attachments.update_one({'_id': key}, {'$set': {'sha': sha}})
+            return sha
+
+    def _download(self, url: str) -> Optional[str]:
+        self.root.mkdir(parents=True, exist_ok=True)
+        digest, size, complete = hashlib.sha256(), 0, False
+        with NamedTemporaryFile(dir=self.root, delete=False) as tmp:
+            try:
+                with requests.get(url, stream=True, timeout=ELJUR_REQUEST_TIMEOUT) as response:
+                    response.raise_for_status()
+                    for chunk in response.iter_content(CHUNK_SIZE):
+                        size += len(chunk)
+                        if size > ATTACHMENT_MAX_SIZE:
+                            attachment_downloads_total.inc(result='too_large')
+                            logger.warning('Вложение %s больше %s байт, не скачивается', url, ATTACHMENT_MAX_SIZE)
+                            break
+                        digest.update(chunk)
+                        tmp.write(chunk)
+                    else:
+                        complete = True
+            except requests.RequestException as e:
+                attachment_downloads_total.inc(result='failed')
+                logger.warning('Не удалось скачать вложение %s: %s', url, e)
+        if not complete:
+            os.unlink(tmp.name)
+            return None
+        sha = digest.hexdigest()
+        self._store(Path(tmp.name), sha, size, move=True)
+        attachment_downloads_total.inc(result='downloaded')
+        return sha
+
+    def _store(self, source: Path, sha: str, size: int, move: bool) -> None:
+        target = self.path(sha)
+        if target.exists():
+            if move:
+                os.unlink(source)
+        else:
+            target.parent.mkdir(parents=True, exist_ok=True)
+            if move:
+                os.replace(source, target)
+            else:
+                shutil.copyfile(source, target)
+        attachment_blobs.update_one({'_id': sha}, {'$setOnInsert': {'size': size}}, upsert=True)
+
+    def store_local(self, path: Path) -> str:
+        """
+        Добавляет в хранилище файл с диска (например, из media)
+        :return: sha256 содержимого
+        """
+        if path not in self._local:
+            sha = file_sha256(path)
+            self._store(path, sha, path.stat().st_size, move=False)
+            self._local[path] = sha
+        return self._local[path]
+
+    def send(self, bot: Bot, chat_id: int, sha: str, filename: str, kind: str = 'document', **kwargs) -> Message:
+        """
+        Отправляет файл из хранилища: по сохраненному file_id, а если его нет - загружает файл в Telegram
+        :param bot: бот
+        :param chat_id: идентификатор чата
+        :param sha: sha256 содержимого
+        :param filename: имя файла для пользователя
+        :param kind: тип сообщения Telegram (document, video, photo, ...)
+        :param kwargs: дополнительные параметры метода send_{kind}
+        :return: отправленное сообщение
+        """
+        sender = getattr(bot, f'send_{kind}')
+        blob = attachment_blobs.find_one({'_id': sha}) or {}
+        if blob.get('file_id'):
+            try:
+                message = sender(chat_id, blob['file_id'], **kwargs)
+                attachment_sends_total.inc(source='telegram')
+                return message
+            except BadRequest as e:
+                logger.warning('file_id для %s не принят Telegram, файл будет загружен заново: %s', sha, e)
+        with open(self.path(sha), 'rb') as file:
+            message = sender(chat_id, file, filename=filename, **kwargs)
+        attachment_sends_total.inc(source='upload')
+        sent = getattr(message, kind)
+        if isinstance(sent, list):  # фотографии приходят в нескольких размерах
+            sent = sent[-1]
+        attachment_blobs.update_one({'_id': sha}, {'$set': {'file_id': sent.file_id}}, upsert=True)
+        return message
+
+    def send_attachment(self, bot: Bot, chat_id: int, key: str) -> bool:
+        """
+        Отправляет вложение элжура по ключу кнопки, при необходимости скачивая его
+        :return: удалось ли отправить вложение
+        """
+        document = attachments.find_one({'_id': key})
+        if not document:
+            return False
+        sha = document.get('sha') or self.fetch(key)
+        if not sha:
+            return False
+        try:
+            self.send(bot, chat_id, sha, filename=document['filename'])
+        except FileNotFoundError:  # файл удален из хранилища, а file_id нет
+            sha = self.fetch(key, force=True)
+            if not sha:
+                return False
+            self.send(bot, chat_id, sha, filename=document['filename'])
+        return True
+
+    def send_media(self, bot: Bot, chat_id: int, path: Path, kind: str = 'document', **kwargs) -> Message:
+        """
+        Отправляет файл из поставки бота (media), загружая его в Telegram только один раз
+        """
+        return self.send(bot, chat_id, self.store_local(path), filename=path.name, kind=kind, **kwargs)
+
+
+mirror = AttachmentMirror()
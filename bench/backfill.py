@@ -0,0 +1,52 @@
+"""
+Время полной загрузки большого ящика (первичная синхронизация) с фейковым элжуром с задержкой ответа:
+страницы по одной (BACKFILL_THREADS=1) против параллельной загрузки страниц.
+
+С --store none запись в базу не выполняется (страницы только разбираются), так замеряется загрузка страниц
+без учета базы: mongomock выполняет upsert полным просмотром коллекции, и на 20 тысячах сообщений запись
+в него занимает больше, чем сама загрузка. Чтобы замерить с записью, задайте mongo_uri настоящей MongoDB.
+
+Пример: python -m bench.backfill --inbox 20000 --sent 2000 --latency 1 --threads 1 4 8
+"""
+import argparse
+import time
+from typing import List, Tuple
+
+from bench.fake_eljur import FakeEljur
+from bench.scenario import setup_environment, seed_users
+
+
+def run(args) -> List[Tuple[int, float, int, int]]:
+    fake = FakeEljur(latency=args.latency, inbox_size=args.inbox, sent_size=args.sent)
+    setup_environment(fake.start())
+
+    import CachedTelegramEljur as module
+    from constants import MessageFolder
+    from database import messages
+
+    if args.store == 'none':
+        module.CachedTelegramEljur._store_page = lambda self, folder, page_messages, queue_read: []
+    report = []
+    for chat_id, threads in zip(seed_users(len(args.threads)), args.threads):
+        module.BACKFILL_THREADS = threads
+        ejuser = module.CachedTelegramEljur(chat_id=chat_id, no_messages=True)
+        fake.reset_counters()
+        begin = time.perf_counter()
+        ejuser.download_messages_preview(check_new_only=False, folder=MessageFolder.INBOX)
+        report.append((threads, time.perf_counter() - begin, fake.requests['getmessages'],
+                       messages.count_documents({'chat_id': chat_id})))
+    fake.stop()
+    return report
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Время полной загрузки большого ящика')
+    parser.add_argument('--inbox', type=int, default=20000)
+    parser.add_argument('--sent', type=int, default=2000)
+    parser.add_argument('--latency', type=float, default=1.0, help='задержка ответа элжура, секунды')
+    parser.add_argument('--threads', type=int, nargs='+', default=[1, 4])
+    parser.add_argument('--store', choices=('db', 'none'), default='db', help='записывать ли сообщения в базу')
+    args = parser.parse_args()
+    for threads, elapsed, requests, stored in run(args):
+        print(f'BACKFILL_THREADS={threads}: {elapsed:.1f} с, запросов getmessages {requests}, '
+              f'записано сообщений {stored}')
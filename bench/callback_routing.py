@@ -0,0 +1,103 @@
+"""
+Выбор обработчика нажатия inline-кнопки: прежняя схема (по CallbackQueryHandler с регулярным выражением на каждое
+действие, Dispatcher проверяет их по порядку, обработчик разбирает query.data через split) против одного
+CallbackQueryHandler с callbacks.CallbackRouter (код действия -> обработчик по словарю, разбор в NamedTuple).
+
+Замеряется только выбор обработчика и разбор данных, сами обработчики не вызываются.
+
+Пример: python -m bench.callback_routing --repeat 200000
+"""
+import argparse
+import timeit
+from typing import Callable, List, Tuple
+
+from telegram import CallbackQuery, Update, User
+from telegram.ext import CallbackQueryHandler
+
+from callbacks import Action, Origin, CallbackRouter, encode, decode
+from constants import MessageFolder
+
+# шаблоны и порядок обработчиков до перехода на callbacks
+LEGACY_PATTERNS = [
+    '^login$',
+    '^homework_[0-9.]*$',
+    '^(page_inbox_|page_sent_|page_unread_)(prev|next|it|[0-9]*)*$',
+    '^(message_inbox_|message_sent_|message_view_new_)[0-9]*(|_[0-9]*_(starred|search))$',
+    '^(reply_inbox_|reply_sent_|reply_all_inbox_|reply_all_sent_)[0-9]*$',
+    '^(update_inbox|update_sent)$',
+    '^(recipients_inbox_|recipients_sent_)[0-9]*_(prev|next|it)$',
+    '^close$',
+    '^file_[0-9a-f]+$',
+    '^(star_inbox_|star_sent_|unstar_inbox_|unstar_sent_)[0-9]*$',
+    '^starred_(inbox|sent)_[0-9]*$',
+    '^search_[0-9]+$',
+]
+
+# (старые данные, новые данные) для типичных нажатий, от первых шаблонов в списке к последним
+PRESSES = [
+    ('homework_20.10.2026', encode(Action.HOMEWORK, '20.10.2026')),
+    ('page_inbox_next', encode(Action.PAGE, MessageFolder.INBOX, 0, 1)),
+    ('message_inbox_12345678', encode(Action.VIEW, MessageFolder.INBOX, '12345678')),
+    ('message_sent_12345678_2_starred', encode(Action.VIEW, MessageFolder.SENT, '12345678', Origin.STARRED, 2)),
+    ('reply_all_inbox_12345678', encode(Action.REPLY, MessageFolder.INBOX, '12345678', True)),
+    ('recipients_inbox_12345678_next', encode(Action.RECIPIENTS, MessageFolder.INBOX, '12345678', 1)),
+    ('file_0123456789abcdef0123', encode(Action.FILE, '0123456789abcdef0123')),
+    ('starred_sent_2', encode(Action.STARRED, MessageFolder.SENT, 2)),
+]
+
+
+def make_update(data: str) -> Update:
+    user = User(id=1, first_name='bench', is_bot=False)
+    return Update(1, callback_query=CallbackQuery(id='1', from_user=user, chat_instance='1', data=data))
+
+
+def legacy_route(handlers: List[CallbackQueryHandler]) -> Callable[[Update], object]:
+    def route(update: Update):
+        for handler in handlers:  # так Dispatcher перебирает обработчики группы
+            if handler.check_update(update):
+                return update.callback_query.data.split('_')
+        return None
+
+    return route
+
+
+def router_route(router: CallbackRouter) -> Callable[[Update], object]:
+    handler = CallbackQueryHandler(router.dispatch)
+    routes = router._routes
+
+    def route(update: Update):
+        if handler.check_update(update):
+            decoded = decode(update.callback_query.data)
+            return routes[decoded[0]], decoded[1]
+        return None
+
+    return route
+
+
+def measure(route: Callable[[Update], object], data: str, repeat: int) -> float:
+    """
+    :return: время одного выбора обработчика, наносекунды
+    """
+    update = make_update(data)
+    assert route(update) is not None, data
+    return min(timeit.repeat(lambda: route(update), number=repeat, repeat=3)) / repeat * 1e9
+
+
+def run(args) -> List[Tuple[str, float, float, float]]:
+    handlers = [CallbackQueryHandler(lambda update, context: None, pattern=pattern) for pattern in LEGACY_PATTERNS]
+    router = CallbackRouter()
+    for action in vars(Action).values():
+        if isinstance(action, str) and len(action) == 1:
+            router.add(action, lambda update, context, parsed: None)
+    old, new = legacy_route(handlers), router_route(router)
+    return [(legacy, measure(old, legacy, args.repeat), measure(new, legacy, args.repeat),
+             measure(new, compact, args.repeat)) for legacy, compact in PRESSES]
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Выбор обработчика нажатия inline-кнопки')
+    parser.add_argument('--repeat', type=int, default=100000)
+    args = parser.parse_args()
+    print(f'{"нажатие":<34} {"шаблоны, нс":>12} {"роутер (старые), нс":>20} {"роутер (v1), нс":>16}')
+    for data, old, new_legacy, new in run(args):
+        print(f'{data:<34} {old:>12.0f} {new_legacy:>20.0f} {new:>16.0f}')
@@ -0,0 +1,313 @@
+"""
+Локальный заменитель API eljur.ru для нагрузочного тестирования.
+
+Отдает правдоподобные ответы getmessages/getmessageinfo/gethomework/getmarks и др.
+для любого количества пользователей, имитирует задержку ответа и появление новых сообщений.
+
+Запуск отдельно: python -m bench.fake_eljur --port 8081 --latency 0.2
+"""
+import argparse
+import random
+import time
+from collections import defaultdict
+from datetime import datetime, timedelta
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+from json import dumps
+from threading import Lock, Thread
+from typing import Dict, Any, Optional, Set, Union
+from urllib.parse import urlparse, parse_qs
+
+UNAUTHORIZED = object()  # результат handle: ответ 401 на отозванный или истекший токен
+
+FIRSTNAMES = ['Анна', 'Иван', 'Мария', 'Петр', 'Елена', 'Сергей', 'Ольга', 'Дмитрий']
+LASTNAMES = ['Иванова', 'Петров', 'Смирнова', 'Кузнецов', 'Попова', 'Соколов', 'Лебедева', 'Козлов']
+MIDDLENAMES = ['Александровна', 'Сергеевич', 'Игоревна', 'Олегович', '']
+SUBJECTS = ['Контрольная по физике', 'Родительское собрание', 'Экскурсия', 'Олимпиада по математике',
+            'Изменение расписания', 'Домашнее задание', 'Консультация перед экзаменом', 'Справка']
+LESSONS = ['Алгебра', 'Геометрия', 'Физика', 'Химия', 'Русский язык', 'Литература', 'История', 'Английский язык']
+WEEKDAYS = ['Понедельник', 'Вторник', 'Среда', 'Четверг', 'Пятница', 'Суббота']
+BODY = '<p>Уважаемые родители и ученики!</p><p>Напоминаем, что {subject} состоится в ближайшее время. ' \
+       'Подробности по ссылке https://eljur.ru/info/{id} и в приложенных файлах.</p><br/>' \
+       'Просьба ознакомиться заранее. ' * 3
+
+
+def fake_user(seed: int) -> Dict[str, str]:
+    rnd = random.Random(seed)
+    return {
+        'name': str(100000 + seed),
+        'firstname': rnd.choice(FIRSTNAMES),
+        'lastname': rnd.choice(LASTNAMES),
+        'middlename': rnd.choice(MIDDLENAMES),
+    }
+
+
+class Mailbox:
+    """
+    Почтовый ящик одного пользователя фейкового элжура. Сообщения генерируются по номеру, в памяти хранится
+    только состояние прочтения
+    """
+
+    def __init__(self, owner: int, inbox_size: int, sent_size: int, unread: int, base_url: str):
+        self.owner = owner
+        self.base_url = base_url
+        self.sizes = {'inbox': inbox_size, 'sent': sent_size}
+        self.read_ids = set()
+        self.unread_tail = unread
+        self.lock = Lock()
+        self.started = datetime(2020, 10, 19, 9, 0, 0)
+
+    def add_incoming(self) -> None:
+        with self.lock:
+            self.sizes['inbox'] += 1
+
+    def msg_id(self, folder: str, number: int) -> str:
+        return str(self.owner * 10 ** 7 + (0 if folder == 'inbox' else 5 * 10 ** 6) + number)
+
+    def is_unread(self, folder: str, number: int, msg_id: str) -> bool:
+        return folder == 'inbox' and number > self.sizes['inbox'] - self.unread_tail and msg_id not in self.read_ids
+
+    def preview(self, folder: str, number: int) -> Dict[str, Any]:
+        msg_id = self.msg_id(folder, number)
+        rnd = random.Random(int(msg_id))
+        subject = rnd.choice(SUBJECTS)
+        if rnd.random() < 0.3:
+            subject = f'Re: {subject}'
+        msg = {
+            'id': msg_id,
+            'subject': subject,
+            'short_text': BODY.format(subject=subject.lower(), id=msg_id)[:150],
+            'date': (self.started + timedelta(minutes=37 * number)).strftime('%Y-%m-%d %H:%M:%S'),
+            'unread': self.is_unread(folder, number, msg_id),
+            'with_files': rnd.random() < 0.2,
+        }
+        if folder == 'inbox':
+            msg['user_from'] = fake_user(rnd.randrange(300))
+        else:
+            msg['user_from'] = fake_user(self.owner)
+            msg['users_to'] = [fake_user(rnd.randrange(300)) for _ in range(rnd.choice([1, 1, 1, 3]))]
+        return msg
+
+    def page(self, folder: str, page: int, limit: int, unreadonly: bool) -> Dict[str, Any]:
+        with self.lock:
+            size = self.sizes[folder]
+            numbers = range(size, 0, -1)
+            if unreadonly:
+                numbers = [n for n in range(size, max(0, size - self.unread_tail), -1)
+                           if self.is_unread(folder, n, self.msg_id(folder, n))]
+            numbers = list(numbers)
+            chunk = numbers[(page - 1) * limit:page * limit]
+            msgs = [self.preview(folder, n) for n in chunk]
+        result = {'total': str(len(numbers)), 'count': str(len(msgs))}
+        if msgs:
+            result['messages'] = msgs
+        return result
+
+    def full(self, msg_id: str) -> Optional[Dict[str, Any]]:
+        number = int(msg_id) % (5 * 10 ** 6)
+        folder = 'sent' if int(msg_id) % 10 ** 7 >= 5 * 10 ** 6 else 'inbox'
+        if not 0 < number <= self.sizes[folder]:
+            return None
+        msg = self.preview(folder, number)
+        rnd = random.Random(int(msg_id) + 1)
+        msg['text'] = BODY.format(subject=msg['subject'].lower(), id=msg_id)
+        msg['user_to'] = msg.pop('users_to', None) or [fake_user(self.owner)] + \
+            [fake_user(rnd.randrange(300)) for _ in range(rnd.choice([0, 0, 5, 40]))]
+        if msg['with_files']:
+            msg['files'] = [{'filename': f'file_{msg_id}.pdf', 'link': f'{self.base_url}/files/{msg_id}.pdf'}]
+        with self.lock:
+            self.read_ids.add(msg_id)
+        msg['unread'] = False
+        return msg
+
+
+class FakeEljur:
+    """
+    Состояние фейкового элжура: почтовые ящики, счетчики запросов и переданных байт
+    """
+
+    def __init__(self, latency: float = 0.0, jitter: float = 0.0, inbox_size: int = 300, sent_size: int = 50,
+                 unread: int = 3, new_message_every: float = 0.0, token_ttl: float = 90 * 24 * 3600):
+        self.latency = latency
+        self.jitter = jitter
+        self.inbox_size = inbox_size
+        self.sent_size = sent_size
+        self.unread = unread
+        self.new_message_every = new_message_every
+        self.token_ttl = token_ttl  # время жизни токенов, выданных методом auth, секунды
+        self.tokens: Dict[str, datetime] = {}  # выданные методом auth токены и время их истечения
+        self.revoked: Set[str] = set()  # отозванные токены - элжур отвечает на них 401
+        self.mailboxes: Dict[str, Mailbox] = {}
+        self.requests = defaultdict(int)
+        self.bytes_sent = defaultdict(int)
+        self.lock = Lock()
+        self.server: Optional[ThreadingHTTPServer] = None
+        self.base_url = ''
+
+    def mailbox(self, token: str) -> Mailbox:
+        with self.lock:
+            owner = token.split('-')[-1]  # у пользователя один ящик, сколько бы токенов ему ни выдали
+            if owner not in self.mailboxes:
+                number = int(owner) if owner.isdigit() else len(self.mailboxes) + 1
+                self.mailboxes[owner] = Mailbox(number, self.inbox_size, self.sent_size, self.unread, self.base_url)
+            return self.mailboxes[owner]
+
+    def token_valid(self, token: str) -> bool:
+        with self.lock:
+            if token in self.revoked:
+                return False
+            return token not in self.tokens or self.tokens[token] > datetime.now()
+
+    def count(self, endpoint: str, size: int) -> None:
+        with self.lock:
+            self.requests[endpoint] += 1
+            self.bytes_sent[endpoint] += size
+
+    @property
+    def total_requests(self) -> int:
+        return sum(self.requests.values())
+
+    def reset_counters(self) -> None:
+        with self.lock:
+            self.requests.clear()
+            self.bytes_sent.clear()
+
+    def delay(self) -> None:
+        if self.latency or self.jitter:
+            time.sleep(max(0.0, self.latency + random.uniform(-self.jitter, self.jitter)))
+
+    def handle(self, endpoint: str, params: Dict[str, str]) -> Union[Dict[str, Any], object, None]:
+        """
+        :return: результат ответа элжура, None - ответ 400, UNAUTHORIZED - ответ 401
+        """
+        token = params.get('auth_token', '')
+        if endpoint == 'auth':
+            if params.get('password') == 'wrong':
+                return None
+            expires = datetime.now() + timedelta(seconds=self.token_ttl)
+            with self.lock:
+                token = f"token-{len(self.tokens) + 1}-{params.get('login', '0').split('-')[-1]}"
+                self.tokens[token] = expires
+            return {'token': token, 'expires': expires.strftime('%Y-%m-%d %H:%M:%S')}
+        if not self.token_valid(token):
+            return UNAUTHORIZED
+        box = self.mailbox(token)
+        if endpoint == 'getmessages':
+            return box.page(params.get('folder', 'inbox'), int(params.get('page', 1)), int(params.get('limit', 6)),
+                            params.get('unreadonly') == 'true')
+        if endpoint == 'getmessageinfo':
+            msg = box.full(params.get('id', '0'))
+            return {'message': msg} if msg else None
+        if endpoint in ('gethomework', 'getschedule'):
+            rnd = random.Random(box.owner)
+            days = {}
+            for shift in range(6):
+                day = box.started + timedelta(days=shift)
+                items = {}
+                for lesson in rnd.sample(LESSONS, 5):
+                    items[lesson] = {'homework': {'1': {'value': f'§{rnd.randrange(1, 40)}, упр. '
+                                                                 f'{rnd.randrange(1, 500)}-{rnd.randrange(1, 500)}'}}}
+                days[day.strftime('%Y%m%d')] = {'title': WEEKDAYS[shift], 'items': items}
+            return {'students': {str(box.owner): {'days': days}}}
+        if endpoint == 'getperiods':
+            return {'students': [{'periods': [
+                {'start': '20200901', 'end': '20201031', 'fullname': '1 четверть'},
+                {'start': '20201101', 'end': '20201229', 'fullname': '2 четверть'},
+            ]}]}
+        if endpoint == 'getmarks':
+            rnd = random.Random(box.owner)
+            lessons = []
+            for lesson in LESSONS:
+                marks = [{'value': str(rnd.randrange(2, 6))} for _ in range(rnd.randrange(0, 8))]
+                average = round(sum(int(m['value']) for m in marks) / len(marks), 2) if marks else 0
+                lessons.append({'name': lesson, 'average': average, 'marks': marks})
+            return {'students': {str(box.owner): {'lessons': lessons}}}
+        if endpoint == 'getrules':
+            return fake_user(box.owner)
+        if endpoint == 'getmessagereceivers':
+            return {'groups': {f'group{g}': {'key': f'group{g}', 'name': f'Группа {g}',
+                                             'users': [fake_user(g * 100 + u) for u in range(100)]}
+                               for g in range(10)}}
+        if endpoint in ('sendmessage', 'sendreplymessage'):
+            return {}
+        return None
+
+    def new_messages_loop(self) -> None:
+        while self.server:
+            time.sleep(self.new_message_every)
+            with self.lock:
+                boxes = list(self.mailboxes.values())
+            for box in boxes:
+                box.add_incoming()
+
+    def start(self, port: int = 0) -> str:
+        """
+        Запускает HTTP-сервер в фоновом потоке
+        :param port: порт, 0 - любой свободный
+        :return: базовый адрес API для переменной окружения eljur_api
+        """
+        fake = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def reply(self, params: Dict[str, str]):
+                path = urlparse(self.path).path.rstrip('/')
+                endpoint = path.split('/')[-1]
+                fake.delay()
+                if '/files/' in path:
+                    body = (endpoint * 2048).encode('utf-8')
+                    content_type = 'application/pdf'
+                    status = 200
+                else:
+                    result = fake.handle(endpoint, params)
+                    status = 401 if result is UNAUTHORIZED else 200 if result is not None else 400
+                    result = None if result is UNAUTHORIZED else result
+                    body = dumps({'response': {'state': status, 'error': None if result is not None else 'error',
+                                               'result': result}}, ensure_ascii=False).encode('utf-8')
+                    content_type = 'application/json; charset=utf-8'
+                fake.count(endpoint, len(body))
+                self.send_response(status)
+                self.send_header('Content-Type', content_type)
+                self.send_header('Content-Length', str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def do_GET(self):
+                self.reply({k: v[0] for k, v in parse_qs(urlparse(self.path).query).items()})
+
+            def do_POST(self):
+                length = int(self.headers.get('Content-Length', 0))
+                self.reply({k: v[0] for k, v in parse_qs(self.rfile.read(length).decode('utf-8')).items()})
+
+            def log_message(self, *args):
+                pass
+
+        self.server = ThreadingHTTPServer(('127.0.0.1', port), Handler)
+        self.server.daemon_threads = True
+        self.base_url = f'http://127.0.0.1:{self.server.server_address[1]}/api'
+        Thread(target=self.server.serve_forever, daemon=True, name='Fake-Eljur').start()
+        if self.new_message_every:
+            Thread(target=self.new_messages_loop, daemon=True, name='Fake-Eljur-New').start()
+        return self.base_url
+
+    def stop(self) -> None:
+        if self.server:
+            server, self.server = self.server, None
+            server.shutdown()
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Фейковый API eljur.ru')
+    parser.add_argument('--port', type=int, default=8081)
+    parser.add_argument('--latency', type=float, default=0.0, help='задержка ответа, секунды')
+    parser.add_argument('--jitter', type=float, default=0.0, help='разброс задержки, секунды')
+    parser.add_argument('--inbox', type=int, default=300, help='входящих сообщений на пользователя')
+    parser.add_argument('--sent', type=int, default=50, help='отправленных сообщений на пользователя')
+    parser.add_argument('--new-every', type=float, default=0.0, help='период появления новых сообщений, секунды')
+    args = parser.parse_args()
+    server = FakeEljur(latency=args.latency, jitter=args.jitter, inbox_size=args.inbox, sent_size=args.sent,
+                       new_message_every=args.new_every)
+    print(f'eljur_api={server.start(args.port)}')
+    try:
+        while True:
+            time.sleep(3600)
+    except KeyboardInterrupt:
+        server.stop()
@@ -0,0 +1,97 @@
+"""
+Локальный заменитель Telegram Bot API для замеров обработчиков без обращения к Telegram.
+
+Принимает вызовы методов (sendMessage, editMessageText, answerCallbackQuery, ...), записывает их и отвечает
+правдоподобными результатами, имитирует задержку ответа. Бот подключается к нему через
+Bot(token, base_url=FakeTelegram.base_url).
+"""
+import json
+import time
+from collections import defaultdict
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+from threading import Lock, Thread
+from typing import Any, Dict, List, Optional, Tuple
+from urllib.parse import parse_qs
+
+BOT_USER = {'id': 123456, 'is_bot': True, 'first_name': 'Bench', 'username': 'bench_bot'}
+MESSAGE_METHODS = {'sendMessage', 'editMessageText', 'editMessageReplyMarkup', 'sendDocument', 'sendPhoto'}
+
+
+class FakeTelegram:
+    def __init__(self, latency: float = 0.0):
+        self.latency = latency  # задержка ответа на каждый вызов, секунды
+        self.calls: List[Tuple[str, Dict[str, Any]]] = []  # (метод, параметры) в порядке вызова
+        self.requests = defaultdict(int)
+        self.lock = Lock()
+        self.server: Optional[ThreadingHTTPServer] = None
+        self.base_url = ''
+        self._message_id = 0
+
+    def reset_counters(self) -> None:
+        with self.lock:
+            self.calls.clear()
+            self.requests.clear()
+
+    @property
+    def total_requests(self) -> int:
+        with self.lock:
+            return len(self.calls)
+
+    def handle(self, method: str, params: Dict[str, Any]) -> Any:
+        with self.lock:
+            self.calls.append((method, params))
+            self.requests[method] += 1
+            self._message_id += 1
+            message_id = self._message_id
+        if method == 'getMe':
+            return BOT_USER
+        if method in MESSAGE_METHODS:
+            chat_id = int(params.get('chat_id') or 0)
+            message = {'message_id': int(params.get('message_id') or message_id), 'date': int(time.time()),
+                       'chat': {'id': chat_id, 'type': 'private'}, 'from': BOT_USER, 'text': params.get('text', '')}
+            if method == 'sendDocument':
+                message['document'] = {'file_id': f'file-{message_id}', 'file_unique_id': f'unique-{message_id}'}
+            return message
+        return True
+
+    def start(self, port: int = 0) -> str:
+        """
+        Запускает HTTP-сервер в фоновом потоке
+        :return: base_url для telegram.Bot
+        """
+        fake = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def do_POST(self):
+                method = self.path.rstrip('/').split('/')[-1]
+                length = int(self.headers.get('Content-Length', 0))
+                body = self.rfile.read(length)
+                content_type = self.headers.get('Content-Type', '')
+                if content_type.startswith('application/json'):
+                    params = json.loads(body or b'{}')
+                elif content_type.startswith('application/x-www-form-urlencoded'):
+                    params = {k: v[0] for k, v in parse_qs(body.decode('utf-8')).items()}
+                else:  # multipart с файлом - параметры не разбираются
+                    params = {}
+                if fake.latency:
+                    time.sleep(fake.latency)
+                reply = json.dumps({'ok': True, 'result': fake.handle(method, params)}).encode('utf-8')
+                self.send_response(200)
+                self.send_header('Content-Type', 'application/json')
+                self.send_header('Content-Length', str(len(reply)))
+                self.end_headers()
+                self.wfile.write(reply)
+
+            def log_message(self, *args):
+                pass
+
+        self.server = ThreadingHTTPServer(('127.0.0.1', port), Handler)
+        self.server.daemon_threads = True
+        self.base_url = f'http://127.0.0.1:{self.server.server_address[1]}/bot'
+        Thread(target=self.server.serve_forever, daemon=True, name='Fake-Telegram').start()
+        return self.base_url
+
+    def stop(self) -> None:
+        if self.server:
+            server, self.server = self.server, None
+            server.shutdown()
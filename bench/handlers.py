@@ -0,0 +1,181 @@
+"""
+Время работы обработчиков бота без Telegram: настоящий диспетчер с обработчиками бота (eljurbot.add_handlers)
+получает синтетические обновления, бот обращается к фейковому Bot API (bench.fake_telegram), элжур - фейковый
+(bench.fake_eljur), база - mongomock с заранее записанными ящиками разного размера.
+
+Обновление считается обработанным, когда пулы обработчиков освободились. Отчет: для каждого размера ящика
+и обработчика p50/p99 времени обработки обновления и вызовы Bot API на обновление. С --trace-file все трассы
+записываются в файл, и для каждого обработчика выводится среднее время по видам обращений (mongo, eljur, telegram).
+
+Пример: python -m bench.handlers --sizes 100 1000 5000 --rounds 20 --bot-latency 0.05
+"""
+import argparse
+import json
+import os
+import random
+import time
+from collections import defaultdict
+from typing import Callable, Dict, List, Tuple
+
+from bench.fake_eljur import FakeEljur
+from bench.fake_telegram import FakeTelegram
+from bench.scenario import setup_environment, seed_users, percentile
+
+TOKEN = '123456:bench'
+
+
+def message_update(update_id: int, chat_id: int, text: str) -> dict:
+    message = {'message_id': update_id, 'date': 0, 'chat': {'id': chat_id, 'type': 'private'},
+               'from': {'id': chat_id, 'is_bot': False, 'first_name': 'Bench'}, 'text': text}
+    if text.startswith('/'):
+        message['entities'] = [{'type': 'bot_command', 'offset': 0, 'length': len(text.split()[0])}]
+    return {'update_id': update_id, 'message': message}
+
+
+def callback_update(update_id: int, chat_id: int, data: str) -> dict:
+    chat = {'id': chat_id, 'type': 'private'}
+    return {'update_id': update_id,
+            'callback_query': {'id': str(update_id), 'chat_instance': '1', 'data': data,
+                               'from': {'id': chat_id, 'is_bot': False, 'first_name': 'Bench'},
+                               'message': {'message_id': 1, 'date': 0, 'chat': chat, 'text': 'Сообщения'}}}
+
+
+def seed_mailbox(fake: FakeEljur, chat_id: int, inbox: int, sent: int) -> None:
+    """
+    Записывает ящик пользователя в базу напрямую, без загрузки из элжура
+    """
+    from database import data, messages
+
+    box = fake.mailbox(data.find_one({'chat_id': chat_id})['auth_token'])
+    box.sizes = {'inbox': inbox, 'sent': sent}
+    for folder, size in box.sizes.items():
+        for begin in range(1, size + 1, 1000):
+            messages.insert_many([{'chat_id': chat_id, 'folder': folder, **box.preview(folder, number)}
+                                  for number in range(begin, min(size, begin + 999) + 1)], ordered=False)
+
+
+def steps(chat_id: int, rnd: random.Random) -> List[Tuple[str, Callable[[int], dict]]]:
+    """
+    Действия пользователя за один круг: (имя обработчика, функция update_id -> обновление)
+    """
+    from callbacks import Action, encode
+    from constants import MessageFolder
+    from CTEStorage import cte
+
+    ejuser = cte.get_cte(chat_id=chat_id)
+    inbox = [msg.id for msg in ejuser.messages(MessageFolder.INBOX)[:30]]
+    sent = [msg.id for msg in ejuser.messages(MessageFolder.SENT)[:30]]
+    msg_id, sent_id = rnd.choice(inbox), rnd.choice(sent)
+    day = rnd.choice(list(ejuser.homework or {'': None}))
+
+    def text(value: str) -> Callable[[int], dict]:
+        return lambda update_id: message_update(update_id, chat_id, value)
+
+    def button(action: str, *values) -> Callable[[int], dict]:
+        data = encode(action, *values)
+        return lambda update_id: callback_update(update_id, chat_id, data)
+
+    return [
+        ('messages_handler', text('Сообщения')),
+        ('messages_page_handler', button(Action.PAGE, MessageFolder.INBOX, 0, 1)),
+        ('messages_page_handler', button(Action.PAGE, MessageFolder.INBOX, 0, 1)),
+        ('view_message', button(Action.VIEW, MessageFolder.INBOX, msg_id)),
+        ('star_handler', button(Action.STAR, MessageFolder.INBOX, msg_id)),
+        ('starred_messages', button(Action.STARRED, MessageFolder.INBOX)),
+        ('message_recipients', button(Action.RECIPIENTS, MessageFolder.SENT, sent_id)),
+        ('update_messages', button(Action.UPDATE, MessageFolder.INBOX)),
+        ('homework', text('Домашнее задание')),
+        ('homework_handler', button(Action.HOMEWORK, day)),
+        ('search_handler', text('/search экзамен')),
+        ('search_page_handler', button(Action.SEARCH, 1)),
+    ]
+
+
+def trace_summary(path: str) -> Dict[str, Dict[str, float]]:
+    """
+    :return: среднее время на обновление по видам span'ов для каждого обработчика, мс
+    """
+    totals = defaultdict(lambda: defaultdict(float))
+    counts = defaultdict(int)
+    with open(path, encoding='utf-8') as file:
+        for line in file:
+            trace = json.loads(line)
+            counts[trace['name']] += 1
+            totals[trace['name']]['total'] += trace['duration_ms']
+            for item in trace['spans']:
+                totals[trace['name']][item['kind']] += item['duration_ms'] or 0.0
+    return {name: {kind: value / counts[name] for kind, value in kinds.items()} for name, kinds in totals.items()}
+
+
+def run(args) -> Dict[int, Dict[str, Dict[str, float]]]:
+    eljur = FakeEljur(latency=args.eljur_latency)
+    if args.trace_file:
+        os.environ['trace_file'] = args.trace_file
+        os.environ['trace_sample_rate'] = '1'
+    setup_environment(eljur.start())
+    telegram = FakeTelegram(latency=args.bot_latency)
+    telegram.start()
+
+    from telegram import Bot, Update
+    from telegram.ext import Dispatcher, DictPersistence
+
+    import eljurbot
+    from executor import cache_pool, eljur_pool
+    from tracing import TracedRequest, exporter
+
+    chat_ids = seed_users(len(args.sizes))
+    conversations = {'bot_conversation': {json.dumps([chat_id, chat_id]): eljurbot.MAIN_MENU for chat_id in chat_ids}}
+    bot = Bot(TOKEN, base_url=telegram.base_url, request=TracedRequest(con_pool_size=8))
+    dispatcher = Dispatcher(bot, update_queue=None, workers=1, use_context=True,
+                            persistence=DictPersistence(conversations_json=json.dumps(conversations)))
+    eljurbot.add_handlers(dispatcher)
+
+    rnd = random.Random(args.seed)
+    update_id = 0
+    report = {}
+    for chat_id, size in zip(chat_ids, args.sizes):
+        seed_mailbox(eljur, chat_id, inbox=size, sent=max(1, size // 10))
+        latency = defaultdict(list)
+        calls = defaultdict(list)
+        for round_number in range(args.rounds + 1):  # первый круг прогревает кэши и в отчет не входит
+            for name, make_update in steps(chat_id, rnd):
+                update_id += 1
+                update = Update.de_json(make_update(update_id), bot)
+                telegram.reset_counters()
+                begin = time.perf_counter()
+                dispatcher.process_update(update)
+                cache_pool.wait_idle()
+                eljur_pool.wait_idle()
+                elapsed = time.perf_counter() - begin
+                if round_number:
+                    latency[name].append(elapsed)
+                    calls[name].append(telegram.total_requests)
+        report[size] = {name: {'count': len(values), 'p50': percentile(values, 50) * 1000,
+                               'p99': percentile(values, 99) * 1000,
+                               'calls': sum(calls[name]) / len(calls[name])} for name, values in latency.items()}
+    exporter.flush()
+    telegram.stop()
+    eljur.stop()
+    return report
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Время работы обработчиков бота с фейковым Bot API')
+    parser.add_argument('--sizes', type=int, nargs='+', default=[100, 1000, 5000], help='входящих в ящике')
+    parser.add_argument('--rounds', type=int, default=20, help='кругов действий пользователя на размер ящика')
+    parser.add_argument('--bot-latency', type=float, default=0.0, help='задержка ответа Bot API, секунды')
+    parser.add_argument('--eljur-latency', type=float, default=0.0, help='задержка ответа элжура, секунды')
+    parser.add_argument('--seed', type=int, default=1)
+    parser.add_argument('--trace-file', help='записать все трассы в этот файл (JSONL)')
+    args = parser.parse_args()
+    if args.trace_file and os.path.exists(args.trace_file):
+        os.remove(args.trace_file)
+    for size, handlers in run(args).items():
+        print(f'Ящик {size} входящих:')
+        print(f'  {"обработчик":<24} {"p50, мс":>9} {"p99, мс":>9} {"вызовов Bot API":>16}')
+        for name, item in handlers.items():
+            print(f"  {name:<24} {item['p50']:>9.1f} {item['p99']:>9.1f} {item['calls']:>16.1f}")
+    if args.trace_file:
+        print('Среднее время на обновление по трассам, мс:')
+        for name, kinds in trace_summary(args.trace_file).items():
+            print(f'  {name:<24} ' + ', '.join(f'{kind} {value:.1f}' for kind, value in sorted(kinds.items())))
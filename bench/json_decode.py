@@ -0,0 +1,96 @@
+"""
+Разбор больших ответов элжура: json против orjson на байтах ответа и пиковая память при разборе страницы
+getmessages целиком против потокового разбора (codec.iter_items).
+
+Ответы записываются с фейкового элжура (bench.fake_eljur) один раз и затем разбираются из памяти.
+
+Пример: python -m bench.json_decode --limit 1000 --repeat 20
+"""
+import argparse
+import gc
+import io
+import json
+import time
+import tracemalloc
+from typing import Callable, Dict
+
+import requests
+
+import codec
+from bench.fake_eljur import FakeEljur
+
+
+def record(limit: int) -> Dict[str, bytes]:
+    """
+    :return: тела ответов getmessages (страница из limit сообщений) и getmessagereceivers (1000 получателей)
+    """
+    fake = FakeEljur(inbox_size=limit)
+    api = fake.start()
+    params = {'auth_token': 'token-1', 'vendor': 'bench', 'out_format': 'json'}
+    payloads = {
+        'getmessages': requests.get(f'{api}/getmessages', params={**params, 'folder': 'inbox', 'limit': limit,
+                                                                   'page': 1}).content,
+        'getmessagereceivers': requests.get(f'{api}/getmessagereceivers', params=params).content,
+    }
+    fake.stop()
+    return payloads
+
+
+def timed(func: Callable[[], object], repeat: int) -> float:
+    """
+    :return: лучшее время одного вызова, секунды
+    """
+    best = float('inf')
+    for _ in range(repeat):
+        begin = time.perf_counter()
+        func()
+        best = min(best, time.perf_counter() - begin)
+    return best
+
+
+def peak(func: Callable[[], object]) -> int:
+    gc.collect()
+    tracemalloc.start()
+    func()
+    size = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+    return size
+
+
+def consume_full(payload: bytes) -> int:
+    count = 0
+    for _ in json.loads(payload)['response']['result'].get('messages', []):
+        count += 1
+    return count
+
+
+def consume_stream(payload: bytes) -> int:
+    _, items = codec.iter_items(io.BytesIO(payload), 'response.result.messages')
+    count = 0
+    for _ in items:
+        count += 1
+    return count
+
+
+def run(args):
+    payloads = record(args.limit)
+    report = []
+    for name, payload in payloads.items():
+        stdlib = timed(lambda: json.loads(payload.decode('utf-8')), args.repeat)
+        fast = timed(lambda: codec.loads(payload), args.repeat)
+        report.append(f'{name}: {len(payload) / 2 ** 10:.0f} KB, json {stdlib * 1000:.2f} ms, '
+                      f'codec ({codec.JSON_BACKEND}) {fast * 1000:.2f} ms, в {stdlib / fast:.1f} раза быстрее')
+    payload = payloads['getmessages']
+    full, streamed = peak(lambda: consume_full(payload)), peak(lambda: consume_stream(payload))
+    report.append(f'getmessages, пиковая память: целиком {full / 2 ** 20:.2f} MB, '
+                  f'потоково ({codec.STREAM_BACKEND or "без ijson - целиком"}) {streamed / 2 ** 20:.2f} MB')
+    return report
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Разбор больших ответов элжура: json, orjson и потоковый разбор')
+    parser.add_argument('--limit', type=int, default=1000, help='сообщений на странице getmessages')
+    parser.add_argument('--repeat', type=int, default=20)
+    args = parser.parse_args()
+    for line in run(args):
+        print(line)
@@ -0,0 +1,136 @@
+"""
+Стоимость логов в цикле опроса: прежняя синхронная запись в файл в потоке, создавшем запись (как basicConfig до
+перехода на logs.setup), против записи через очередь фоновым потоком (logs.setup) в текстовом и JSON формате.
+Для сравнения замеряется тот же цикл с отключенными логами.
+
+Цикл для каждого пользователя: задача check_for_new_messages, загрузка первой страницы входящих из базы и
+кэширование полных сообщений (cache_full_messages). Первый цикл кэширует все прочитанные сообщения страницы
+и пишет по строке на сообщение, он выводится отдельно. --sink-latency имитирует медленный диск или stderr:
+задержку каждой записи в файл.
+
+Пример: python -m bench.logging_overhead --users 10 --cycles 10 --sink-latency 2
+"""
+import argparse
+import logging
+import os
+import tempfile
+import time
+from types import SimpleNamespace
+from typing import Callable, Dict, List
+
+from bench.fake_eljur import FakeEljur
+from bench.scenario import setup_environment, seed_users, percentile
+
+
+def slow_down(handler: logging.Handler, latency: float) -> None:
+    """
+    Добавляет задержку latency (секунды) к каждой записи обработчика
+    """
+    if not latency:
+        return
+    emit = handler.emit
+
+    def slow_emit(record: logging.LogRecord) -> None:
+        time.sleep(latency)
+        emit(record)
+
+    handler.emit = slow_emit
+
+
+def configure(mode: str, path: str, latency: float) -> Callable[[], None]:
+    """
+    Настраивает логи для режима mode
+    :return: функция, которая дописывает оставшиеся записи и отключает настройку
+    """
+    import logs
+
+    root = logging.getLogger()
+    logs.stop()
+    for handler in list(root.handlers):
+        root.removeHandler(handler)
+    logging.disable(logging.NOTSET)
+    if mode == 'off':
+        logging.disable(logging.CRITICAL)
+        return lambda: None
+    if mode == 'sync':
+        handler = logging.FileHandler(path, encoding='utf-8')
+        handler.setFormatter(logging.Formatter(logs.TEXT_FORMAT))
+        slow_down(handler, latency)
+        root.addHandler(handler)
+        root.setLevel(logging.INFO)
+
+        def close():
+            root.removeHandler(handler)
+            handler.close()
+
+        return close
+    logs.setup(path, fmt='json' if mode == 'queue json' else 'text', stream=False)
+    for handler in logs._listener.handlers:
+        slow_down(handler, latency)
+    return logs.stop
+
+
+def poll_cycle(chat_ids: List[int]) -> List[float]:
+    """
+    :return: время цикла опроса каждого пользователя, секунды
+    """
+    import eljurbot
+    from constants import MessageFolder
+    from CTEStorage import cte
+
+    bot = SimpleNamespace(send_message=lambda **kwargs: None)
+    elapsed = []
+    for chat_id in chat_ids:
+        begin = time.perf_counter()
+        eljurbot.check_for_new_messages(SimpleNamespace(job=SimpleNamespace(context=chat_id), bot=bot))
+        ejuser = cte.get_cte(chat_id=chat_id)
+        ejuser.get_messages(page=1, folder=MessageFolder.INBOX)
+        ejuser.cache_full_messages()
+        elapsed.append(time.perf_counter() - begin)
+    return elapsed
+
+
+def run(args) -> Dict[str, Dict[str, float]]:
+    fake = FakeEljur(inbox_size=args.inbox, sent_size=args.sent)
+    setup_environment(fake.start())
+    import eljurbot  # noqa: F401 - настраивает логи бота, настройка заменяется для каждого режима
+    from database import messages, cache_queue
+
+    modes = ['off', 'sync', 'queue text', 'queue json']
+    chat_ids = seed_users(args.users * len(modes))
+    directory = tempfile.mkdtemp(prefix='eljur_logs_')
+    report = {}
+    for index, mode in enumerate(modes):
+        users = chat_ids[index * args.users:(index + 1) * args.users]
+        path = os.path.join(directory, f"{mode.replace(' ', '_')}.log")
+        close = configure(mode, path, args.sink_latency)
+        begin = time.perf_counter()
+        poll_cycle(users)
+        cold = time.perf_counter() - begin
+        steady = []
+        for _ in range(args.cycles):
+            steady.extend(poll_cycle(users))
+        close()
+        lines = sum(1 for _ in open(path, encoding='utf-8')) if os.path.exists(path) else 0
+        for collection in (messages, cache_queue):  # mongomock просматривает коллекции целиком, режимы - в равных
+            collection.delete_many({'chat_id': {'$in': users}})
+        report[mode] = {'cold': cold, 'p50': percentile(steady, 50) * 1000, 'p99': percentile(steady, 99) * 1000,
+                        'cycle': sum(steady) / args.cycles, 'lines': lines}
+    logging.disable(logging.NOTSET)
+    fake.stop()
+    return report
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Стоимость логов в цикле опроса')
+    parser.add_argument('--users', type=int, default=10)
+    parser.add_argument('--cycles', type=int, default=10, help='циклов опроса после первого')
+    parser.add_argument('--sink-latency', type=float, default=0.0, help='задержка записи строки лога, мс')
+    parser.add_argument('--inbox', type=int, default=100)
+    parser.add_argument('--sent', type=int, default=20)
+    args = parser.parse_args()
+    args.sink_latency /= 1000
+    print(f'{"режим":<12} {"первый цикл, с":>15} {"цикл, с":>9} {"p50, мс":>9} {"p99, мс":>9} {"строк":>7}')
+    for mode, item in run(args).items():
+        print(f"{mode:<12} {item['cold']:>15.2f} {item['cycle']:>9.3f} {item['p50']:>9.2f} {item['p99']:>9.2f} "
+              f"{item['lines']:>7}")
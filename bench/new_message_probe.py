@@ -0,0 +1,80 @@
+"""
+Трафик проверки новых сообщений (задача check_for_new_messages): прежняя загрузка первой страницы
+из 100 сообщений обеих папок при каждой проверке против двухэтапной проверки (CachedTelegramEljur.check_new_messages).
+
+Проверки идут подряд без пауз, каждая считается за MESSAGES_CHECK_DELAY секунд; новые входящие появляются
+в фейковом элжуре случайно с заданной частотой на пользователя в час. Результат - запросы и байты ответов
+элжура на пользователя в час.
+
+Пример: python -m bench.new_message_probe --users 5 --hours 1 --new-per-hour 2
+"""
+import argparse
+import random
+from typing import Callable, Dict, List
+
+from bench.fake_eljur import FakeEljur
+from bench.scenario import setup_environment, seed_users
+
+
+def simulate(fake: FakeEljur, chat_ids: List[int], poll: Callable[[object], List[dict]], cycles: int,
+             new_per_cycle: float, seed: int) -> Dict[str, float]:
+    from CTEStorage import cte
+
+    rnd = random.Random(seed)
+    users = [cte.get_cte(chat_id=chat_id) for chat_id in chat_ids]
+    boxes = [fake.mailbox(ejuser.token) for ejuser in users]
+    for ejuser in users:  # первая проверка сохраняет отметки и в замер не входит
+        poll(ejuser)
+    fake.reset_counters()
+    arrived = notified = 0
+    for _ in range(cycles):
+        for box, ejuser in zip(boxes, users):
+            if rnd.random() < new_per_cycle:
+                box.add_incoming()
+                arrived += 1
+            notified += len(poll(ejuser))
+    return {'requests': fake.total_requests, 'bytes': sum(fake.bytes_sent.values()), 'arrived': arrived,
+            'notified': notified}
+
+
+def run(args) -> Dict[str, Dict[str, float]]:
+    fake = FakeEljur(inbox_size=args.inbox, sent_size=args.sent)
+    setup_environment(fake.start())
+
+    from constants import MessageFolder, MESSAGES_CHECK_DELAY
+
+    cycles = int(args.hours * 3600 / MESSAGES_CHECK_DELAY)
+    new_per_cycle = args.new_per_hour * MESSAGES_CHECK_DELAY / 3600
+    modes = {
+        'full page': lambda ejuser: ejuser.download_messages_preview(check_new_only=True, limit=100,
+                                                                     folder=MessageFolder.INBOX),
+        'probe': lambda ejuser: ejuser.check_new_messages(limit=100),
+    }
+    chat_ids = seed_users(args.users * len(modes))
+    report = {}
+    for index, (name, poll) in enumerate(modes.items()):
+        users = chat_ids[index * args.users:(index + 1) * args.users]
+        result = simulate(fake, users, poll, cycles, new_per_cycle, args.seed)
+        user_hours = args.users * args.hours
+        report[name] = {'requests': result['requests'] / user_hours, 'kbytes': result['bytes'] / 2 ** 10 / user_hours,
+                        'arrived': result['arrived'], 'notified': result['notified']}
+    fake.stop()
+    return report
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Трафик проверки новых сообщений')
+    parser.add_argument('--users', type=int, default=5)
+    parser.add_argument('--hours', type=float, default=1.0, help='длительность в часах проверок')
+    parser.add_argument('--new-per-hour', type=float, default=2.0, help='новых входящих на пользователя в час')
+    parser.add_argument('--inbox', type=int, default=300)
+    parser.add_argument('--sent', type=int, default=50)
+    parser.add_argument('--seed', type=int, default=1)
+    args = parser.parse_args()
+    report = run(args)
+    for name, item in report.items():
+        print(f"{name}: {item['requests']:.0f} запросов и {item['kbytes']:.0f} KB на пользователя в час, "
+              f"новых сообщений {item['arrived']}, уведомлений {item['notified']}")
+    full, probe = report['full page'], report['probe']
+    print(f"меньше запросов в {full['requests'] / probe['requests']:.1f} раза, "
+          f"байт в {full['kbytes'] / probe['kbytes']:.1f} раза")
@@ -0,0 +1,133 @@
+"""
+Проверка числа обращений к MongoDB в обработчиках (dbstats.max_round_trips) для CI: обработчики вызываются
+через настоящий диспетчер с фейковыми элжуром и Bot API, как в bench.handlers, на ящиках разного размера.
+Лимиты одинаковы для всех размеров, поэтому N+1 запросы (обращение к базе на каждое сообщение страницы или ящика)
+превышают лимит. Учитываются и команды из пулов обработчиков, потоков кэширования и предзагрузки.
+
+Завершается с кодом 1, если хотя бы один обработчик превысил лимит.
+
+Пример: python -m bench.round_trips --sizes 50 2000
+"""
+import argparse
+import json
+import sys
+from typing import Callable, Dict, List, Tuple
+
+from bench.fake_eljur import FakeEljur
+from bench.fake_telegram import FakeTelegram
+from bench.handlers import TOKEN, message_update, callback_update, seed_mailbox
+from bench.scenario import setup_environment, seed_users
+
+# обработчик -> максимум команд MongoDB на одно обновление вместе с фоновой работой, которую оно запускает
+BUDGETS = {
+    'present_messages': 1,
+    'messages_handler': 6,
+    'messages_page_handler': 36,  # с предзагрузкой сообщений показанной и следующей страниц, по 4-5 команд
+    'view_message': 10,  # с предзагрузкой соседнего сообщения цепочки
+    # с загрузкой из элжура и предзагрузкой соседнего сообщения; чтения до промаха кэша повторяются в пуле элжура
+    'view_message (не в кэше)': 16,
+    'star_handler': 9,  # с проверкой, что сообщение в кэше, до изменения избранного
+    'starred_messages': 4,
+}
+
+
+def cases(chat_id: int, cached: str, missing: str) -> List[Tuple[str, Callable[[int], dict]]]:
+    """
+    Проверяемые обновления: (имя лимита, функция update_id -> обновление)
+    :param cached: id прочитанного входящего, полный текст которого уже в базе
+    :param missing: id прочитанного входящего, текст которого еще не загружен
+    """
+    from callbacks import Action, encode
+    from constants import MessageFolder
+
+    def text(value: str) -> Callable[[int], dict]:
+        return lambda update_id: message_update(update_id, chat_id, value)
+
+    def button(action: str, *values) -> Callable[[int], dict]:
+        data = encode(action, *values)
+        return lambda update_id: callback_update(update_id, chat_id, data)
+
+    return [
+        ('messages_handler', text('Сообщения')),
+        ('messages_page_handler', button(Action.PAGE, MessageFolder.INBOX, 0, 1)),
+        ('view_message', button(Action.VIEW, MessageFolder.INBOX, cached)),
+        ('view_message (не в кэше)', button(Action.VIEW, MessageFolder.INBOX, missing)),
+        ('star_handler', button(Action.STAR, MessageFolder.INBOX, cached)),
+        ('starred_messages', button(Action.STARRED, MessageFolder.INBOX)),
+    ]
+
+
+def run(args) -> Tuple[Dict[int, Dict[str, int]], List[str]]:
+    eljur = FakeEljur()
+    setup_environment(eljur.start())
+    telegram = FakeTelegram()
+    telegram.start()
+
+    from telegram import Bot, Update
+    from telegram.ext import Dispatcher, DictPersistence
+
+    import eljurbot
+    from constants import MessageFolder
+    from CTEStorage import cte
+    from dbstats import max_round_trips
+    from executor import cache_pool, eljur_pool
+    from messages import present_messages
+    from prefetch import prefetcher
+
+    chat_ids = seed_users(len(args.sizes))
+    conversations = {'bot_conversation': {json.dumps([chat_id, chat_id]): eljurbot.MAIN_MENU for chat_id in chat_ids}}
+    bot = Bot(TOKEN, base_url=telegram.base_url)
+    dispatcher = Dispatcher(bot, update_queue=None, workers=1, use_context=True,
+                            persistence=DictPersistence(conversations_json=json.dumps(conversations)))
+    eljurbot.add_handlers(dispatcher)
+
+    def process(update: dict) -> None:
+        dispatcher.process_update(Update.de_json(update, bot))
+        cache_pool.wait_idle()
+        eljur_pool.wait_idle()
+        prefetcher.wait_idle()
+
+    def check(name: str, size: int, counts: Dict[str, int], call: Callable[[], None]) -> None:
+        try:
+            with max_round_trips(BUDGETS[name], f'{name} ({size} входящих)') as issued:
+                call()
+        except AssertionError as e:
+            failures.append(str(e))
+        counts[name] = len(issued)
+
+    report = {}
+    failures = []
+    update_id = 0
+    for chat_id, size in zip(chat_ids, args.sizes):
+        seed_mailbox(eljur, chat_id, inbox=size, sent=max(1, size // 10))
+        ejuser = cte.get_cte(chat_id=chat_id)
+        read = [msg.id for msg in ejuser.messages(MessageFolder.INBOX) if not msg.unread]
+        for msg_id in read[:3]:  # часть сообщений страницы уже в кэше
+            ejuser.get_message(msg_id=msg_id, only_cache=True)
+        process(message_update(0, chat_id, 'Сообщения'))  # первое обращение загружает ящик в память
+        counts = {}
+        page = ejuser.get_messages(page=1, folder=MessageFolder.INBOX)
+        check('present_messages', size, counts,
+              lambda: present_messages(chat_id=chat_id, msgs=page, folder=MessageFolder.INBOX))
+        for name, make_update in cases(chat_id, cached=read[0], missing=read[-1]):
+            update_id += 1
+            check(name, size, counts, lambda: process(make_update(update_id)))
+        report[size] = counts
+    telegram.stop()
+    eljur.stop()
+    return report, failures
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Проверка числа обращений к MongoDB в обработчиках')
+    parser.add_argument('--sizes', type=int, nargs='+', default=[50, 2000], help='входящих в ящике')
+    args = parser.parse_args()
+    report, failures = run(args)
+    for size, counts in report.items():
+        print(f'Ящик {size} входящих:')
+        for name, issued in counts.items():
+            print(f'  {name:<28} {issued:>3} / {BUDGETS[name]}')
+    for failure in failures:
+        print(failure)
+    if failures:
+        sys.exit(1)
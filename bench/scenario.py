@@ -0,0 +1,272 @@
+"""
+Нагрузочный сценарий: N пользователей опрашивают фейковый элжур и листают сообщения.
+
+Работает без сети и без MongoDB: элжур подменяется bench.fake_eljur, база - хранилищем в памяти (mongomock).
+Чтобы прогнать сценарий на настоящей базе, задайте mongo_uri и database.
+
+Пример: python -m bench.scenario --users 50 --duration 60 --latency 0.1
+"""
+import argparse
+import os
+import random
+import tempfile
+import time
+from collections import defaultdict
+from concurrent.futures.thread import ThreadPoolExecutor
+from json import dumps
+from threading import Lock, Event, Thread
+from typing import Dict, List, Callable
+
+from bench.fake_eljur import FakeEljur, fake_user
+
+
+def percentile(values: List[float], q: float) -> float:
+    if not values:
+        return 0.0
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, int(round(q / 100 * (len(ordered) - 1))))]
+
+
+class OpCounter:
+    """
+    Считает обращения к коллекциям MongoDB (по имени коллекции и методу)
+    """
+
+    def __init__(self):
+        self.ops = defaultdict(int)
+        self.lock = Lock()
+
+    def hit(self, key: str) -> None:
+        with self.lock:
+            self.ops[key] += 1
+
+    @property
+    def total(self) -> int:
+        return sum(self.ops.values())
+
+    def reset(self) -> None:
+        with self.lock:
+            self.ops.clear()
+
+
+class CountingCollection:
+    """
+    Обертка над коллекцией, учитывающая каждый вызов метода как обращение к базе
+    """
+
+    def __init__(self, collection, counter: OpCounter):
+        self._collection = collection
+        self._counter = counter
+
+    def __getattr__(self, item):
+        attr = getattr(self._collection, item)
+        if not callable(attr):
+            return attr
+        name = f'{self._collection.name}.{item}'
+
+        def counted(*args, **kwargs):
+            self._counter.hit(name)
+            return attr(*args, **kwargs)
+
+        return counted
+
+
+class LatencyLog:
+    def __init__(self):
+        self.samples: Dict[str, List[float]] = defaultdict(list)
+        self.errors: Dict[str, int] = defaultdict(int)
+        self.lock = Lock()
+
+    def measure(self, name: str, func: Callable, *args, **kwargs):
+        begin = time.perf_counter()
+        try:
+            return func(*args, **kwargs)
+        except Exception:
+            with self.lock:
+                self.errors[name] += 1
+        finally:
+            with self.lock:
+                self.samples[name].append((time.perf_counter() - begin) * 1000)
+
+
+def setup_environment(api: str) -> OpCounter:
+    """
+    Настраивает переменные окружения и подменяет коллекции считающими обертками.
+    Должна вызываться до импорта модулей бота
+    """
+    os.environ.setdefault('mongo_uri', 'mongomock://')
+    os.environ.setdefault('database', 'eljur_bench')
+    os.environ['eljur_api'] = api
+    os.environ.setdefault('attachments_dir', tempfile.mkdtemp(prefix='eljur_bench_'))
+    import database
+    counter = OpCounter()
+    for name in ('data', 'messages', 'cache_queue', 'homework'):
+        setattr(database, name, CountingCollection(getattr(database, name), counter))
+    return counter
+
+
+def seed_users(users: int) -> List[int]:
+    from database import data
+    chat_ids = []
+    for uid in range(1, users + 1):
+        chat_id = 10 ** 6 + uid
+        data.delete_one({'chat_id': chat_id})
+        data.insert_one({'chat_id': chat_id, 'auth_token': f'token-{uid}', 'vendor': 'bench',
+                         'login': f'user-{uid}', **fake_user(uid)})
+        chat_ids.append(chat_id)
+    return chat_ids
+
+
+def run(args) -> Dict[str, object]:
+    fake = FakeEljur(latency=args.latency, jitter=args.jitter, inbox_size=args.inbox, sent_size=args.sent,
+                     new_message_every=args.new_every)
+    counter = setup_environment(fake.start())
+
+    from CTEStorage import cte
+    from constants import MessageFolder
+    from messages import present_messages
+
+    chat_ids = seed_users(args.users)
+    latency = LatencyLog()
+
+    begin = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=args.workers) as pool:
+        list(pool.map(lambda chat_id: cte.get_cte(chat_id=chat_id), chat_ids))
+    initial_sync = time.perf_counter() - begin
+    initial_requests = fake.total_requests
+    fake.reset_counters()
+    counter.reset()
+
+    def poll(chat_id: int):
+        ejuser = cte.get_cte(chat_id=chat_id)
+        ejuser.check_new_messages(limit=100)
+
+    def browse_messages(ejuser, page: int = 1):
+        msgs = ejuser.get_messages(page=page)
+        present_messages(chat_id=ejuser.chat_id, msgs=msgs, folder=MessageFolder.INBOX)
+        ejuser.unread_count()
+        ejuser.starred_messages(MessageFolder.INBOX)
+        ejuser.starred_messages(MessageFolder.SENT)
+        return msgs
+
+    def view(ejuser):
+        msgs = ejuser.get_messages(page=random.randint(1, 3))
+        if not msgs['messages']:
+            return
+        msg_id = random.choice(msgs['messages']).id
+        ejuser.is_starred(msg_id=msg_id, folder=MessageFolder.INBOX)
+        ejuser.get_message(msg_id=msg_id, force_folder=MessageFolder.INBOX)
+        ejuser.mark_as_read(msg_id=msg_id, folder=MessageFolder.INBOX)
+        ejuser.messages_chain(msg_id=msg_id, folder=MessageFolder.INBOX)
+
+    actions = {
+        'messages_handler': lambda ejuser: browse_messages(ejuser),
+        'messages_page_handler': lambda ejuser: browse_messages(ejuser, page=random.randint(2, 5)),
+        'view_message': view,
+        'homework': lambda ejuser: ejuser.homework,
+        'marks_handler': lambda ejuser: (ejuser.marks(last_period=True), ejuser.periods(show_disabled=False)),
+    }
+    weights = [4, 3, 4, 1, 1]
+
+    stop = Event()
+    poll_cycles = []
+
+    def poller():
+        with ThreadPoolExecutor(max_workers=args.workers) as pool:
+            while not stop.is_set():
+                cycle_begin = time.perf_counter()
+                list(pool.map(lambda chat_id: latency.measure('check_for_new_messages', poll, chat_id), chat_ids))
+                poll_cycles.append(time.perf_counter() - cycle_begin)
+                stop.wait(max(0.0, args.poll_interval - (time.perf_counter() - cycle_begin)))
+
+    def cacher():
+        while not stop.is_set():
+            for chat_id in chat_ids:
+                cte.get_cte(chat_id=chat_id).cache_full_messages()
+            stop.wait(args.cache_interval)
+
+    def browser(chat_id: int):
+        rnd = random.Random(chat_id)
+        ejuser = cte.get_cte(chat_id=chat_id)
+        while not stop.is_set():
+            name = rnd.choices(list(actions), weights=weights)[0]
+            latency.measure(name, actions[name], ejuser)
+            stop.wait(rnd.expovariate(1 / args.think_time))
+
+    threads = [Thread(target=poller, daemon=True), Thread(target=cacher, daemon=True)]
+    browsing = chat_ids[:max(1, int(len(chat_ids) * args.active))]
+    threads.extend(Thread(target=browser, args=[chat_id], daemon=True) for chat_id in browsing)
+    begin = time.perf_counter()
+    for thread in threads:
+        thread.start()
+    time.sleep(args.duration)
+    stop.set()
+    elapsed = time.perf_counter() - begin
+    eljur_requests, eljur_bytes = dict(fake.requests), sum(fake.bytes_sent.values())
+    db_ops = dict(sorted(counter.ops.items(), key=lambda kv: -kv[1]))
+    for thread in threads:
+        thread.join(timeout=args.poll_interval)
+    fake.stop()
+
+    minutes = elapsed / 60
+    return {
+        'users': args.users,
+        'duration_s': round(elapsed, 1),
+        'initial_sync_s': round(initial_sync, 2),
+        'initial_sync_eljur_requests': initial_requests,
+        'poll_cycles': len(poll_cycles),
+        'poll_cycle_p50_ms': round(percentile(poll_cycles, 50) * 1000, 1),
+        'poll_cycle_max_ms': round(max(poll_cycles, default=0) * 1000, 1),
+        'eljur_requests_per_user_per_minute': round(sum(eljur_requests.values()) / args.users / minutes, 2),
+        'eljur_requests_by_endpoint': eljur_requests,
+        'eljur_bytes_per_user_per_minute': round(eljur_bytes / args.users / minutes),
+        'db_ops': sum(db_ops.values()),
+        'db_ops_per_minute': round(sum(db_ops.values()) / minutes),
+        'db_ops_by_method': db_ops,
+        'handlers': {name: {'count': len(values),
+                            'errors': latency.errors.get(name, 0),
+                            'p50_ms': round(percentile(values, 50), 2),
+                            'p99_ms': round(percentile(values, 99), 2)}
+                     for name, values in sorted(latency.samples.items())},
+    }
+
+
+def print_report(report: Dict[str, object]) -> None:
+    print(f"Пользователей: {report['users']}, длительность: {report['duration_s']} с")
+    print(f"Первичная синхронизация: {report['initial_sync_s']} с, "
+          f"{report['initial_sync_eljur_requests']} запросов к элжуру")
+    print(f"Цикл опроса: p50 {report['poll_cycle_p50_ms']} ms, max {report['poll_cycle_max_ms']} ms "
+          f"({report['poll_cycles']} циклов)")
+    print(f"Запросов к элжуру на пользователя в минуту: {report['eljur_requests_per_user_per_minute']}")
+    for endpoint, count in sorted(report['eljur_requests_by_endpoint'].items()):
+        print(f'    {endpoint}: {count}')
+    print(f"Операций с базой: {report['db_ops']} ({report['db_ops_per_minute']} в минуту)")
+    for name, count in list(report['db_ops_by_method'].items())[:10]:
+        print(f'    {name}: {count}')
+    print('Задержка обработчиков:')
+    for name, stats in report['handlers'].items():
+        print(f"    {name}: p50 {stats['p50_ms']} ms, p99 {stats['p99_ms']} ms "
+              f"({stats['count']} вызовов, {stats['errors']} ошибок)")
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Нагрузочный сценарий бота на фейковом элжуре')
+    parser.add_argument('--users', type=int, default=20)
+    parser.add_argument('--duration', type=float, default=30.0, help='длительность сценария, секунды')
+    parser.add_argument('--active', type=float, default=0.3, help='доля пользователей, листающих сообщения')
+    parser.add_argument('--think-time', type=float, default=2.0, help='средняя пауза между действиями, секунды')
+    parser.add_argument('--poll-interval', type=float, default=5.0, help='период опроса новых сообщений, секунды')
+    parser.add_argument('--cache-interval', type=float, default=10.0, help='период кэширования сообщений, секунды')
+    parser.add_argument('--workers', type=int, default=4, help='потоков для опроса (как у диспетчера)')
+    parser.add_argument('--latency', type=float, default=0.05, help='задержка элжура, секунды')
+    parser.add_argument('--jitter', type=float, default=0.02)
+    parser.add_argument('--inbox', type=int, default=300)
+    parser.add_argument('--sent', type=int, default=50)
+    parser.add_argument('--new-every', type=float, default=20.0, help='период появления новых сообщений, секунды')
+    parser.add_argument('--json', action='store_true', help='вывести отчет в JSON')
+    args = parser.parse_args()
+    report = run(args)
+    if args.json:
+        print(dumps(report, ensure_ascii=False, indent=2))
+    else:
+        print_report(report)
@@ -0,0 +1,55 @@
+"""
+Сравнение размера документов сообщений в схеме v1 и компактной схеме v2 на правдоподобных данных фейкового элжура.
+Оцениваются BSON-размер документов и размер ключей уникального индекса (hash в v1, (c, f, i) в v2).
+
+Пример: python -m bench.schema_size --messages 10000 --cached 0.7
+"""
+import argparse
+import random
+
+import bson
+
+from bench.fake_eljur import Mailbox
+from storage import pack
+from utility import hash_string
+
+
+def build_documents(count: int, cached: float):
+    box = Mailbox(owner=1, inbox_size=count, sent_size=0, unread=3, base_url='http://127.0.0.1/api')
+    rnd = random.Random(1)
+    for number in range(count, 0, -1):
+        msg = box.preview('inbox', number)
+        document = {'chat_id': 123456789, 'folder': 'inbox',
+                    'hash': hash_string(f"123456789_inbox_{msg['id']}"), **msg}
+        if rnd.random() < cached:
+            full = box.full(msg['id'])
+            full.pop('unread', None)
+            document.update(full)
+        yield document
+
+
+def run(args):
+    totals = {'v1': 0, 'v2': 0, 'v1_key': 0, 'v2_key': 0, 'v1_text': 0, 'v2_text': 0}
+    for document in build_documents(args.messages, args.cached):
+        packed = pack(document)
+        totals['v1'] += len(bson.encode(document))
+        totals['v2'] += len(bson.encode(packed))
+        totals['v1_key'] += len(bson.encode({'hash': document['hash']}))
+        totals['v2_key'] += len(bson.encode({'c': packed['c'], 'f': packed['f'], 'i': packed['i']}))
+        if 'text' in document:
+            totals['v1_text'] += len(bson.encode({'text': document['text']}))
+            totals['v2_text'] += len(bson.encode({k: v for k, v in packed.items() if k in ('t', 'tz')}))
+    return totals
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Размер документов в схемах v1 и v2')
+    parser.add_argument('--messages', type=int, default=10000)
+    parser.add_argument('--cached', type=float, default=0.7, help='доля сообщений с загруженным текстом')
+    args = parser.parse_args()
+    totals = run(args)
+    for title, v1, v2 in (('Документы', 'v1', 'v2'), ('Ключи уникального индекса', 'v1_key', 'v2_key'),
+                          ('Тексты сообщений', 'v1_text', 'v2_text')):
+        saved = 1 - totals[v2] / totals[v1] if totals[v1] else 0
+        print(f'{title}: v1 {totals[v1] / 2 ** 20:.2f} MB, v2 {totals[v2] / 2 ** 20:.2f} MB ({saved:.0%} экономии)')
+    print(f"В среднем на сообщение: v1 {totals['v1'] // args.messages} B, v2 {totals['v2'] // args.messages} B")
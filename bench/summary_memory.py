@@ -0,0 +1,63 @@
+"""
+Память, занимаемая кэшем списка сообщений одного пользователя (msg_cache): документы MongoDB целиком
+против кратких представлений MessageSummary. Документы строятся как в базе: превью фейкового элжура,
+часть сообщений с загруженным текстом, после pack/unpack схемы v2.
+
+Пример: python -m bench.summary_memory --messages 1000 10000 --cached 0.7
+"""
+import argparse
+import gc
+import random
+import tracemalloc
+from typing import Callable, List
+
+from bson import ObjectId
+
+from bench.schema_size import build_documents
+from storage import pack, unpack
+from summary import MessageSummary
+
+
+def load_documents(count: int, cached: float) -> List[dict]:
+    documents = []
+    for document in build_documents(count, cached):
+        document.pop('hash', None)
+        stored = unpack({'_id': ObjectId(), **pack(document)})
+        documents.append(stored)
+    return documents
+
+
+def measure(build: Callable[[], list]) -> int:
+    """
+    :return: байты, выделенные при построении и оставшиеся занятыми
+    """
+    gc.collect()
+    tracemalloc.start()
+    result = build()
+    size = tracemalloc.get_traced_memory()[0]
+    tracemalloc.stop()
+    del result
+    return size
+
+
+def run(args):
+    random.seed(1)
+    report = []
+    for count in args.messages:
+        documents = load_documents(count, args.cached)
+        packed = [pack(document) for document in documents]  # документы строятся заново внутри замера, как из базы
+        before = measure(lambda: [unpack(document) for document in packed])
+        after = measure(lambda: [MessageSummary.from_document(unpack(document)) for document in packed])
+        report.append((count, before, after))
+    return report
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Память кэша списка сообщений: документы против MessageSummary')
+    parser.add_argument('--messages', type=int, nargs='+', default=[1000, 10000])
+    parser.add_argument('--cached', type=float, default=0.7, help='доля сообщений с загруженным текстом')
+    args = parser.parse_args()
+    for count, before, after in run(args):
+        print(f'{count} сообщений: документы {before / 2 ** 20:.2f} MB ({before // count} B на сообщение), '
+              f'MessageSummary {after / 2 ** 20:.2f} MB ({after // count} B на сообщение), '
+              f'в {before / after:.1f} раза меньше')
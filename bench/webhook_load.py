@@ -0,0 +1,98 @@
+"""
+Нагрузочный тест приема обновлений через webhook: несколько клиентов отправляют синтетические обновления
+на локальный WebhookServer, диспетчер обрабатывает их простым обработчиком.
+Отчет: принятые и отклоненные (503) обновления, обновлений в секунду на приеме и на обработке.
+
+Пример: python -m bench.webhook_load --clients 16 --updates 20000
+"""
+import argparse
+import time
+from http.client import HTTPConnection
+from json import dumps
+from threading import Thread, Lock
+from typing import Dict
+
+from telegram import Bot
+from telegram.ext import Dispatcher, CallbackQueryHandler, MessageHandler, Filters
+
+from webhook import WebhookServer, SECRET_HEADER
+
+SECRET = 'bench-secret'
+
+
+def synthetic_update(update_id: int) -> bytes:
+    chat = {'id': 10 ** 6 + update_id % 1000, 'type': 'private', 'first_name': 'Bench'}
+    user = {'id': chat['id'], 'is_bot': False, 'first_name': 'Bench'}
+    if update_id % 2:
+        update = {'update_id': update_id,
+                  'callback_query': {'id': str(update_id), 'from': user, 'chat_instance': '1',
+                                     'data': f'page_inbox_{update_id % 5 + 1}',
+                                     'message': {'message_id': 1, 'date': 0, 'chat': chat, 'text': 'Входящие'}}}
+    else:
+        update = {'update_id': update_id,
+                  'message': {'message_id': update_id, 'date': 0, 'chat': chat, 'from': user, 'text': 'Сообщения'}}
+    return dumps(update, ensure_ascii=False).encode('utf-8')
+
+
+def run(args) -> Dict[str, float]:
+    bot = Bot('123456:bench')
+    dispatcher = Dispatcher(bot, update_queue=None, workers=1, use_context=True)
+    processed = [0]
+    lock = Lock()
+
+    def handle(update, context):
+        with lock:
+            processed[0] += 1
+        if args.handler_ms:
+            time.sleep(args.handler_ms / 1000)
+
+    dispatcher.add_handler(CallbackQueryHandler(handle))
+    dispatcher.add_handler(MessageHandler(Filters.text, handle))
+    server = WebhookServer(dispatcher, secret=SECRET, port=0, queue_size=args.queue)
+    server.start()
+
+    statuses = {}
+    per_client = args.updates // args.clients
+
+    def client(number: int):
+        connection = HTTPConnection('127.0.0.1', server.port)
+        local = {}
+        for i in range(per_client):
+            connection.request('POST', '/telegram', body=synthetic_update(number * per_client + i),
+                               headers={'Content-Type': 'application/json', SECRET_HEADER: SECRET})
+            response = connection.getresponse()
+            response.read()
+            local[response.status] = local.get(response.status, 0) + 1
+        connection.close()
+        with lock:
+            for status, count in local.items():
+                statuses[status] = statuses.get(status, 0) + count
+
+    begin = time.perf_counter()
+    clients = [Thread(target=client, args=[n]) for n in range(args.clients)]
+    for thread in clients:
+        thread.start()
+    for thread in clients:
+        thread.join()
+    ingest = time.perf_counter() - begin
+    server.stop()
+    total = time.perf_counter() - begin
+    return {
+        'sent': per_client * args.clients,
+        'accepted': statuses.get(200, 0),
+        'rejected_503': statuses.get(503, 0),
+        'processed': processed[0],
+        'ingest_updates_per_s': round(per_client * args.clients / ingest),
+        'processed_updates_per_s': round(processed[0] / total),
+    }
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Нагрузочный тест webhook')
+    parser.add_argument('--clients', type=int, default=8, help='параллельных соединений (max_connections)')
+    parser.add_argument('--updates', type=int, default=5000)
+    parser.add_argument('--queue', type=int, default=256, help='размер очереди перед диспетчером')
+    parser.add_argument('--handler-ms', type=float, default=0.0, help='время работы обработчика, ms')
+    report = run(parser.parse_args())
+    for key, value in report.items():
+        print(f'{key}: {value}')
@@ -0,0 +1,263 @@
+"""
+Данные inline-кнопок (callback_data) и маршрутизация нажатий.
+
+Формат версии 1: '1' + код действия (один символ) + поля через точку. Числа и числовые id сообщений записываются
+в base36, папки и перечисления - одной буквой: открыть входящее 12345678 из избранного со страницы 2 -
+'1mi.7clzi.s.2'. Маршрутизатор выбирает обработчик по коду действия (словарь, без перебора регулярных выражений)
+и передает ему разобранные поля третьим аргументом - NamedTuple действия.
+
+Кнопки старого формата (message_inbox_12345678, page_sent_next, ...) остаются на уже отправленных сообщениях:
+они разбираются по первому слову в те же аргументы.
+"""
+import logging
+from typing import Any, Callable, Dict, NamedTuple, Optional, Tuple
+
+from telegram import TelegramError, Update
+from telegram.ext import CallbackContext
+
+from constants import MessageFolder
+from metrics import registry
+
+logger = logging.getLogger('BOT')
+
+VERSION = '1'
+SEPARATOR = '.'
+MAX_LENGTH = 64  # ограничение Telegram на callback_data, байты
+UNREAD = 'unread'  # папка "непрочитанные входящие" на кнопках списка
+EXPIRED_TEXT = 'Кнопка устарела, откройте раздел заново'
+
+callback_queries_total = registry.counter('callback_queries_total', 'Нажатия inline-кнопок по действию и формату',
+                                          ('action', 'format'))
+
+
+class Action:
+    PAGE = 'p'  # страница списка сообщений
+    VIEW = 'm'  # открыть сообщение
+    REPLY = 'r'  # ответить на сообщение
+    UPDATE = 'u'  # обновить список сообщений из элжура
+    RECIPIENTS = 'c'  # полный список получателей
+    CLOSE = 'x'  # удалить сообщение бота
+    FILE = 'f'  # отправить вложение
+    STAR = 's'  # добавить в избранное или убрать из него
+    STARRED = 't'  # страница избранного
+    SEARCH = 'q'  # страница результатов поиска
+    HOMEWORK = 'h'  # домашнее задание на день
+
+
+class Origin:
+    """
+    Откуда открыто сообщение (куда ведет кнопка "Назад")
+    """
+    LIST = 'list'
+    NEW = 'new'  # уведомление о новом сообщении
+    STARRED = 'starred'
+    SEARCH = 'search'
+
+
+class NoArgs(NamedTuple):
+    pass
+
+
+class PageArgs(NamedTuple):
+    folder: str  # inbox, sent или unread
+    page: int = 0  # номер страницы, 0 - текущая страница со сдвигом step
+    step: int = 0  # -1 - предыдущая, 1 - следующая
+
+
+class MessageArgs(NamedTuple):
+    folder: str
+    msg_id: str
+    origin: str = Origin.LIST
+    origin_page: int = 0  # страница избранного или поиска, с которой открыто сообщение
+
+
+class ReplyArgs(NamedTuple):
+    folder: str
+    msg_id: str
+    reply_all: bool = False
+
+
+class FolderArgs(NamedTuple):
+    folder: str
+
+
+class RecipientsArgs(NamedTuple):
+    folder: str
+    msg_id: str
+    step: int = 0
+
+
+class FileArgs(NamedTuple):
+    key: str
+
+
+class StarredArgs(NamedTuple):
+    folder: str
+    page: int = 1
+
+
+class SearchArgs(NamedTuple):
+    page: int
+
+
+class HomeworkArgs(NamedTuple):
+    date: str
+
+
+class Codec(NamedTuple):
+    encode: Callable[[Any], str]
+    decode: Callable[[str], Any]
+
+
+def _choice(values: Dict[Any, str]) -> Codec:
+    reverse = {code: value for value, code in values.items()}
+    return Codec(values.__getitem__, reverse.__getitem__)
+
+
+def _base36(number: int) -> str:
+    if number < 0:
+        raise ValueError(f'Отрицательное число в callback_data: {number}')
+    digits = ''
+    while True:
+        number, digit = divmod(number, 36)
+        digits = '0123456789abcdefghijklmnopqrstuvwxyz'[digit] + digits
+        if not number:
+            return digits
+
+
+def _encode_id(msg_id: str) -> str:
+    if msg_id.isdigit() and not msg_id.startswith('0'):
+        return _base36(int(msg_id))
+    return f'~{msg_id}'  # нечисловой id хранится как есть
+
+
+def _decode_id(value: str) -> str:
+    return value[1:] if value.startswith('~') else str(int(value, 36))
+
+
+INT = Codec(_base36, lambda value: int(value, 36))
+ID = Codec(_encode_id, _decode_id)
+TEXT = Codec(str, str)  # только последним полем: может содержать разделитель
+FLAG = Codec(lambda value: '1' if value else '0', lambda value: value == '1')
+STEP = _choice({-1: 'p', 0: 'c', 1: 'n'})
+FOLDER = _choice({MessageFolder.INBOX: 'i', MessageFolder.SENT: 's', UNREAD: 'u'})
+ORIGIN = _choice({Origin.LIST: 'l', Origin.NEW: 'n', Origin.STARRED: 's', Origin.SEARCH: 'q'})
+
+SCHEMA: Dict[str, Tuple[type, Tuple[Codec, ...]]] = {
+    Action.PAGE: (PageArgs, (FOLDER, INT, STEP)),
+    Action.VIEW: (MessageArgs, (FOLDER, ID, ORIGIN, INT)),
+    Action.REPLY: (ReplyArgs, (FOLDER, ID, FLAG)),
+    Action.UPDATE: (FolderArgs, (FOLDER,)),
+    Action.RECIPIENTS: (RecipientsArgs, (FOLDER, ID, STEP)),
+    Action.CLOSE: (NoArgs, ()),
+    Action.FILE: (FileArgs, (TEXT,)),
+    Action.STAR: (MessageArgs, (FOLDER, ID, ORIGIN, INT)),
+    Action.STARRED: (StarredArgs, (FOLDER, INT)),
+    Action.SEARCH: (SearchArgs, (INT,)),
+    Action.HOMEWORK: (HomeworkArgs, (TEXT,)),
+}
+# код действия -> (конструктор аргументов, разборщики полей, число разделителей) для decode
+DECODERS = {action: (args_type._make, tuple(codec.decode for codec in codecs), len(codecs) - 1)
+            for action, (args_type, codecs) in SCHEMA.items()}
+
+
+def encode(action: str, *values: Any) -> str:
+    """
+    :param action: код действия из Action
+    :param values: поля аргументов действия по порядку, пропущенные берутся по умолчанию
+    :return: callback_data для кнопки
+    """
+    args_type, codecs = SCHEMA[action]
+    args = args_type(*values)
+    data = VERSION + action + SEPARATOR.join(codec.encode(value) for codec, value in zip(codecs, args))
+    if len(data.encode('utf-8')) > MAX_LENGTH:
+        raise ValueError(f'callback_data длиннее {MAX_LENGTH} байт: {data}')
+    return data
+
+
+def _move(value: str) -> Tuple[int, int]:
+    """
+    Переход по страницам в старом формате: prev, next, it или номер страницы
+    :return: (страница, сдвиг)
+    """
+    if value == 'prev':
+        return 0, -1
+    if value == 'next':
+        return 0, 1
+    if value.isdigit():
+        return int(value), 0
+    return 0, 0
+
+
+def _legacy_message(parts):
+    if parts[1] == 'view':  # message_view_new_<id> из уведомления
+        return Action.VIEW, (MessageFolder.INBOX, parts[3], Origin.NEW)
+    if len(parts) == 5:  # message_<папка>_<id>_<страница>_(starred|search)
+        return Action.VIEW, (parts[1], parts[2], parts[4], int(parts[3]))
+    return Action.VIEW, (parts[1], parts[2])
+
+
+LEGACY = {
+    'page': lambda parts: (Action.PAGE, (parts[1], *_move(parts[2] if len(parts) > 2 else ''))),
+    'message': _legacy_message,
+    'reply': lambda parts: (Action.REPLY, (parts[-2], parts[-1], parts[1] == 'all')),
+    'update': lambda parts: (Action.UPDATE, (parts[1],)),
+    'recipients': lambda parts: (Action.RECIPIENTS, (parts[1], parts[2], _move(parts[3])[1])),
+    'close': lambda parts: (Action.CLOSE, ()),
+    'file': lambda parts: (Action.FILE, (parts[1],)),
+    'star': lambda parts: (Action.STAR, (parts[1], parts[2])),
+    'unstar': lambda parts: (Action.STAR, (parts[1], parts[2])),
+    'starred': lambda parts: (Action.STARRED, (parts[1], int(parts[2]))),
+    'search': lambda parts: (Action.SEARCH, (int(parts[1]),)),
+    'homework': lambda parts: (Action.HOMEWORK, ('_'.join(parts[1:]),)),
+}
+LEGACY_FOLDERS = {MessageFolder.INBOX, MessageFolder.SENT, UNREAD}
+
+
+def decode(data: str) -> Optional[Tuple[str, NamedTuple, bool]]:
+    """
+    :param data: callback_data нажатой кнопки
+    :return: (код действия, аргументы, старый ли формат) или None, если данные не разбираются
+    """
+    try:
+        if data[:1] == VERSION:
+            action = data[1:2]
+            make, decoders, separators = DECODERS[action]
+            fields = data[2:].split(SEPARATOR, separators) if decoders else ()
+            return action, make([decoder(value) for decoder, value in zip(decoders, fields)]), False
+        parts = data.split('_')
+        action, values = LEGACY[parts[0]](parts)
+        args = SCHEMA[action][0](*values)
+        if getattr(args, 'folder', MessageFolder.INBOX) not in LEGACY_FOLDERS:
+            return None
+        return action, args, True
+    except (KeyError, IndexError, ValueError, TypeError):
+        return None
+
+
+class CallbackRouter:
+    """
+    Один обработчик CallbackQuery на все кнопки: выбирает обработчик действия по коду за O(1).
+    Обработчики действий вызываются как handler(update, context, args)
+    """
+
+    def __init__(self):
+        self._routes: Dict[str, Callable] = dict()
+
+    def add(self, action: str, handler: Callable) -> None:
+        self._routes[action] = handler
+
+    def dispatch(self, update: Update, context: CallbackContext) -> Any:
+        query = update.callback_query
+        decoded = decode(query.data or '')
+        if decoded is None or decoded[0] not in self._routes:
+            callback_queries_total.inc(action='unknown', format='unknown')
+            logger.warning('Не удалось разобрать callback_data %r', query.data)
+            try:
+                query.answer(text=EXPIRED_TEXT)
+            except TelegramError as e:
+                logger.warning('Не удалось ответить на нажатие кнопки: %s', e)
+            return None
+        action, args, legacy = decoded
+        callback_queries_total.inc(action=action, format='legacy' if legacy else VERSION)
+        return self._routes[action](update, context, args)
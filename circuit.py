@@ -0,0 +1,113 @@
+"""
+Общее состояние доступности элжура.
+
+Для каждой школы (vendor) и для сервера API (api.eljur.ru) ведется свой автомат: после CIRCUIT_FAILURE_THRESHOLD
+ошибок подряд он размыкается, и запросы к элжуру сразу завершаются EljurUnavailable без обращения к сети.
+Через паузу пропускается один пробный запрос: успех замыкает автомат, ошибка снова размыкает его с вдвое большей
+паузой (но не больше CIRCUIT_MAX_BACKOFF). Недоступность сервера API отключает все школы,
+ошибки одной школы (5xx, таймауты) - только её.
+"""
+import logging
+import random
+import time
+from threading import Lock
+from typing import Dict, Tuple
+from urllib.parse import urlparse
+
+from requests.exceptions import ConnectionError
+
+from constants import CIRCUIT_FAILURE_THRESHOLD, CIRCUIT_BASE_BACKOFF, CIRCUIT_MAX_BACKOFF, ELJUR_REQUEST_TIMEOUT
+from metrics import registry
+
+logger = logging.getLogger('eljur')
+
+
+class EljurUnavailable(ConnectionError):
+    """
+    Элжур недоступен, запрос не отправлялся
+    """
+    pass
+
+
+class Circuit:
+    CLOSED, HALF_OPEN, OPEN = 0, 1, 2
+
+    def __init__(self, name: str):
+        self.name = name
+        self.state = Circuit.CLOSED
+        self.failures = 0  # ошибок подряд
+        self.backoff = CIRCUIT_BASE_BACKOFF
+        self.retry_at = 0.0  # время следующего пробного запроса
+        self._lock = Lock()
+
+    @property
+    def is_open(self) -> bool:
+        """
+        :return: разомкнут ли автомат (без учета того, что пора делать пробный запрос)
+        """
+        return self.state != Circuit.CLOSED and time.monotonic() < self.retry_at
+
+    def allow(self) -> bool:
+        """
+        Решает, можно ли отправить запрос. В разомкнутом состоянии по истечении паузы пропускает один пробный запрос
+        """
+        with self._lock:
+            if self.state == Circuit.CLOSED:
+                return True
+            now = time.monotonic()
+            if now < self.retry_at:
+                return False
+            self.state = Circuit.HALF_OPEN
+            self.retry_at = now + ELJUR_REQUEST_TIMEOUT  # следующая проба, если эта так и не завершится
+            return True
+
+    def success(self) -> None:
+        with self._lock:
+            if self.state != Circuit.CLOSED:
+                logger.info('Элжур (%s) снова доступен', self.name)
+            self.state = Circuit.CLOSED
+            self.failures = 0
+            self.backoff = CIRCUIT_BASE_BACKOFF
+
+    def failure(self) -> None:
+        with self._lock:
+            self.failures += 1
+            if self.state == Circuit.HALF_OPEN:
+                self.backoff = min(self.backoff * 2, CIRCUIT_MAX_BACKOFF)
+            elif self.state == Circuit.OPEN or self.failures < CIRCUIT_FAILURE_THRESHOLD:
+                return
+            self.state = Circuit.OPEN
+            # разброс, чтобы пробы разных школ не совпадали
+            self.retry_at = time.monotonic() + self.backoff * random.uniform(0.9, 1.1)
+            logger.warning('Элжур (%s) недоступен после %s ошибок подряд, следующая попытка через %d с', self.name,
+                           self.failures, self.backoff)
+
+
+class CircuitBreakers:
+    def __init__(self):
+        self._circuits: Dict[str, Circuit] = dict()
+        self._lock = Lock()
+        registry.gauge('eljur_circuit_state', 'Состояние автоматов элжура: 0 - доступен, 1 - проба, 2 - недоступен',
+                       ('circuit',), function=lambda: {(name,): circuit.state
+                                                       for name, circuit in list(self._circuits.items())})
+
+    def get(self, name: str) -> Circuit:
+        with self._lock:
+            if name not in self._circuits:
+                self._circuits[name] = Circuit(name)
+            return self._circuits[name]
+
+    def for_request(self, api: str, vendor: str) -> Tuple[Circuit, Circuit]:
+        """
+        :return: автоматы сервера API и школы
+        """
+        return self.get(urlparse(api).netloc), self.get(f'vendor:{vendor}')
+
+    def available(self, api: str, vendor: str) -> bool:
+        """
+        :return: можно ли сейчас обращаться к элжуру школы vendor
+        """
+        return not any(circuit.is_open for circuit in self.for_request(api, vendor))
+
+
+breakers = CircuitBreakers()
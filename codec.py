@@ -0,0 +1,93 @@
+"""
+Разбор JSON ответов элжура.
+
+loads принимает байты ответа без декодирования в str и использует orjson, если он установлен, иначе json.
+iter_items разбирает ответ потоково (нужен пакет ijson) и отдает элементы массива по одному, не строя весь ответ
+в памяти; без ijson ответ разбирается целиком через loads.
+"""
+import json
+from typing import Any, Union, Iterator, Tuple, Dict, BinaryIO
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+try:
+    import ijson
+except ImportError:
+    ijson = None
+
+JSON_BACKEND = 'orjson' if orjson else 'json'
+STREAM_BACKEND = f'ijson/{ijson.backend}' if ijson else None
+
+
+def loads(data: Union[bytes, str]) -> Any:
+    if orjson:
+        return orjson.loads(data)
+    return json.loads(data)
+
+
+def dumps(value: Any) -> str:
+    """
+    :return: JSON без экранирования не-ASCII символов
+    """
+    if orjson:
+        return orjson.dumps(value).decode('utf-8')
+    return json.dumps(value, ensure_ascii=False)
+
+
+def _walk(value: Any, path: str) -> Any:
+    for key in path.split('.'):
+        if not isinstance(value, dict) or key not in value:
+            return None
+        value = value[key]
+    return value
+
+
+def iter_items(stream: BinaryIO, array: str, fields: Tuple[str, ...] = ()) -> Tuple[Dict[str, Any], Iterator[Any]]:
+    """
+    Потоковый разбор ответа: значения полей fields и элементы массива array по одному
+    :param stream: поток байтов ответа (response.raw)
+    :param array: путь к массиву через точку, например response.result.messages
+    :param fields: пути к скалярным полям через точку (например response.result.total)
+    :return: (значения полей fields по последнему компоненту пути, итератор элементов массива). Словарь значений
+    заполняется по ходу разбора: поле, которое в ответе идет после массива, появится в нем только после полного
+    прохода по итератору
+    """
+    if not ijson:
+        document = loads(stream.read())
+        items = _walk(document, array) or []
+        return {field.rsplit('.', 1)[-1]: _walk(document, field) for field in fields}, iter(items)
+    events = ijson.parse(stream, use_float=True)
+    values = dict()
+    item_prefix = f'{array}.item'
+    for prefix, event, value in events:
+        if prefix in fields:
+            values[prefix.rsplit('.', 1)[-1]] = value
+        elif prefix == array and event == 'start_array':
+            break
+    else:
+        return values, iter(())
+
+    def items() -> Iterator[Any]:
+        builder = None
+        for prefix, event, value in events:
+            if builder is None:
+                if prefix == array and event == 'end_array':
+                    break
+                if prefix == item_prefix and event in ('start_map', 'start_array'):
+                    builder = ijson.ObjectBuilder()
+                    builder.event(event, value)
+                elif prefix == item_prefix:
+                    yield value
+                continue
+            builder.event(event, value)
+            if prefix == item_prefix and event in ('end_map', 'end_array'):
+                yield builder.value
+                builder = None
+        for prefix, event, value in events:  # поля после массива
+            if prefix in fields:
+                values[prefix.rsplit('.', 1)[-1]] = value
+
+    return values, items()
@@ -1,10 +1,66 @@
+import os
+
 MAX_CACHE_PAGES = 100
+INGEST_BATCH = 200  # сообщений в одной записи в базу при загрузке страниц
+BACKFILL_THREADS = 4  # одновременных запросов страниц при полной загрузке ящика одного пользователя
 RECIPIENTS_PREVIEW_COUNT = 6
 RECIPIENTS_PER_PAGE = 100
 MESSAGES_CHECK_DELAY = 30
 MESSAGES_CACHE_DELAY = 60
+READ_STATE_SYNC_DELAY = 300
 MESSAGES_CACHE_THREADS = 10
+PREFETCH_THREADS = 4
+CACHE_HANDLER_THREADS = 8  # потоки для обработчиков, работающих только с кэшем
+ELJUR_HANDLER_THREADS = 8  # потоки для обработчиков, обращающихся к элжуру
+ELJUR_HANDLER_QUEUE = 64  # максимум обработчиков элжура в работе и в очереди
+ELJUR_HANDLER_TIMEOUT = 30  # максимальное ожидание обработчика элжура в очереди, секунды
+ELJUR_REQUEST_TIMEOUT = 15  # таймаут HTTP-запроса к элжуру, секунды
 MESSAGES_PER_USER_ML = 100
+MESSAGE_COMPRESS_THRESHOLD = 512  # тексты сообщений длиннее (в символах) хранятся сжатыми
+DB_STATS_LOG_DELAY = 600
+BOT_MODE = os.environ.get('mode', 'polling')  # способ получения обновлений: polling или webhook
+WEBHOOK_HOST = os.environ.get('webhook_host', '127.0.0.1')  # адрес, на котором слушает webhook (за reverse proxy)
+WEBHOOK_PORT = int(os.environ.get('webhook_port', 8443))
+WEBHOOK_QUEUE_SIZE = 256  # обновлений в очереди перед диспетчером, сверх - 503 и повтор со стороны Telegram
+METRICS_PORT = int(os.environ.get('metrics_port', 9105))  # порт HTTP-сервера с метриками Prometheus
+TRACE_SAMPLE_RATE = float(os.environ.get('trace_sample_rate', 0.01))  # доля трасс, записываемых целиком
+TRACE_SLOW_THRESHOLD = float(os.environ.get('trace_slow_ms', 2000)) / 1000  # долгие трассы пишутся всегда, секунды
+TRACE_FILE = os.environ.get('trace_file', os.path.join(os.path.dirname(__file__), 'data', 'traces.jsonl'))
+OTLP_ENDPOINT = os.environ.get('otlp_endpoint')  # коллектор OTLP/HTTP (http://host:4318) вместо файла трасс
+TRACE_MAX_SPANS = 500  # span'ов в одной трассе, остальные отбрасываются (полная загрузка ящика)
+TRACE_QUEUE_SIZE = 1000  # трасс в очереди на запись, сверх - отбрасываются
+LOG_FORMAT = os.environ.get('log_format', 'text')  # формат файла лога: text или json (строка JSON на запись)
+LOG_QUEUE_SIZE = 10000  # записей лога в очереди на запись, сверх - отбрасываются
+LOG_USER_LIMIT = 30  # записей лога об одном пользователе за LOG_USER_WINDOW, сверх - отбрасываются (кроме ошибок)
+LOG_USER_WINDOW = 60  # секунды
+LOG_SAMPLE_RATES = {'poll': 0.01, 'message_cached': 0.01}  # доля записываемых частых событий (extra event)
+ELJUR_API_URL = os.environ.get('eljur_api', 'https://api.eljur.ru/api')  # адрес API, переопределяется для тестов
+ATTACHMENTS_DIR = os.environ.get('attachments_dir',
+                                 os.path.join(os.path.dirname(__file__), 'data', 'attachments'))  # копии вложений
+ATTACHMENT_MAX_SIZE = 20 * 2 ** 20  # вложения больше не скачиваются (лимит Telegram на отправку файлов ботом - 50 MB)
+ATTACHMENT_THREADS = 2  # потоки фонового скачивания вложений
+CIRCUIT_FAILURE_THRESHOLD = 5  # ошибок подряд, после которых элжур считается недоступным
+CIRCUIT_BASE_BACKOFF = 30  # пауза до первой пробы недоступного элжура, секунды
+CIRCUIT_MAX_BACKOFF = 1800  # максимальная пауза между пробами, секунды
+VENDOR_RATE_LIMIT = 5  # запросов страниц полной загрузки к элжуру одной школы в секунду
+VENDOR_RATE_BURST = 10  # запросов к элжуру школы, которые можно сделать сразу, не дожидаясь лимита
+ONBOARDING_FIRST_PAGE = 20  # сообщений первой страницы, загружаемой сразу после входа
+ONBOARDING_PAGE_DELAY = 0.5  # пауза между страницами фоновой первичной загрузки, секунды
+ONBOARDING_PROGRESS_INTERVAL = 3  # минимальный интервал обновления сообщения о ходе загрузки, секунды
+ONBOARDING_RETRY_DELAY = 300  # пауза перед повтором прерванной первичной загрузки, секунды
+ONBOARDING_RETRIES = 5  # попыток первичной загрузки
+SCHOOL_CACHE_ENTRIES = 1000  # записей кэша данных школ в памяти процесса
+SCHOOL_CACHE_MEMORY = 64 * 2 ** 20  # суммарный размер записей кэша данных школ в памяти, байты
+SCHOOL_CACHE_MAX_VALUE = 8 * 2 ** 20  # записи больше не кэшируются (лимит документа MongoDB - 16 MB)
+PERIODS_TTL = 24 * 3600  # время жизни учебных периодов школы в кэше, секунды
+RECEIVERS_TTL = 6 * 3600  # время жизни списка получателей сообщений школы в кэше, секунды
+IDEMPOTENT_ENDPOINTS = {'getmessages', 'getmessageinfo', 'gethomework', 'getschedule', 'getperiods', 'getmarks',
+                        'getrules', 'getmessagereceivers'}  # методы API, одинаковые запросы к которым объединяются
+TOKEN_REJECTED_STATUSES = (401, 403)  # HTTP-статусы, которыми элжур отклоняет токен
+TOKEN_REFRESH_DELAY = 900  # период проверки токенов, которые пора обновить, секунды
+TOKEN_REFRESH_AHEAD = 7 * 24 * 3600  # токен обновляется, если истекает раньше, чем через столько секунд
+TOKEN_REFRESH_BATCH = 20  # максимум переавторизаций за одну проверку
+TOKEN_REFRESH_INTERVAL = 1  # пауза между переавторизациями, секунды
 
 
 class MessageFolder:
@@ -13,3 +69,16 @@ class MessageFolder:
 
 
 FOLDER_TYPES = [MessageFolder.INBOX, MessageFolder.SENT]
+
+
+class PrefetchPriority:
+    CHAIN = 0  # соседние сообщения в открытой цепочке
+    PAGE = 1  # сообщения показанной страницы
+    NEXT_PAGE = 2  # сообщения следующей страницы
+    NEW = 3  # новые сообщения из уведомлений
+
+
+class TokenState:
+    ACTIVE = 'active'
+    EXPIRED = 'expired'  # истек срок действия токена
+    REJECTED = 'rejected'  # элжур отклонил токен
@@ -0,0 +1,125 @@
+import itertools
+import os
+import time
+from typing import Any, Dict, List
+
+import pymongo
+from pymongo import InsertOne, DeleteOne, DeleteMany
+
+import tracing
+from dbstats import stats
+from storage import CompactCollection
+
+LISTENERS = [stats, tracing.listener]
+COMMANDS = {'find': 'find', 'find_one': 'find', 'count_documents': 'aggregate', 'aggregate': 'aggregate',
+            'estimated_document_count': 'count', 'distinct': 'distinct', 'insert_one': 'insert',
+            'insert_many': 'insert', 'update_one': 'update', 'update_many': 'update', 'replace_one': 'update',
+            'delete_one': 'delete', 'delete_many': 'delete', 'find_one_and_update': 'findAndModify',
+            'find_one_and_delete': 'findAndModify', 'find_one_and_replace': 'findAndModify',
+            'create_index': 'createIndexes', 'drop': 'drop'}  # метод pymongo -> команда MongoDB
+
+
+class MockEvent:
+    """
+    Событие команды MongoDB с полями, которые читают слушатели dbstats и tracing
+    """
+    _ids = itertools.count(1)
+
+    def __init__(self, command_name: str, collection: str):
+        self.request_id = next(self._ids)
+        self.command_name = command_name
+        self.command = {command_name: collection}
+        self.duration_micros = 0
+        self.failure: Dict[str, Any] = {}
+
+
+class MockMonitor:
+    """
+    Коллекция mongomock, сообщающая слушателям команд о каждом обращении так же, как pymongo: mongomock
+    не публикует события команд, а без них не работают dbstats (учет и max_round_trips) и span'ы трасс.
+    Команда учитывается при вызове метода (find - одна команда без getMore), bulk_write - по команде на каждый
+    вид операций в запросе
+    """
+
+    def __init__(self, collection):
+        self._collection = collection
+
+    def _publish(self, commands: List[str], call, *args, **kwargs):
+        events = [MockEvent(command, self._collection.name) for command in commands]
+        for event in events:
+            for listener in LISTENERS:
+                listener.started(event)
+        begin = time.perf_counter()
+        try:
+            result = call(*args, **kwargs)
+        except Exception as e:
+            for event in events:
+                event.failure = {'codeName': type(e).__name__}
+                for listener in LISTENERS:
+                    listener.failed(event)
+            raise
+        for event in events:
+            event.duration_micros = int((time.perf_counter() - begin) * 1e6 / len(events))
+            for listener in LISTENERS:
+                listener.succeeded(event)
+        return result
+
+    def bulk_write(self, requests: List, *args, **kwargs):
+        kinds = {'insert' if isinstance(op, InsertOne) else 'delete' if isinstance(op, (DeleteOne, DeleteMany))
+                 else 'update' for op in requests}
+        return self._publish(sorted(kinds), self._collection.bulk_write, requests, *args, **kwargs)
+
+    def __getattr__(self, item):
+        attr = getattr(self._collection, item)
+        if item not in COMMANDS:
+            return attr
+        return lambda *args, **kwargs: self._publish([COMMANDS[item]], attr, *args, **kwargs)
+
+
+def connect() -> pymongo.MongoClient:
+    """
+    Создает клиент MongoDB по адресу из переменной окружения mongo_uri.
+    Адрес вида mongomock:// поднимает хранилище в памяти (нужен пакет mongomock) - используется для нагрузочных тестов.
+    Все команды к базе учитываются по обработчикам в dbstats.stats и записываются в трассы (tracing), с mongomock -
+    через MockMonitor (см. collection)
+    :return: клиент базы данных
+    """
+    uri = os.environ.get('mongo_uri')
+    if uri and uri.startswith('mongomock://'):
+        import mongomock
+        return mongomock.MongoClient()
+    return pymongo.MongoClient(uri, event_listeners=LISTENERS)
+
+
+def collection(name: str):
+    """
+    :return: коллекция базы; с mongomock - обернутая в MockMonitor
+    """
+    if isinstance(mongo, pymongo.MongoClient):
+        return db[name]
+    return MockMonitor(db[name])
+
+
+mongo = connect()
+db = mongo[os.environ['database']]
+data = collection('data')
+messages = CompactCollection(collection('messages_v2'))  # сообщения в компактной схеме v2, см. storage.py
+legacy_messages = collection('messages')  # сообщения в схеме v1, переносятся в v2 скриптом migrate_v2.py
+cache_queue = collection('cache_queue')
+homework = collection('homework')
+attachments = collection('attachments')  # ссылки на вложения: ключ кнопки -> ссылка, имя файла, sha256 содержимого
+attachment_blobs = collection('attachment_blobs')  # содержимое вложений по sha256: размер и file_id в Telegram
+school_cache = collection('school_cache')  # общие данные школ (периоды, получатели), см. schoolcache.py
+migrations = collection('migrations')  # ход переносов данных между схемами: _id - имя переноса
+MESSAGES_V2_MIGRATION = 'messages_v2'
+
+messages.ensure_indexes()
+
+
+def migration_pending() -> bool:
+    """
+    :return: в коллекции v1 есть сообщения, а перенос в v2 (migrate_v2.py) еще не завершен
+    """
+    if not legacy_messages.find_one({}, {'_id': True}):
+        return False
+    return not (migrations.find_one({'_id': MESSAGES_V2_MIGRATION}) or {}).get('finished')
@@ -0,0 +1,185 @@
+import threading
+from collections import defaultdict
+from contextlib import contextmanager
+from functools import wraps
+from typing import Callable, Dict, Any, Optional, List
+
+from pymongo import monitoring
+
+import tracing
+
+_local = threading.local()
+UNTRACKED = 'other'
+
+
+def current_operation() -> str:
+    """
+    :return: имя обработчика или фоновой задачи, выполняющейся в текущем потоке
+    """
+    return getattr(_local, 'operation', UNTRACKED)
+
+
+@contextmanager
+def operation(name: str):
+    """
+    Приписывает все команды MongoDB, выполненные внутри блока, обработчику или задаче name
+    :param name: имя обработчика Telegram или фоновой задачи
+    """
+    previous = getattr(_local, 'operation', UNTRACKED)
+    _local.operation = name
+    stats.invoked(name)
+    try:
+        yield
+    finally:
+        _local.operation = previous
+
+
+def tracked(func: Callable, name: Optional[str] = None) -> Callable:
+    """
+    Оборачивает обработчик Telegram или задачу так, чтобы команды MongoDB учитывались на его имя
+    :param func: обработчик
+    :param name: имя для учета, по умолчанию имя функции
+    """
+    name = name or func.__name__
+
+    @wraps(func)
+    def wrapper(*args, **kwargs):
+        with operation(name):
+            return func(*args, **kwargs)
+
+    return wrapper
+
+
+def current_budget() -> Optional[List[str]]:
+    """
+    :return: список команд открытого в текущем потоке max_round_trips или None
+    """
+    return getattr(_local, 'budget', None)
+
+
+@contextmanager
+def charged(budget: Optional[List[str]]):
+    """
+    Учитывает команды MongoDB внутри блока в budget (список команд max_round_trips из другого потока)
+    """
+    previous = getattr(_local, 'budget', None)
+    _local.budget = budget
+    try:
+        yield
+    finally:
+        _local.budget = previous
+
+
+def bind(func: Callable) -> Callable:
+    """
+    Переносит текущий обработчик в другой поток (ThreadPoolExecutor, Thread), чтобы команды оттуда
+    учитывались на тот же обработчик, в его лимит max_round_trips и записывались в его трассу
+    """
+    name = current_operation()
+    budget = current_budget()
+    func = tracing.bind(func)
+
+    @wraps(func)
+    def wrapper(*args, **kwargs):
+        previous = getattr(_local, 'operation', UNTRACKED)
+        _local.operation = name
+        try:
+            with charged(budget):
+                return func(*args, **kwargs)
+        finally:
+            _local.operation = previous
+
+    return wrapper
+
+
+class CommandStats(monitoring.CommandListener):
+    """
+    Слушатель команд pymongo: считает количество и время команд MongoDB по обработчикам
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._pending: Dict[int, str] = {}
+        self.calls = defaultdict(int)
+        self.commands = defaultdict(lambda: defaultdict(int))
+        self.failures = defaultdict(int)
+        self.time_ms = defaultdict(float)
+
+    def invoked(self, name: str) -> None:
+        with self._lock:
+            self.calls[name] += 1
+
+    def started(self, event: monitoring.CommandStartedEvent) -> None:
+        name = current_operation()
+        with self._lock:
+            self._pending[event.request_id] = name
+            self.commands[name][event.command_name] += 1
+        budget = current_budget()
+        if budget is not None:
+            budget.append(event.command_name)
+
+    def _finished(self, event, failed: bool) -> None:
+        with self._lock:
+            name = self._pending.pop(event.request_id, UNTRACKED)
+            self.time_ms[name] += event.duration_micros / 1000
+            if failed:
+                self.failures[name] += 1
+
+    def succeeded(self, event: monitoring.CommandSucceededEvent) -> None:
+        self._finished(event, failed=False)
+
+    def failed(self, event: monitoring.CommandFailedEvent) -> None:
+        self._finished(event, failed=True)
+
+    def snapshot(self) -> Dict[str, Dict[str, Any]]:
+        """
+        :return: статистика по обработчикам: количество вызовов, команд к базе на вызов, время в базе
+        """
+        with self._lock:
+            result = dict()
+            for name in set(self.commands) | set(self.calls):
+                total = sum(self.commands[name].values())
+                calls = self.calls.get(name, 0)
+                result[name] = {
+                    'calls': calls,
+                    'commands': total,
+                    'commands_per_call': round(total / calls, 2) if calls else None,
+                    'failures': self.failures.get(name, 0),
+                    'time_ms': round(self.time_ms.get(name, 0.0), 2),
+                    'by_command': dict(self.commands[name]),
+                }
+            return result
+
+    def reset(self) -> None:
+        with self._lock:
+            self.calls.clear()
+            self.commands.clear()
+            self.failures.clear()
+            self.time_ms.clear()
+
+
+stats = CommandStats()
+
+
+@contextmanager
+def max_round_trips(limit: int, name: str = 'test'):
+    """
+    Проверяет, что код внутри блока делает не больше limit обращений к MongoDB.
+    Используется в проверке для CI (bench/round_trips.py), чтобы ловить N+1 запросы в обработчиках:
+
+        with max_round_trips(5, 'view_message'):
+            view_message(update, context)
+
+    Считаются команды текущего потока и потоков, запущенных из блока через bind (пулы обработчиков, кэширование)
+    или получивших лимит через charged (предзагрузка). С mongomock события команд формирует database.MockMonitor
+    :param limit: максимальное количество команд
+    :param name: имя обработчика для учета и текста ошибки
+    """
+    issued = []
+    with charged(issued), operation(name):
+        yield issued
+    if len(issued) > limit:
+        counts = defaultdict(int)
+        for command in issued:
+            counts[command] += 1
+        raise AssertionError(f'{name}: {len(issued)} обращений к MongoDB при лимите {limit}: {dict(counts)}')
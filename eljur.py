@@ -1,16 +1,26 @@
+import time
 from copy import deepcopy
-from json import loads
-from typing import Dict, Optional, Any, List, Union
+from typing import Dict, Optional, Any, List, Union, Iterator, Tuple
 
-from requests import get
+from requests import get, Response, exceptions
+from urllib3.exceptions import HTTPError
 
-from constants import MessageFolder
+from circuit import breakers, EljurUnavailable
+from codec import loads, iter_items
+from constants import MessageFolder, ELJUR_API_URL, ELJUR_REQUEST_TIMEOUT, TOKEN_REJECTED_STATUSES, IDEMPOTENT_ENDPOINTS
+from executor import require_eljur
+from metrics import eljur_request_seconds, eljur_requests_total, eljur_dead_token_requests_total, \
+    eljur_requests_coalesced_total
+from singleflight import SingleFlight
+from tracing import span
+
+in_flight = SingleFlight()  # выполняющиеся запросы на чтение, общие для всех пользователей
 
 
 class Eljur:
     def __init__(self, token: str = None, vendor: str = 'eljur'):
         self.token = token  # Токен пользователя, полученный после авторизации (выдаётся на 3 месяца)
-        self.api = 'https://api.eljur.ru/api'  # Адрес API eljur.ru
+        self.api = ELJUR_API_URL  # Адрес API eljur.ru
         self._rdata = {
             'auth_token': self.token,
             'vendor': vendor,  # Домен школы
@@ -19,12 +29,85 @@ class Eljur:
             # запасной: 19c4bfc2705023fe080ce94ace26aec9
         }
 
+    def _get(self, api_path: str, params: Dict[str, Any], stream: bool = False) -> Response:
+        """
+        Выполняет GET-запрос к методу API eljur. Одинаковые одновременные запросы на чтение
+        (тот же метод с теми же параметрами, включая токен и школу) выполняются один раз, результат получают все
+        :param api_path: метод API (getmessages, getmarks, ...)
+        :param params: параметры запроса
+        :param stream: не загружать тело ответа сразу (читается из response.raw, такие запросы не объединяются)
+        :return: ответ сервера
+        :raises EljurUnavailable: элжур недоступен, запрос не отправлялся
+        :raises CacheMiss: запрос из обработчика пула кэша, обработчик будет перезапущен в пуле элжура
+        """
+        require_eljur()
+        with span(f'eljur {api_path}', 'eljur', endpoint=api_path, vendor=self._rdata['vendor']) as request_span:
+            if stream:
+                request = self._request(api_path, params, stream=True)
+            elif api_path in IDEMPOTENT_ENDPOINTS:
+                key = (self.api, api_path, tuple(sorted((name, str(value)) for name, value in params.items())))
+                request, shared = in_flight.do(key, lambda: self._request(api_path, params))
+                if shared:
+                    eljur_requests_coalesced_total.inc(endpoint=api_path)
+                    if request_span:
+                        request_span.set('coalesced', True)
+            else:
+                request = self._request(api_path, params)
+            if request_span:
+                request_span.set('status', request.status_code)
+        if request.status_code in TOKEN_REJECTED_STATUSES and params.get('auth_token'):
+            self.token_rejected()
+        return request
+
+    def _request(self, api_path: str, params: Dict[str, Any], stream: bool = False) -> Response:
+        """
+        Отправляет запрос, учитывая время ответа и статус в метриках и доступность элжура в автоматах
+        """
+        api_circuit, vendor_circuit = breakers.for_request(self.api, self._rdata['vendor'])
+        if not api_circuit.allow() or not vendor_circuit.allow():
+            eljur_requests_total.inc(endpoint=api_path, status='circuit_open')
+            raise EljurUnavailable(f'Элжур {self._rdata["vendor"]} недоступен')
+        begin = time.perf_counter()
+        try:
+            request = get(f'{self.api}/{api_path}', params=params, timeout=ELJUR_REQUEST_TIMEOUT, stream=stream)
+        except Exception as e:
+            eljur_requests_total.inc(endpoint=api_path, status=type(e).__name__)
+            if isinstance(e, exceptions.ConnectionError):  # не удалось подключиться к серверу API
+                api_circuit.failure()
+            elif isinstance(e, exceptions.Timeout):  # сервер API принял запрос, но элжур школы не ответил
+                vendor_circuit.failure()
+            raise
+        finally:
+            eljur_request_seconds.observe(time.perf_counter() - begin, endpoint=api_path)
+        eljur_requests_total.inc(endpoint=api_path, status=request.status_code)
+        api_circuit.success()
+        if request.status_code >= 500:
+            vendor_circuit.failure()
+        else:
+            vendor_circuit.success()
+        if request.status_code in TOKEN_REJECTED_STATUSES and params.get('auth_token'):
+            eljur_dead_token_requests_total.inc(endpoint=api_path)
+        return request
+
+    @property
+    def available(self) -> bool:
+        """
+        :return: False, если элжур школы пользователя сейчас считается недоступным
+        """
+        return breakers.available(self.api, self._rdata['vendor'])
+
+    def token_rejected(self) -> None:
+        """
+        Вызывается, когда элжур отклонил токен пользователя. Переопределяется в наследниках
+        """
+        pass
+
     def _parse_schedule_like(self, api_path: str) -> Optional[Dict[str, dict]]:
         """
         Получения расписания и домашнего задания, исправляет даты вида ггггммдд в дд.мм.гггг
         """
-        r = get(f'{self.api}/{api_path}', params=self._rdata)
-        data = loads(r.text)
+        r = self._get(api_path, params=self._rdata)
+        data = loads(r.content)
         if data['response']['state'] != 200:
             return None
         schedule = list(data['response']['result']['students'].values())[0]['days']
@@ -68,10 +151,48 @@ class Eljur:
             params['unreadonly'] = str(True).lower()
         params['limit'] = str(limit)
         params['page'] = str(page)
-        request = get(f'{self.api}/getmessages', params=params)
+        request = self._get('getmessages', params=params)
         if request.status_code != 200:
             return None
-        return loads(request.text)['response']['result']
+        return loads(request.content)['response']['result']
+
+    def iter_messages(self, folder: str = MessageFolder.INBOX,
+                      page: int = 1,
+                      limit: int = 6,
+                      unreadonly: bool = False) -> Optional[Tuple[Dict[str, Any], Iterator[Dict[str, Any]]]]:
+        """
+        То же, что get_messages, но ответ разбирается потоково: сообщения отдаются по одному по мере чтения ответа,
+        и страница целиком в памяти не хранится
+        :return: (поля результата total и count, итератор сообщений страницы) или None, если элжур вернул ошибку.
+        Поля, которые в ответе идут после сообщений, появляются в словаре после прохода по итератору
+        """
+        params = deepcopy(self._rdata)
+        params['folder'] = str(folder)
+        if unreadonly:
+            params['unreadonly'] = str(True).lower()
+        params['limit'] = str(limit)
+        params['page'] = str(page)
+        request = self._get('getmessages', params=params, stream=True)
+        if request.status_code != 200:
+            request.close()
+            return None
+        request.raw.decode_content = True
+        try:
+            values, items = iter_items(request.raw, 'response.result.messages',
+                                       fields=('response.result.total', 'response.result.count'))
+        except HTTPError as e:
+            request.close()
+            raise exceptions.ConnectionError(e)
+
+        def messages() -> Iterator[Dict[str, Any]]:
+            try:
+                yield from items
+            except HTTPError as e:  # обрыв соединения при чтении ответа
+                raise exceptions.ConnectionError(e)
+            finally:
+                request.close()
+
+        return values, messages()
 
     def get_message(self, msg_id: str) -> Dict[str, Any]:
         """
@@ -81,10 +202,10 @@ class Eljur:
         """
         params = deepcopy(self._rdata)
         params['id'] = msg_id
-        request = get(f'{self.api}/getmessageinfo', params=params)
+        request = self._get('getmessageinfo', params=params)
         if request.status_code != 200:
             return {}
-        msg = loads(request.text)['response']['result']['message']
+        msg = loads(request.content)['response']['result']['message']
         msg['with_files'] = 'files' in msg and len(msg['files']) > 0
         return msg
 
@@ -95,12 +216,12 @@ class Eljur:
         :param group: название группы пользователей из поля key
         :return: список групп или пользователей группы
         """
-        request = get(f'{self.api}/getmessagereceivers', params=self._rdata)
+        request = self._get('getmessagereceivers', params=self._rdata)
         if request.status_code != 200:
             return None
         if group:
-            return loads(request.text)['response']['result']['groups'][group]
-        return loads(request.text)['response']['result']['groups']
+            return loads(request.content)['response']['result']['groups'][group]
+        return loads(request.content)['response']['result']['groups']
 
     def send_message(self, users_to: str, subject: str, text: str) -> bool:
         """
@@ -114,7 +235,7 @@ class Eljur:
         params['subject'] = subject
         params['text'] = text
         params['users_to'] = users_to
-        request = get(f'{self.api}/sendmessage', params=params)
+        request = self._get('sendmessage', params=params)
         if request.status_code != 200:
             return False
         return True
@@ -129,7 +250,7 @@ class Eljur:
         params = deepcopy(self._rdata)
         params['replyto'] = replyto
         params['text'] = text
-        request = get(f'{self.api}/sendreplymessage', params=params)
+        request = self._get('sendreplymessage', params=params)
         if request.status_code != 200:
             return False
         return True
@@ -138,20 +259,20 @@ class Eljur:
         """
         Основная информация о пользователе
         """
-        request = get(f'{self.api}/getrules', params=self._rdata)
+        request = self._get('getrules', params=self._rdata)
         if request.status_code != 200:
             return None
-        return loads(request.text)['response']['result']
+        return loads(request.content)['response']['result']
 
     def periods(self, show_disabled: bool = True) -> Optional[List[Dict[str, Optional[str]]]]:
         """
         Учебные периоды пользователя
         :param show_disabled: возвращать ли ещё не наступившие периоды
         """
-        request = get(f'{self.api}/getperiods', params={**self._rdata, 'show_disabled': show_disabled})
+        request = self._get('getperiods', params={**self._rdata, 'show_disabled': show_disabled})
         if request.status_code != 200:
             return None
-        return loads(request.text)['response']['result']['students'][0]['periods']
+        return loads(request.content)['response']['result']['students'][0]['periods']
 
     def marks(self, last_period: bool = True) -> Optional[Dict[str, Any]]:
         period = None
@@ -159,7 +280,7 @@ class Eljur:
             periods = self.periods(show_disabled=False)
             if periods:
                 period = f"{periods[-1]['start']}-{periods[-1]['end']}"
-        request = get(f'{self.api}/getmarks', params={**self._rdata, 'days': period})
+        request = self._get('getmarks', params={**self._rdata, 'days': period})
         if request.status_code != 200:
             return None
-        return list(loads(request.text)['response']['result']['students'].values())[0]
+        return list(loads(request.content)['response']['result']['students'].values())[0]
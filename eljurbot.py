@@ -3,57 +3,73 @@ import logging
 import math
 import os
 import time
-import traceback
 import socket
+from datetime import datetime, timedelta
+from html import escape
 from pathlib import Path
 from threading import Thread
-from typing import Dict, Any, Callable
+from typing import Dict, Any, Callable, Optional
 
-import pymongo
 import requests
-from pymorphy2 import MorphAnalyzer
 from telegram import InlineKeyboardButton, InlineKeyboardMarkup, ParseMode, ReplyKeyboardRemove, ReplyKeyboardMarkup, \
-    Update, ChatAction, User, CallbackQuery
+    Update, ChatAction, User, CallbackQuery, TelegramError, Bot
 from telegram.ext import Updater, CommandHandler, CallbackQueryHandler, PicklePersistence, \
-    ConversationHandler, MessageHandler, Filters, CallbackContext, JobQueue, Job
+    ConversationHandler, MessageHandler, Filters, CallbackContext, JobQueue, Job, Dispatcher
 
+from attachments import mirror
+from callbacks import Action, Origin, CallbackRouter, encode, UNREAD, PageArgs, MessageArgs, \
+    ReplyArgs, FolderArgs, RecipientsArgs, FileArgs, StarredArgs, SearchArgs, NoArgs
 from CTEStorage import cte
 from CachedTelegramEljur import CachedTelegramEljur
 from constants import *
+from database import data, messages, cache_queue, migration_pending
+from dbstats import stats as db_stats, tracked, operation
+from executor import cache_pool, eljur_pool, notify_busy, require_eljur, UNAVAILABLE_TEXT
 from homework import homework_handler, homework
+from logs import setup as setup_logging
 from messages import present_messages
+from onboarding import onboarding
+from prefetch import prefetcher
+from render import render_body, render_recipients
+from tracing import traced, TracedRequest
+from metrics import registry, timed, handler_seconds, handler_errors_total, telegram_send_failures_total, \
+    serve as serve_metrics
 from utility import format_user, opposite_folder, folder_to_string, parse_vendor, load_date, clean_html
+from webhook import WebhookServer
 
 locale.setlocale(locale.LC_TIME, 'ru_RU.UTF-8')
 data_dir = Path(__file__).parent / 'data'
 media = Path(__file__).parent / 'media'
 if not data_dir.exists():
     os.mkdir(data_dir)
-logging.basicConfig(format='%(asctime)s - %(name)s - %(levelname)s - %(message)s',
-                    level=logging.INFO,
-                    filename=str(data_dir / 'bot.log'))
+setup_logging(str(data_dir / 'bot.log'))
 logger = logging.getLogger("BOT")
-logger_cte = logging.getLogger('CachedTelegramEljur')
-logging.getLogger("requests").setLevel(logging.WARNING)
-ch = logging.StreamHandler()
-ch.setLevel(logging.INFO)
-formatter = logging.Formatter('%(asctime)s - %(name)s - %(levelname)s - %(message)s')
-ch.setFormatter(formatter)
-logger.addHandler(ch)
-logger.setLevel(logging.INFO)
-logger_cte.addHandler(ch)
-morph = MorphAnalyzer()
 LOGIN, WAIT_LOGIN, WAIT_PASSWORD, MAIN_MENU, CHOOSE_VENDOR, INPUT_VENDOR = range(6)
-mongo = pymongo.MongoClient(os.environ.get('mongo_uri'))
-db = mongo[os.environ['database']]
-data = db['data']
-messages = db['messages']
-cache_queue = db['cache_queue']
+last_poll: Dict[int, float] = dict()  # время последней успешной проверки новых сообщений по чатам
+
+registry.gauge('poll_lag_seconds', 'Время с последней успешной проверки новых сообщений', ('chat_id',),
+               function=lambda: {(str(chat_id),): time.time() - at for chat_id, at in list(last_poll.items())})
+registry.gauge('cache_queue_depth', 'Сообщения, ожидающие кэширования',
+               function=lambda: cache_queue.estimated_document_count())
+registry.gauge('prefetch_queue_depth', 'Сообщения в очереди предзагрузки', function=lambda: prefetcher.depth)
+registry.gauge('cte_storage_size', 'Пользователи, загруженные в память', function=lambda: len(cte.ctes))
+registry.gauge('parked_tokens', 'Пользователи с истекшим или отклоненным токеном, для которых элжур не опрашивается',
+               function=lambda: data.count_documents({'token_state': {'$in': [TokenState.EXPIRED,
+                                                                              TokenState.REJECTED]}}))
+polls_parked_total = registry.counter('polls_parked_total', 'Пропущенные опросы элжура из-за недействительного токена',
+                                      ('job',))
+token_refresh_total = registry.counter('token_refresh_total', 'Переавторизации по сохраненным логину и паролю',
+                                       ('result',))
+registry.gauge('mongo_commands', 'Команды MongoDB по обработчикам', ('handler',),
+               function=lambda: {(name,): item['commands'] for name, item in db_stats.snapshot().items()})
 
 
 def error(update: Update, context: CallbackContext):
     """Log Errors caused by Updates."""
+    handler_errors_total.inc(error=type(context.error).__name__)
     logger.warning('Update "%s" caused error "%s"', update, context.error)
+    if isinstance(context.error, requests.exceptions.RequestException) and isinstance(update, Update):
+        notify_busy(update, text=UNAVAILABLE_TEXT)
 
 
 def start(update: Update, context: CallbackContext):
@@ -90,10 +106,8 @@ def vendor_handler(update: Update, context: CallbackContext):
         return login_handler(update, context)
     else:
         context.dispatcher.bot.send_chat_action(chat_id=update.message.chat.id, action=ChatAction.RECORD_VIDEO)
-        context.dispatcher.bot.send_video(update.message.chat.id,
-                                          open(media / 'copy-vendor.mov', 'rb'),
-                                          width=2960,
-                                          height=416)
+        mirror.send_media(context.dispatcher.bot, update.message.chat.id, media / 'copy-vendor.mov', kind='video',
+                          width=2960, height=416)
         update.message.reply_text(text='Скопируйте ссылку на ваш элжур, как показано выше и отправьте её мне:',
                                   reply_markup=ReplyKeyboardRemove())
         return INPUT_VENDOR
@@ -136,15 +150,27 @@ def user_send_password(update: Update, context: CallbackContext):
     if ejuser.auth(login=context.user_data['eljur_login'],
                    password=update.message.text,
                    vendor=context.user_data['vendor']):
-        update.message.reply_text('Вы успешно вошли в элжур! Выполняю синхронизацию, пожалуйста, подождите.')
-        cte.get_cte(chat_id=update.message.chat.id)  # Кэшируем сообщения
+        try:
+            ejuser.sync_first_page()  # последние входящие доступны сразу, остальное загружается в фоне
+        except requests.exceptions.RequestException as e:
+            logger.warning('Не удалось загрузить первую страницу сообщений %s: %s', update.message.chat.id, e,
+                           extra={'chat_id': update.message.chat.id})
+        cte.add(ejuser)
+        progress = update.message.reply_text('Вы успешно вошли в элжур! Последние сообщения уже доступны, '
+                                             'остальные загружаю в фоне.')
+        onboarding.start(context.bot, ejuser, message_id=progress.message_id)
         if update.message.chat.id not in authorized_chat_ids:
             authorized_chat_ids.append(update.message.chat.id)
-        updater.job_queue.run_repeating(check_for_new_messages,
+        updater.job_queue.run_repeating(instrument(check_for_new_messages),
                                         interval=MESSAGES_CHECK_DELAY,
                                         first=MESSAGES_CHECK_DELAY,
                                         context=update.message.chat.id,
                                         name=f'new_messages:{update.message.chat.id}')
+        updater.job_queue.run_repeating(instrument(sync_read_state),
+                                        interval=READ_STATE_SYNC_DELAY,
+                                        first=READ_STATE_SYNC_DELAY,
+                                        context=update.message.chat.id,
+                                        name=f'read_state:{update.message.chat.id}')
         send_menu(update=update, context=context)
         return MAIN_MENU
     else:
@@ -158,10 +184,13 @@ def user_send_password(update: Update, context: CallbackContext):
 
 def stop(update: Update, context: CallbackContext):
     user: User = update.message.from_user
-    logger.info(f"{user.first_name} {user.username} остановил бота")
+    logger.info('%s %s остановил бота', user.first_name, user.username, extra={'chat_id': user.id})
     chat_id = user.id
     job_new_messages: Job = job_queue.get_jobs_by_name(f'new_messages:{chat_id}')[0]
     job_new_messages.schedule_removal()
+    for job in job_queue.get_jobs_by_name(f'read_state:{chat_id}'):
+        job.schedule_removal()
+    last_poll.pop(chat_id, None)
     messages.delete_many({'chat_id': update.message.chat.id})
     cache_queue.delete_many({'chat_id': update.message.chat.id})
     data.delete_one({'chat_id': update.message.chat.id})
@@ -175,13 +204,19 @@ def check_for_new_messages(context):
     user_id = context.job.context
     if not data.find_one({'chat_id': user_id}):
         return
-    logger.info(f'Проверка новых сообщений для {user_id}')
+    logger.info('Проверка новых сообщений для %s', user_id, extra={'chat_id': user_id, 'event': 'poll'})
     try:
         ejuser = cte.get_cte(chat_id=user_id)
-        new_messages = ejuser.download_messages_preview(check_new_only=True, limit=100, folder=MessageFolder.INBOX)
-        logger.info(f'{len(new_messages)} новых сообщений для {user_id}')
+        if not ejuser.token_usable:
+            polls_parked_total.inc(job='new_messages')
+            return
+        new_messages = ejuser.check_new_messages(limit=100)
+        logger.info('%s новых сообщений для %s', len(new_messages), user_id,
+                    extra={'chat_id': user_id, 'event': 'poll' if not new_messages else 'new_messages'})
+        last_poll[user_id] = time.time()
         if not new_messages:
             return
+        prefetcher.promote(ejuser, new_messages, PrefetchPriority.NEW)
         for message in new_messages:
             text = "<b>Новое сообщение</b>\n\n"
             subject = message['subject']
@@ -191,16 +226,83 @@ def check_for_new_messages(context):
                     f"<i>Тема:</i> {subject}\n\n" \
                     f"<pre>{clean_html(message['short_text'])}</pre>"
             keyboard = [[InlineKeyboardButton("Посмотреть",
-                                              callback_data=f'message_view_new_{message["id"]}'),
-                         InlineKeyboardButton("Закрыть", callback_data='close')]]
+                                              callback_data=encode(Action.VIEW, MessageFolder.INBOX, message['id'],
+                                                                   Origin.NEW)),
+                         InlineKeyboardButton("Закрыть", callback_data=encode(Action.CLOSE))]]
             reply_markup = InlineKeyboardMarkup(keyboard)
-            context.bot.send_message(chat_id=user_id, text=text, parse_mode=ParseMode.HTML, reply_markup=reply_markup)
+            try:
+                context.bot.send_message(chat_id=user_id, text=text, parse_mode=ParseMode.HTML,
+                                         reply_markup=reply_markup)
+            except TelegramError as e:
+                telegram_send_failures_total.inc(method='sendMessage')
+                logger.warning('Не удалось отправить уведомление %s: %s', user_id, e, extra={'chat_id': user_id})
+    except socket.gaierror as e:
+        pass
+    except requests.exceptions.ConnectionError as e:
+        pass
+
+
+def sync_read_state(context):
+    """
+    Фоновая сверка статуса прочтения входящих сообщений с элжуром
+    """
+    user_id = context.job.context
+    if not data.find_one({'chat_id': user_id}):
+        return
+    try:
+        ejuser = cte.get_cte(chat_id=user_id)
+        if not ejuser.token_usable:
+            polls_parked_total.inc(job='read_state')
+            return
+        changed = ejuser.update_read_state(folder=MessageFolder.INBOX)
+        if changed:
+            logger.info('Статус прочтения обновлен для %s сообщений %s', changed, user_id, extra={'chat_id': user_id})
     except socket.gaierror as e:
         pass
     except requests.exceptions.ConnectionError as e:
         pass
 
 
+def refresh_tokens(context: CallbackContext):
+    """
+    Переавторизация по сохраненным логину и паролю пользователей, чей токен скоро истечет или уже недействителен.
+    За один запуск обрабатывается не больше TOKEN_REFRESH_BATCH пользователей с паузой между запросами к элжуру
+    """
+    due = data.find({'login': {'$exists': True}, 'password': {'$exists': True}, 'reauth_failed': {'$ne': True},
+                     '$or': [{'token_expire': {'$lt': datetime.now() + timedelta(seconds=TOKEN_REFRESH_AHEAD)}},
+                             {'token_state': {'$in': [TokenState.EXPIRED, TokenState.REJECTED]}}]},
+                    {'chat_id': True}).sort('token_expire', 1).limit(TOKEN_REFRESH_BATCH)
+    for number, document in enumerate(list(due)):
+        chat_id = document['chat_id']
+        if number:
+            time.sleep(TOKEN_REFRESH_INTERVAL)
+        if chat_id in cte.ctes:
+            ejuser = cte.get_cte(chat_id=chat_id)
+        else:
+            ejuser = CachedTelegramEljur(chat_id=chat_id, no_messages=True)
+        try:
+            refreshed = ejuser.reauth()
+        except requests.exceptions.RequestException as e:
+            token_refresh_total.inc(result='unavailable')
+            logger.warning('Не удалось обновить токен %s, элжур недоступен: %s', chat_id, e, extra={'chat_id': chat_id})
+            continue
+        if refreshed:
+            token_refresh_total.inc(result='refreshed')
+            logger.info('Токен пользователя %s обновлен', chat_id, extra={'chat_id': chat_id})
+            continue
+        token_refresh_total.inc(result='failed')
+        ejuser.park_token(TokenState.REJECTED)
+        data.update_one({'chat_id': chat_id}, {'$set': {'reauth_failed': True}})
+        logger.warning('Элжур не принял сохраненные логин и пароль пользователя %s', chat_id,
+                       extra={'chat_id': chat_id})
+        try:
+            context.bot.send_message(chat_id=chat_id, text='Не удалось войти в элжур с сохраненным паролем. '
+                                                           'Чтобы снова получать сообщения, войдите заново: /start')
+        except TelegramError as e:
+            telegram_send_failures_total.inc(method='sendMessage')
+            logger.warning('Не удалось сообщить %s об ошибке входа: %s', chat_id, e, extra={'chat_id': chat_id})
+
+
 def messages_common_part(msgs: Dict[str, Any],
                          folder: str,
                          context: CallbackContext,
@@ -220,26 +322,28 @@ def messages_common_part(msgs: Dict[str, Any],
         unread = 0
     if context.user_data['messages_page'] == 1:
         keyboard = [[InlineKeyboardButton(f'{op_folder_name.lower().capitalize()}',
-                                          callback_data=f'page_{op_folder}_1'),
-                     InlineKeyboardButton(f'🔄', callback_data=f'update_{folder}'),
-                     InlineKeyboardButton('➡', callback_data=f'page_{folder}_next')]
+                                          callback_data=encode(Action.PAGE, op_folder, 1)),
+                     InlineKeyboardButton(f'🔄', callback_data=encode(Action.UPDATE, folder)),
+                     InlineKeyboardButton('➡', callback_data=encode(Action.PAGE, folder, 0, 1))]
                     ]
     else:
-        keyboard = [[InlineKeyboardButton('⬅', callback_data=f'page_{folder}_prev'),
-                     InlineKeyboardButton('В начало', callback_data=f'page_{folder}_1'),
-                     InlineKeyboardButton('➡', callback_data=f'page_{folder}_next')]]
+        keyboard = [[InlineKeyboardButton('⬅', callback_data=encode(Action.PAGE, folder, 0, -1)),
+                     InlineKeyboardButton('В начало', callback_data=encode(Action.PAGE, folder, 1)),
+                     InlineKeyboardButton('➡', callback_data=encode(Action.PAGE, folder, 0, 1))]]
     if unread > 0 and not unread_only:
-        keyboard[0].insert(1, InlineKeyboardButton('🆕', callback_data=f'page_unread_1'))
+        keyboard[0].insert(1, InlineKeyboardButton('🆕', callback_data=encode(Action.PAGE, UNREAD, 1)))
     elif unread_only:
-        keyboard[0].insert(1, InlineKeyboardButton('👁️+🆕', callback_data=f'page_inbox_1'))
+        keyboard[0].insert(1, InlineKeyboardButton('👁️+🆕', callback_data=encode(Action.PAGE, MessageFolder.INBOX, 1)))
     starred = ejuser.starred_messages(MessageFolder.INBOX) + ejuser.starred_messages(MessageFolder.SENT)
     if len(starred) > 0:
-        keyboard[0].insert(1, InlineKeyboardButton('⭐', callback_data=f'starred_inbox_1'))
+        keyboard[0].insert(1, InlineKeyboardButton('⭐', callback_data=encode(Action.STARRED, MessageFolder.INBOX)))
     for i in range(0, msgs['count'], 3):
         keyboard.append([InlineKeyboardButton(str(label),
-                                              callback_data=f'message_{folder}_{msgs["messages"][label - 1]["id"]}')
+                                              callback_data=encode(Action.VIEW, folder, msgs['messages'][label - 1].id))
                          for label in range(i + 1, i + 4) if label - 1 < len(msgs["messages"])])
     reply_markup = InlineKeyboardMarkup(keyboard)
+    if not unread_only:
+        prefetcher.promote_page(ejuser, folder=folder, page=context.user_data['messages_page'])
     return messages_s, reply_markup
 
 
@@ -250,6 +354,7 @@ def messages_handler(update: Update, context: CallbackContext):
     folder = MessageFolder.INBOX
     messages_s, reply_markup = messages_common_part(msgs=msgs, folder=folder, context=context, ejuser=ejuser)
     update.message.reply_text(messages_s, parse_mode=ParseMode.HTML, reply_markup=reply_markup)
+    ejuser.warm_search_index()
 
 
 def marks_handler(update: Update, context: CallbackContext):
@@ -272,98 +377,94 @@ def marks_handler(update: Update, context: CallbackContext):
                                   parse_mode=ParseMode.HTML)
 
 
-def messages_page_handler(update: Update, context: CallbackContext):
+def messages_page_handler(update: Update, context: CallbackContext, args: PageArgs):
     query = update.callback_query
-    action = query.data.split('_')[-1]
     if 'messages_page' in context.user_data:
-        if action == 'next':
-            context.user_data['messages_page'] += 1
-        elif action == 'prev':
-            context.user_data['messages_page'] -= 1
-        elif action.isdigit():
-            context.user_data['messages_page'] = int(action)
+        page = args.page if args.page else context.user_data['messages_page'] + args.step
     else:
-        context.user_data['messages_page'] = 1
-    folder = query.data.split('_')[1]
-    if folder == "unread":
+        page = 1
+    folder = args.folder
+    if folder == UNREAD:
         unread_only = True
         folder = MessageFolder.INBOX
     else:
         unread_only = False
-    context.user_data['messages_page'] = max(1, context.user_data['messages_page'])
+    page = max(1, page)
     ejuser = cte.get_cte(chat_id=query.message.chat.id)
-    msgs = ejuser.get_messages(page=context.user_data['messages_page'], folder=folder, unreadonly=unread_only)
+    msgs = ejuser.get_messages(page=page, folder=folder, unreadonly=unread_only)
     total = math.ceil(int(msgs['total']) / 6)
-    if context.user_data['messages_page'] > total:
-        context.user_data['messages_page'] = 1
-        msgs = ejuser.get_messages(page=context.user_data['messages_page'])
+    if page > total:
+        page = 1
+        msgs = ejuser.get_messages(page=page)
+    # страница запоминается после обращений к элжуру: при промахе кэша обработчик перезапускается в пуле элжура
+    context.user_data['messages_page'] = page
     messages_s, reply_markup = messages_common_part(msgs=msgs,
                                                     folder=folder,
                                                     context=context,
                                                     ejuser=ejuser,
                                                     unread_only=unread_only)
-    query.edit_message_text(messages_s, parse_mode=ParseMode.HTML)
-    query.edit_message_reply_markup(reply_markup=reply_markup)
+    query.edit_message_text(messages_s, parse_mode=ParseMode.HTML, reply_markup=reply_markup)
     query.answer()
 
 
 def parse_message(message: dict):
-    recipients = ''
-    for user in message['user_to'][:RECIPIENTS_PREVIEW_COUNT]:
-        if user['middlename']:
-            recipients += f"{user['lastname']} {user['firstname'][0]}.{user['middlename'][0]}, "
-        else:
-            recipients += f"{user['lastname']} {user['firstname']}, "
-    recipients = recipients[:-2]
-    yet_more = len(message['user_to']) - RECIPIENTS_PREVIEW_COUNT
-    and_yet_more = f" и ещё {yet_more} {morph.parse('получателей')[0].make_agree_with_number(yet_more).word}" \
-        if len(message['user_to']) > RECIPIENTS_PREVIEW_COUNT else ""
-    files = ''
-    if 'files' in message:
-        for file in message['files']:
-            files += f'<a href="{file["link"]}">📎 {file["filename"]}</a>\n'
+    """
+    Текст сообщения для Telegram. Текст и получатели подготавливаются при кэшировании сообщения (render.prerender),
+    здесь только собирается строка
+    """
+    recipients = message.get('recipients') or \
+        render_recipients(message.get('user_to') or message.get('users_to') or [])
+    if 'html' in message:
+        text = message['html']
+    elif 'text' in message:
+        text = render_body(message['text'])
+    else:  # элжур недоступен, а текст ещё не загружен
+        text = f"{render_body(message.get('short_text', ''))}…\n\n<i>Элжур не отвечает, показано начало сообщения</i>"
     result = f"<i>Тема:</i> <b>{message['subject']}</b>\n" \
              f"<i>Отправитель:</i> {format_user(message['user_from'])}\n" \
              f"<i>Отправлено:</i> {load_date(message['date']).strftime('%-d %B %H:%M')}\n" \
-             f"<i>{'Получатели' if len(message['user_to']) > 1 else 'Получатель'}:</i> {recipients}{and_yet_more}\n\n" \
+             f"{recipients}\n\n" \
              f"<i>Сообщение:</i>\n" \
-             f"{message['text']}\n" \
-             f"{files}"
+             f"{text}\n"
     return result
 
 
-def view_message(update: Update, context: CallbackContext):
+def view_message(update: Update, context: CallbackContext, args: MessageArgs, notice: Optional[str] = None):
     query = update.callback_query
     ejuser = cte.get_cte(chat_id=query.message.chat.id)
-    from_starred = query.data.endswith('_starred')
-    starred_page = 1
-    if from_starred:
-        starred_page = query.data.split('_')[-2]
-        query.data = '_'.join(query.data.split('_')[:-2])
     context.user_data['recipients_offset'] = 0
     context.user_data['reply'] = None
-    message_id = query.data.split('_')[-1]
-    if query.data.startswith('message_view_new_'):
-        message_folder = 'inbox'
-        keyboard = [[InlineKeyboardButton("Ответить", callback_data=f'reply_inbox_{message_id}'),
-                     InlineKeyboardButton("Закрыть", callback_data='close')]]
+    message_id = args.msg_id
+    message_folder = args.folder
+    reply_callback = encode(Action.REPLY, message_folder, message_id)
+    if args.origin == Origin.NEW:
+        keyboard = [[InlineKeyboardButton("Ответить", callback_data=reply_callback),
+                     InlineKeyboardButton("Закрыть", callback_data=encode(Action.CLOSE))]]
     else:
-        message_folder = query.data.split('_')[-2]
-        back_callback = f"page_{message_folder}_it" if not from_starred else f"starred_{message_folder}_{starred_page}"
-        keyboard = [[InlineKeyboardButton("Ответить", callback_data=f'reply_{message_folder}_{message_id}'),
+        if args.origin == Origin.STARRED:
+            back_callback = encode(Action.STARRED, message_folder, args.origin_page)
+        elif args.origin == Origin.SEARCH:
+            back_callback = encode(Action.SEARCH, args.origin_page)
+        else:
+            back_callback = encode(Action.PAGE, message_folder)
+        keyboard = [[InlineKeyboardButton("Ответить", callback_data=reply_callback),
                      InlineKeyboardButton("Назад", callback_data=back_callback)]]
     starred = ejuser.is_starred(msg_id=message_id, folder=message_folder)
     star = "👎🏿⭐️️" if starred else "⭐️"
-    start_callback = f"unstar_{message_folder}_{message_id}" if starred else f"star_{message_folder}_{message_id}"
-    keyboard[0].insert(1, InlineKeyboardButton(f"{star}", callback_data=f'{start_callback}'))
-    message = ejuser.get_message(msg_id=message_id, force_folder=message_folder)
+    keyboard[0].insert(1, InlineKeyboardButton(f"{star}", callback_data=encode(Action.STAR, *args)))
+    message = ejuser.get_message(msg_id=message_id, force_folder=message_folder, view=True)
+    if not message:
+        query.answer(text=UNAVAILABLE_TEXT)
+        return
     result = parse_message(message=message)
-    if message_folder == MessageFolder.INBOX:
+    if message_folder == MessageFolder.INBOX and 'text' in message:
         ejuser.mark_as_read(msg_id=message_id, folder=message_folder)
-    yet_more = len(message['user_to']) - RECIPIENTS_PREVIEW_COUNT
+    yet_more = len(message.get('user_to', [])) - RECIPIENTS_PREVIEW_COUNT
     if yet_more > 0:
         keyboard.append([InlineKeyboardButton("Полный список получателей",
-                                              callback_data=f"recipients_{message_folder}_{message_id}_it")])
+                                              callback_data=encode(Action.RECIPIENTS, message_folder, message_id))])
+    if message.get('files'):
+        keyboard.extend(mirror.buttons(message['files']))
     chain = ejuser.messages_chain(msg_id=message_id, folder=message_folder)
     pos_in_chain = 0
     for msg in chain:
@@ -371,48 +472,53 @@ def view_message(update: Update, context: CallbackContext):
             break
         pos_in_chain += 1
     if len(chain) > 1:
+        prefetcher.promote(ejuser, chain[max(0, pos_in_chain - 1):pos_in_chain + 2], PrefetchPriority.CHAIN)
         if pos_in_chain == 0:
             next_msg = chain[pos_in_chain + 1]
-            keyboard.append([InlineKeyboardButton("➡", callback_data=f"message_{next_msg['folder']}_{next_msg['id']}")])
+            keyboard.append([InlineKeyboardButton("➡", callback_data=encode(Action.VIEW, next_msg['folder'],
+                                                                            next_msg['id']))])
         else:
             if pos_in_chain + 1 < len(chain):
                 next_msg = chain[pos_in_chain + 1]
                 prev_msg = chain[pos_in_chain - 1]
                 keyboard.append([InlineKeyboardButton("⬅",
-                                                      callback_data=f"message_{prev_msg['folder']}_{prev_msg['id']}"),
+                                                      callback_data=encode(Action.VIEW, prev_msg['folder'],
+                                                                           prev_msg['id'])),
                                  InlineKeyboardButton("➡",
-                                                      callback_data=f"message_{next_msg['folder']}_{next_msg['id']}")])
+                                                      callback_data=encode(Action.VIEW, next_msg['folder'],
+                                                                           next_msg['id']))])
             else:
                 prev_msg = chain[pos_in_chain - 1]
                 keyboard.append(
-                    [InlineKeyboardButton("⬅", callback_data=f"message_{prev_msg['folder']}_{prev_msg['id']}")])
+                    [InlineKeyboardButton("⬅", callback_data=encode(Action.VIEW, prev_msg['folder'], prev_msg['id']))])
     reply_markup = InlineKeyboardMarkup(keyboard)
-    query.edit_message_text(result, parse_mode=ParseMode.HTML, disable_web_page_preview=True)
-    query.edit_message_reply_markup(reply_markup)
-    query.answer()
+    query.edit_message_text(result, parse_mode=ParseMode.HTML, disable_web_page_preview=True, reply_markup=reply_markup)
+    query.answer(text=notice)
+
 
+def file_handler(update: Update, context: CallbackContext, args: FileArgs):
+    query = update.callback_query
+    context.dispatcher.bot.send_chat_action(chat_id=query.message.chat.id, action=ChatAction.UPLOAD_DOCUMENT)
+    if mirror.send_attachment(context.dispatcher.bot, chat_id=query.message.chat.id, key=args.key):
+        query.answer()
+    else:
+        query.answer(text='Не удалось загрузить файл из элжура, попробуйте позднее')
 
-def close_message(update: Update, context: CallbackContext):
+
+def close_message(update: Update, context: CallbackContext, args: NoArgs):
     query = update.callback_query
     context.bot.delete_message(chat_id=query.message.chat.id, message_id=query.message.message_id)
     query.answer()
 
 
-def message_recipients(update: Update, context: CallbackContext):
+def message_recipients(update: Update, context: CallbackContext, args: RecipientsArgs):
     query = update.callback_query
     ejuser = cte.get_cte(chat_id=query.message.chat.id)
-    message_id = query.data.split('_')[-2]
-    action = query.data.split('_')[-1]
-    folder = query.data.split('_')[1]
-    if action == 'next':
-        context.user_data['recipients_offset'] += RECIPIENTS_PER_PAGE
-    elif action == 'prev':
-        context.user_data['recipients_offset'] -= RECIPIENTS_PER_PAGE
-    context.user_data['recipients_offset'] = max(0, context.user_data['recipients_offset'])
-    if 'messages_folder' not in context.user_data:
-        context.user_data['messages_folder'] = MessageFolder.INBOX
-    offset = context.user_data['recipients_offset']
-    message = ejuser.get_message(message_id, force_folder=context.user_data['messages_folder'])
+    message_id = args.msg_id
+    folder = args.folder
+    offset = max(0, context.user_data.get('recipients_offset', 0) + args.step * RECIPIENTS_PER_PAGE)
+    message = ejuser.get_message(message_id, force_folder=folder)
+    context.user_data['recipients_offset'] = offset
     total = math.ceil(len(message["user_to"]) / RECIPIENTS_PER_PAGE)
     cur_page = offset // RECIPIENTS_PER_PAGE + 1
     recipients = f'<b>Получатели (страница {cur_page}/{total})</b>\n\n<i>'
@@ -420,40 +526,38 @@ def message_recipients(update: Update, context: CallbackContext):
         recipients += f"{format_user(user)}, "
     recipients = recipients[:-2]
     recipients += '</i>'
-    query.edit_message_text(recipients, parse_mode=ParseMode.HTML)
+    next_callback = encode(Action.RECIPIENTS, folder, message_id, 1)
     if offset > 0:
-        keyboard = [[InlineKeyboardButton('⬅', callback_data=f'recipients_{folder}_{message_id}_prev')]]
+        keyboard = [[InlineKeyboardButton('⬅', callback_data=encode(Action.RECIPIENTS, folder, message_id, -1))]]
     else:
         keyboard = []
     if cur_page != total:
         if offset > 0:
-            keyboard[0].append(InlineKeyboardButton('➡', callback_data=f'recipients_{folder}_{message_id}_next'))
+            keyboard[0].append(InlineKeyboardButton('➡', callback_data=next_callback))
         else:
-            keyboard = [[InlineKeyboardButton('➡', callback_data=f'recipients_{folder}_{message_id}_next')]]
-    keyboard.append([InlineKeyboardButton("Назад", callback_data=f'message_{context.user_data["messages_folder"]}'
-                                                                 f'_{message_id}')])
+            keyboard = [[InlineKeyboardButton('➡', callback_data=next_callback)]]
+    keyboard.append([InlineKeyboardButton("Назад", callback_data=encode(Action.VIEW, folder, message_id))])
     reply_markup = InlineKeyboardMarkup(keyboard)
-    query.edit_message_reply_markup(reply_markup)
+    query.edit_message_text(recipients, parse_mode=ParseMode.HTML, reply_markup=reply_markup)
     query.answer()
 
 
-def message_reply(update: Update, context: CallbackContext):
+def message_reply(update: Update, context: CallbackContext, args: ReplyArgs):
     query: CallbackQuery = update.callback_query
-    message_id = query.data.split('_')[-1]
-    folder = query.data.split('_')[-2]
+    message_id = args.msg_id
+    folder = args.folder
     ejuser = cte.get_cte(chat_id=query.message.chat.id)
     message = ejuser.get_message(message_id)
     result = parse_message(message=message)
     result += '\n\nНапишите ответное сообщение:'
     context.user_data['write_answer_message_id'] = query.message.message_id
-    query.edit_message_text(result, parse_mode=ParseMode.HTML)
     context.user_data['reply'] = message_id
-    context.user_data['reply_all'] = '_all_' in query.data
-    keyboard = [[InlineKeyboardButton('Отмена', callback_data=f'message_{folder}_{message_id}')]]
+    context.user_data['reply_all'] = args.reply_all
+    keyboard = [[InlineKeyboardButton('Отмена', callback_data=encode(Action.VIEW, folder, message_id))]]
     # if 'users_to' in message and len(message['users_to']) > 1:
     #     keyboard[0].insert(0, InlineKeyboardButton('[0] Ответ всем', callback_data=query.data.replace('reply_', 'reply_all_')))
     reply_markup = InlineKeyboardMarkup(keyboard)
-    query.edit_message_reply_markup(reply_markup)
+    query.edit_message_text(result, parse_mode=ParseMode.HTML, reply_markup=reply_markup)
     query.answer()
 
 
@@ -463,8 +567,8 @@ def just_message(update: Update, context: CallbackContext):
         message_id = context.user_data['reply']
         context.user_data['reply'] = None
         reply_text = update.message.text
-        keyboard = [[InlineKeyboardButton("Закрыть", callback_data='close'),
-                     InlineKeyboardButton("Сообщения", callback_data='page_inbox_it')]]
+        keyboard = [[InlineKeyboardButton("Закрыть", callback_data=encode(Action.CLOSE)),
+                     InlineKeyboardButton("Сообщения", callback_data=encode(Action.PAGE, MessageFolder.INBOX))]]
         reply_markup = InlineKeyboardMarkup(keyboard)
         if ejuser.reply_message(replyto=message_id, text=reply_text):
             message = ejuser.get_message(message_id)
@@ -486,28 +590,48 @@ def cache_full_messages_task():
         for chat_id in authorized_chat_ids:
             time_begin = time.time()
             try:
-                ejuser = cte.get_cte(chat_id=chat_id)
-                ejuser.cache_full_messages()
+                with operation('cache_full_messages'), handler_seconds.time(handler='cache_full_messages'):
+                    ejuser = cte.get_cte(chat_id=chat_id)
+                    ejuser.cache_full_messages()
             except Exception:
-                logger.error(f'Ошибка кэширования сообщений для {chat_id}, traceback:\n{traceback.format_exc()}')
-            logger.debug(f'Работа по кэшированию сообщений для {chat_id} завершена '
-                         f'за {(int(time.time() - time_begin) * 1000)} ms')
+                logger.exception('Ошибка кэширования сообщений для %s', chat_id, extra={'chat_id': chat_id})
+            logger.debug('Работа по кэшированию сообщений для %s завершена за %d ms', chat_id,
+                         (time.time() - time_begin) * 1000, extra={'chat_id': chat_id})
         time.sleep(MESSAGES_CACHE_DELAY)
 
 
-def update_messages(update: Update, context: CallbackContext):
+def update_messages(update: Update, context: CallbackContext, args: FolderArgs):
     query = update.callback_query
-    folder = query.data.split('_')[-1]
+    folder = args.folder
     ejuser = cte.get_cte(chat_id=query.message.chat.id)
-    ejuser.update_read_state(folder=folder)
+    try:
+        ejuser.update_read_state(folder=folder)
+    except requests.exceptions.RequestException as e:
+        logger.warning('Не удалось обновить сообщения %s, показываю кэш: %s', query.message.chat.id, e,
+                       extra={'chat_id': query.message.chat.id})
     context.user_data['messages_page'] = 1
     msgs = ejuser.get_messages(page=context.user_data['messages_page'], folder=folder)
     messages_s, reply_markup = messages_common_part(msgs=msgs, folder=folder, context=context, ejuser=ejuser)
-    query.edit_message_text(messages_s, parse_mode=ParseMode.HTML)
-    query.edit_message_reply_markup(reply_markup=reply_markup)
+    query.edit_message_text(messages_s, parse_mode=ParseMode.HTML, reply_markup=reply_markup)
     query.answer()
 
 
+def instrument(func: Callable) -> Callable:
+    """
+    Оборачивает обработчик или задачу учетом обращений к MongoDB, метрикой времени работы и корневым span'ом трассы
+    """
+    return timed(tracked(traced(func)))
+
+
+def log_db_stats(context: CallbackContext):
+    """
+    Пишет в лог количество и время обращений к MongoDB по обработчикам
+    """
+    for name, item in sorted(db_stats.snapshot().items(), key=lambda kv: -kv[1]['commands']):
+        logger.info('MongoDB: %s - %s вызовов, %s команд (%s на вызов), %s ms, %s', name, item['calls'],
+                    item['commands'], item['commands_per_call'], item['time_ms'], item['by_command'])
+
+
 def build_fallback(text: str) -> Callable:
     def fallback_func(update: Update, context: CallbackContext):
         update.message.reply_text(text)
@@ -515,29 +639,32 @@ def build_fallback(text: str) -> Callable:
     return fallback_func
 
 
-def star_handler(update: Update, context: CallbackContext):
+def star_handler(update: Update, context: CallbackContext, args: MessageArgs):
     query: CallbackQuery = update.callback_query
-    message_id = query.data.split('_')[-1]
-    folder = query.data.split('_')[-2]
+    message_id = args.msg_id
+    folder = args.folder
     ejuser = cte.get_cte(chat_id=query.message.chat.id)
+    cached = ejuser.get_message(msg_id=message_id, force_folder=folder, no_eljur_request=True)
+    if not cached or 'text' not in cached:
+        require_eljur()  # view_message загрузит сообщение: промах кэша - до изменения избранного, не после
     starred = ejuser.is_starred(msg_id=message_id, folder=folder)
     if starred:
         ejuser.unstar_message(msg_id=message_id, folder=folder)
-        query.answer(text='Убрано из избранных')
+        notice = 'Убрано из избранных'
     else:
         ejuser.star_message(msg_id=message_id, folder=folder)
-        query.answer(text='Добавлено в избранные')
-    view_message(update, context)
+        notice = 'Добавлено в избранные'
+    view_message(update, context, args, notice=notice)  # на нажатие можно ответить только один раз
 
 
-def starred_messages(update: Update, context: CallbackContext):
+def starred_messages(update: Update, context: CallbackContext, args: StarredArgs):
     query: CallbackQuery = update.callback_query
     ejuser = cte.get_cte(chat_id=query.message.chat.id)
-    folder = query.data.split('_')[-2]
+    folder = args.folder
     op_folder = opposite_folder(folder)
     starred = ejuser.starred_messages(folder)
     total = math.ceil(len(starred) / 6)
-    page = int(query.data.split('_')[-1])
+    page = args.page
     messages_s = f"Избранное {len(starred)} сообщений" \
                  f"- страница <b>{context.user_data['messages_page']}/{total}</b>\n"
     messages_s += present_messages(chat_id=ejuser.chat_id, msgs={"messages": starred[(page - 1) * 6:page * 6]},
@@ -546,83 +673,168 @@ def starred_messages(update: Update, context: CallbackContext):
     if page == 1:
         keyboard = [[]]
     else:
-        keyboard = [[InlineKeyboardButton('⬅', callback_data=f'starred_{folder}_{page - 1}')]]
+        keyboard = [[InlineKeyboardButton('⬅', callback_data=encode(Action.STARRED, folder, page - 1))]]
     if len(starred) - page * 6 > 0:
-        keyboard[0].insert(1, InlineKeyboardButton('➡', callback_data=f'starred_{folder}_{page + 1}'))
-    keyboard[0].insert(1, InlineKeyboardButton('Назад', callback_data=f'page_inbox_it'))
+        keyboard[0].insert(1, InlineKeyboardButton('➡', callback_data=encode(Action.STARRED, folder, page + 1)))
+    keyboard[0].insert(1, InlineKeyboardButton('Назад', callback_data=encode(Action.PAGE, MessageFolder.INBOX)))
     if page == 1 and len(ejuser.starred_messages(op_folder)) > 0:
         keyboard[0].insert(2, InlineKeyboardButton('⭐ ' + folder_to_string(op_folder),
-                                                   callback_data=f'starred_{op_folder}_1'))
+                                                   callback_data=encode(Action.STARRED, op_folder)))
     for i in range(0, 6, 3):
         keyboard.append([InlineKeyboardButton(str(label),
-                                              callback_data=f'message_{starred[label - 1]["folder"]}_'
-                                                            f'{starred[label - 1]["id"]}_{page}_starred')
+                                              callback_data=encode(Action.VIEW, starred[label - 1].folder,
+                                                                   starred[label - 1].id, Origin.STARRED, page))
                          for label in range(i + 1, i + 4) if label - 1 < len(starred)])
     reply_markup = InlineKeyboardMarkup(keyboard)
     query.answer(text='Избранные сообщения')
-    query.edit_message_text(text=messages_s, parse_mode=ParseMode.HTML)
-    query.edit_message_reply_markup(reply_markup=reply_markup)
+    query.edit_message_text(text=messages_s, parse_mode=ParseMode.HTML, reply_markup=reply_markup)
+
+
+def search_results(ejuser: CachedTelegramEljur, search_query: str, page: int):
+    found = ejuser.search(search_query)
+    if not found:
+        return f'По запросу «{escape(search_query)}» ничего не найдено', None
+    total = math.ceil(len(found) / 6)
+    page = min(max(1, page), total)
+    msgs = ejuser.messages_by_keys(found[(page - 1) * 6:page * 6])
+    messages_s = f"Поиск «{escape(search_query)}»: {len(found)} сообщений " \
+                 f"- страница <b>{page}/{total}</b>\n"
+    messages_s += present_messages(chat_id=ejuser.chat_id, msgs={"messages": msgs}, folder='both')
+    messages_s = messages_s[:-1]
+    keyboard = [[]]
+    if page > 1:
+        keyboard[0].append(InlineKeyboardButton('⬅', callback_data=encode(Action.SEARCH, page - 1)))
+    keyboard[0].append(InlineKeyboardButton('Назад', callback_data=encode(Action.PAGE, MessageFolder.INBOX)))
+    if len(found) - page * 6 > 0:
+        keyboard[0].append(InlineKeyboardButton('➡', callback_data=encode(Action.SEARCH, page + 1)))
+    for i in range(0, len(msgs), 3):
+        keyboard.append([InlineKeyboardButton(str(label),
+                                              callback_data=encode(Action.VIEW, msgs[label - 1].folder,
+                                                                   msgs[label - 1].id, Origin.SEARCH, page))
+                         for label in range(i + 1, i + 4) if label - 1 < len(msgs)])
+    return messages_s, InlineKeyboardMarkup(keyboard)
 
 
-if __name__ == '__main__':
-    persistence = PicklePersistence(filename=str(data_dir / 'persistence.pickle'))
-    updater: Updater = Updater(os.environ["token"], use_context=True, persistence=persistence)
-
-    callback_queries = [
-        {'callback': login_handler, 'pattern': '^login$'},
-        {'callback': homework_handler, 'pattern': '^homework_[0-9.]*$'},
-        {'callback': messages_page_handler, 'pattern': '^(page_inbox_|page_sent_|page_unread_)(prev|next|it|[0-9]*)*$'},
-        {'callback': view_message,
-         'pattern': '^(message_inbox_|message_sent_|message_view_new_)[0-9]*(|_[0-9]*_starred{1})$'},
-        {'callback': message_reply, 'pattern': '^(reply_inbox_|reply_sent_|reply_all_inbox_|reply_all_sent_)[0-9]*$'},
-        {'callback': update_messages, 'pattern': '^(update_inbox|update_sent)$'},
-        {'callback': message_recipients, 'pattern': '^(recipients_inbox_|recipients_sent_)[0-9]*_(prev|next|it)$'},
-        {'callback': close_message, 'pattern': '^close$'},
-        {'callback': star_handler, 'pattern': '^(star_inbox_|star_sent_|unstar_inbox_|unstar_sent_)[0-9]*$'},
-        {'callback': starred_messages, 'pattern': '^starred_(inbox|sent)_[0-9]*$'},
+def search_handler(update: Update, context: CallbackContext):
+    search_query = ' '.join(context.args or [])
+    if not search_query:
+        update.message.reply_text('Напишите запрос после команды, например: /search физика экзамен')
+        return
+    context.user_data['search_query'] = search_query
+    ejuser = cte.get_cte(chat_id=update.message.chat.id)
+    messages_s, reply_markup = search_results(ejuser=ejuser, search_query=search_query, page=1)
+    update.message.reply_text(messages_s, parse_mode=ParseMode.HTML, reply_markup=reply_markup)
+
+
+def search_page_handler(update: Update, context: CallbackContext, args: SearchArgs):
+    query: CallbackQuery = update.callback_query
+    search_query = context.user_data.get('search_query')
+    if not search_query:
+        query.answer(text='Повторите поиск командой /search')
+        return
+    ejuser = cte.get_cte(chat_id=query.message.chat.id)
+    page = args.page
+    messages_s, reply_markup = search_results(ejuser=ejuser, search_query=search_query, page=page)
+    query.edit_message_text(messages_s, parse_mode=ParseMode.HTML, reply_markup=reply_markup)
+    query.answer()
+
+
+def add_handlers(dispatcher: Dispatcher) -> None:
+    """
+    Регистрирует обработчики бота в диспетчере
+    """
+    # cache_pool - обработчики, работающие с кэшем, eljur_pool - обработчики, обращающиеся к элжуру.
+    # Обработчик cache_pool, которому нужен элжур (сообщения или счетчика нет в базе), перезапускается в eljur_pool
+    callback_routes = [
+        {'callback': homework_handler, 'action': Action.HOMEWORK, 'pool': eljur_pool},
+        {'callback': messages_page_handler, 'action': Action.PAGE, 'pool': cache_pool},
+        {'callback': view_message, 'action': Action.VIEW, 'pool': cache_pool},
+        {'callback': message_reply, 'action': Action.REPLY, 'pool': cache_pool},
+        {'callback': update_messages, 'action': Action.UPDATE, 'pool': eljur_pool},
+        {'callback': message_recipients, 'action': Action.RECIPIENTS, 'pool': cache_pool},
+        {'callback': close_message, 'action': Action.CLOSE, 'pool': cache_pool},
+        {'callback': file_handler, 'action': Action.FILE, 'pool': eljur_pool},
+        {'callback': star_handler, 'action': Action.STAR, 'pool': cache_pool},
+        {'callback': starred_messages, 'action': Action.STARRED, 'pool': cache_pool},
+        {'callback': search_page_handler, 'action': Action.SEARCH, 'pool': cache_pool},
     ]
-    for param in callback_queries:
-        updater.dispatcher.add_handler(CallbackQueryHandler(**param))
-    updater.dispatcher.add_error_handler(error)
+    router = CallbackRouter()
+    for param in callback_routes:
+        router.add(param['action'], param['pool'].wrap(instrument(param['callback'])))
+    dispatcher.add_handler(CallbackQueryHandler(callback=router.dispatch))
+    dispatcher.add_error_handler(error)
 
     conv_handler = ConversationHandler(
-        entry_points=[CommandHandler('start', start),
-                      MessageHandler(Filters.regex('Попробовать ещё раз'), login_handler)],
+        entry_points=[CommandHandler('start', instrument(start)),
+                      MessageHandler(Filters.regex('Попробовать ещё раз'), instrument(login_handler))],
         states={
-            CHOOSE_VENDOR: [MessageHandler(Filters.regex('(Физтех-Лицей|Другая школа)'), vendor_handler),
+            CHOOSE_VENDOR: [MessageHandler(Filters.regex('(Физтех-Лицей|Другая школа)'),
+                                           instrument(vendor_handler)),
                             MessageHandler(Filters.text, build_fallback('Выберите школу'))],
-            INPUT_VENDOR: [CommandHandler('stop', stop), MessageHandler(Filters.text, user_send_vendor)],
+            INPUT_VENDOR: [CommandHandler('stop', instrument(stop)),
+                           MessageHandler(Filters.text, instrument(user_send_vendor))],
             # LOGIN: [MessageHandler(Filters.regex('Войти в элжур'), login_handler)],
-            WAIT_LOGIN: [CommandHandler('stop', stop), MessageHandler(Filters.text, user_send_login)],
-            WAIT_PASSWORD: [CommandHandler('stop', stop), MessageHandler(Filters.text, user_send_password)],
-            MAIN_MENU: [MessageHandler(Filters.regex('Домашнее задание'), homework),
-                        MessageHandler(Filters.regex('Сообщения'), messages_handler),
-                        MessageHandler(Filters.regex('Оценки'), marks_handler),
-                        CommandHandler('stop', stop),
-                        MessageHandler(Filters.text, just_message)],
+            WAIT_LOGIN: [CommandHandler('stop', instrument(stop)),
+                         MessageHandler(Filters.text, instrument(user_send_login))],
+            WAIT_PASSWORD: [CommandHandler('stop', instrument(stop)),
+                            MessageHandler(Filters.text, eljur_pool.wrap(instrument(user_send_password)))],
+            MAIN_MENU: [MessageHandler(Filters.regex('Домашнее задание'), eljur_pool.wrap(instrument(homework))),
+                        MessageHandler(Filters.regex('Сообщения'), cache_pool.wrap(instrument(messages_handler))),
+                        MessageHandler(Filters.regex('Оценки'), eljur_pool.wrap(instrument(marks_handler))),
+                        CommandHandler('stop', instrument(stop)),
+                        CommandHandler('search', cache_pool.wrap(instrument(search_handler))),
+                        MessageHandler(Filters.text, eljur_pool.wrap(instrument(just_message)))],
         },
-        fallbacks=[CommandHandler('stop', stop)],
+        fallbacks=[CommandHandler('stop', instrument(stop))],
         name="bot_conversation",
         persistent=True,
         per_message=False
     )
 
-    updater.dispatcher.add_handler(conv_handler)
+    dispatcher.add_handler(conv_handler)
+
+
+if __name__ == '__main__':
+    if migration_pending():  # бот читает только v2: без переноса каждый пользователь заново загрузил бы ящик
+        logger.error('Перенос сообщений в схему v2 не завершен, запустите python migrate_v2.py')
+        raise SystemExit(1)
+    persistence = PicklePersistence(filename=str(data_dir / 'persistence.pickle'))
+    bot = Bot(os.environ["token"], request=TracedRequest(con_pool_size=8))  # как у Updater по умолчанию: workers + 4
+    updater: Updater = Updater(bot=bot, use_context=True, persistence=persistence)
+
+    add_handlers(updater.dispatcher)
     authorized_chat_ids = [user['chat_id'] for user in data.find({})]
     job_queue: JobQueue = updater.job_queue
 
     for uid in authorized_chat_ids:
-        job_queue.run_repeating(check_for_new_messages,
+        job_queue.run_repeating(instrument(check_for_new_messages),
                                 interval=MESSAGES_CHECK_DELAY,
                                 first=MESSAGES_CHECK_DELAY,
                                 context=uid,
                                 name=f'new_messages:{uid}')
+        job_queue.run_repeating(instrument(sync_read_state),
+                                interval=READ_STATE_SYNC_DELAY,
+                                first=READ_STATE_SYNC_DELAY,
+                                context=uid,
+                                name=f'read_state:{uid}')
+
+    job_queue.run_repeating(instrument(refresh_tokens), interval=TOKEN_REFRESH_DELAY, first=60, name='refresh_tokens')
+    job_queue.run_repeating(log_db_stats, interval=DB_STATS_LOG_DELAY, first=DB_STATS_LOG_DELAY, name='db_stats')
 
     Thread(target=cache_full_messages_task, daemon=True, name='Cache-Full').start()
+    serve_metrics(METRICS_PORT)
 
     # Запуск бота
-    updater.start_polling()
+    if BOT_MODE == 'webhook':
+        webhook = WebhookServer(updater.dispatcher, secret=os.environ['webhook_secret'],
+                                host=WEBHOOK_HOST, port=WEBHOOK_PORT)
+        webhook.start()
+        job_queue.start()
+        updater.bot.set_webhook(url=os.environ['webhook_url'], secret_token=os.environ['webhook_secret'])
+        webhook.idle()
+    else:
+        updater.start_polling()
 
-    # Работать пока пользователь не нажмет Ctrl-C или процесс получит SIGINT,
-    # SIGTERM or SIGABRT
-    updater.idle()
+        # Работать пока пользователь не нажмет Ctrl-C или процесс получит SIGINT,
+        # SIGTERM or SIGABRT
+        updater.idle()
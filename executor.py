@@ -0,0 +1,201 @@
+import logging
+import threading
+import time
+from concurrent.futures.thread import ThreadPoolExecutor
+from contextlib import contextmanager
+from functools import wraps
+from threading import BoundedSemaphore, Condition, Lock
+from typing import Callable, Optional
+
+from telegram import Update, TelegramError
+from telegram.ext import CallbackContext
+from telegram.ext.utils.promise import Promise
+
+from constants import CACHE_HANDLER_THREADS, ELJUR_HANDLER_THREADS, ELJUR_HANDLER_QUEUE, ELJUR_HANDLER_TIMEOUT
+from dbstats import bind
+from metrics import registry
+
+logger = logging.getLogger('BOT')
+_local = threading.local()
+
+handler_rejected_total = registry.counter('handler_rejected_total',
+                                          'Обновления, отклоненные из-за переполнения или ожидания в пуле', ('pool',))
+handler_fallback_total = registry.counter('handler_fallback_total',
+                                          'Обновления, переданные из пула кэша в пул элжура из-за промаха кэша',
+                                          ('pool',))
+BUSY_TEXT = 'Элжур сейчас отвечает медленно, попробуйте позднее'
+UNAVAILABLE_TEXT = 'Элжур сейчас недоступен, попробуйте позднее'
+
+
+def notify_busy(update: Update, text: str = BUSY_TEXT) -> None:
+    """
+    Сообщает пользователю, что запрос не может быть выполнен сейчас
+    """
+    try:
+        if update.callback_query:
+            update.callback_query.answer(text=text)
+        elif update.effective_message:
+            update.effective_message.reply_text(text)
+    except TelegramError as e:
+        logger.warning('Не удалось сообщить о занятости: %s', e)
+
+
+class CacheMiss(Exception):
+    """
+    Обработчику из пула кэша нужен элжур: сообщения или счетчика сообщений еще нет в базе
+    """
+
+
+@contextmanager
+def cache_only():
+    """
+    Запрещает обращения к элжуру внутри блока: require_eljur бросает CacheMiss
+    """
+    previous = getattr(_local, 'cache_only', False)
+    _local.cache_only = True
+    try:
+        yield
+    finally:
+        _local.cache_only = previous
+
+
+def require_eljur() -> None:
+    """
+    Вызывается перед обращением к элжуру в коде, который выполняют и обработчики пула кэша
+    :raises CacheMiss: поток выполняет обработчик пула кэша - обработчик будет перезапущен в пуле элжура
+    """
+    if getattr(_local, 'cache_only', False):
+        raise CacheMiss()
+
+
+class FallbackPromise(Promise):
+    """
+    Promise обработчика пула с запасным пулом: сначала обработчик выполняется без обращений к элжуру (cache_only).
+    Если ему нужен элжур (CacheMiss), Promise не завершается, а передается в запасной пул (handoff) и выполняется там
+    заново, уже с элжуром. Обработчик должен до обращения к элжуру только читать базу и context.user_data
+    """
+    __slots__ = ('handoff',)
+
+    def __init__(self, pooled_function: Callable, args: list, update: Update,
+                 handoff: Callable[['FallbackPromise'], None]):
+        super().__init__(pooled_function, args, {}, update=update)
+        self.handoff: Optional[Callable[['FallbackPromise'], None]] = handoff
+
+    def run(self) -> None:
+        if self.handoff is None:  # уже в запасном пуле
+            super().run()
+            return
+        try:
+            with cache_only():
+                self._result = self.pooled_function(*self.args, **self.kwargs)
+        except CacheMiss:
+            handoff, self.handoff = self.handoff, None
+            handoff(self)
+            return
+        except Exception as exc:
+            self._exception = exc
+        self.done.set()
+        if self._exception is None and self._done_callback:
+            try:
+                self._done_callback(self._result)
+            except Exception as exc:
+                logger.warning('done_callback обработчика %s завершился ошибкой: %s', self.pooled_function.__name__,
+                               exc)
+
+
+class HandlerPool:
+    """
+    Пул потоков для одного класса обработчиков Telegram.
+    Обработчики выполняются вне потока диспетчера, поэтому медленный элжур не задерживает остальные обновления.
+    Обработчик возвращает Promise, так что ConversationHandler продолжает корректно переключать состояния
+    """
+
+    def __init__(self, name: str, workers: int, max_pending: Optional[int] = None, timeout: Optional[float] = None,
+                 fallback: Optional['HandlerPool'] = None):
+        """
+        :param name: имя пула (для потоков и метрик)
+        :param workers: количество потоков
+        :param max_pending: максимум обновлений в работе и в очереди, сверх него обновления отклоняются
+        :param timeout: максимальное время ожидания в очереди, после него обновление отклоняется
+        :param fallback: пул, в котором перезапускаются обработчики, которым нужен элжур (см. FallbackPromise);
+        без него обработчики этого пула обращаются к элжуру сами
+        """
+        self.name = name
+        self.timeout = timeout
+        self.fallback = fallback
+        self._executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix=name)
+        self._slots = BoundedSemaphore(max_pending) if max_pending else None
+        self._pending = 0
+        self._lock = Lock()
+        self._idle = Condition(self._lock)
+        registry.gauge(f'{name}_pool_pending', f'Обновления в работе и в очереди пула {name}',
+                       function=lambda: self._pending)
+
+    def _run(self, promise: Promise, context: CallbackContext, submitted: float) -> None:
+        try:
+            if self.timeout and time.monotonic() - submitted > self.timeout:
+                handler_rejected_total.inc(pool=self.name)
+                logger.warning('Обработчик %s ждал в пуле %s дольше %s с и отменен', promise.pooled_function.__name__,
+                               self.name, self.timeout)
+                notify_busy(promise.update)
+                promise.done.set()
+                return
+            promise.run()
+            if promise.exception is not None:
+                context.dispatcher.dispatch_error(promise.update, promise.exception, promise=promise)
+        finally:
+            with self._lock:
+                self._pending -= 1
+                if not self._pending:
+                    self._idle.notify_all()
+            if self._slots:
+                self._slots.release()
+
+    def submit(self, promise: Promise, context: CallbackContext) -> bool:
+        """
+        Ставит Promise обработчика в очередь пула
+        :return: False, если пул переполнен и обновление отклонено
+        """
+        if self._slots and not self._slots.acquire(blocking=False):
+            handler_rejected_total.inc(pool=self.name)
+            notify_busy(promise.update)
+            return False
+        with self._lock:
+            self._pending += 1
+        self._executor.submit(bind(self._run), promise, context, time.monotonic())
+        return True
+
+    def wrap(self, func: Callable) -> Callable:
+        """
+        Оборачивает обработчик так, чтобы он выполнялся в этом пуле. Аргументы после update и context
+        (например, разобранные данные кнопки) передаются обработчику
+        """
+
+        @wraps(func)
+        def wrapper(update: Update, context: CallbackContext, *args) -> Optional[Promise]:
+            if self.fallback is None:
+                promise = Promise(func, [update, context, *args], {}, update=update)
+            else:
+                def handoff(retried: FallbackPromise) -> None:
+                    handler_fallback_total.inc(pool=self.name)
+                    if not self.fallback.submit(retried, context):
+                        retried.done.set()  # обновление отклонено, состояние разговора не меняется
+
+                promise = FallbackPromise(func, [update, context, *args], update=update, handoff=handoff)
+            return promise if self.submit(promise, context) else None
+
+        return wrapper
+
+    def wait_idle(self, timeout: Optional[float] = None) -> bool:
+        """
+        Ждет, пока в пуле не останется обработчиков в работе и в очереди
+        :return: False, если за timeout секунд пул не освободился
+        """
+        with self._idle:
+            return self._idle.wait_for(lambda: not self._pending, timeout=timeout)
+
+
+eljur_pool = HandlerPool('eljur', workers=ELJUR_HANDLER_THREADS, max_pending=ELJUR_HANDLER_QUEUE,
+                         timeout=ELJUR_HANDLER_TIMEOUT)  # обработчики, обращающиеся к элжуру
+# обработчики, отвечающие из базы; при промахе кэша обработчик перезапускается в eljur_pool
+cache_pool = HandlerPool('cache', workers=CACHE_HANDLER_THREADS, fallback=eljur_pool)
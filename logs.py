@@ -0,0 +1,168 @@
+"""
+Настройка логов бота.
+
+Записи не пишутся в файл и stderr в потоке, который их создал: QueueLogHandler кладет запись в очередь, а запись
+на диск и форматирование строк выполняет фоновый поток QueueListener. Поэтому медленный диск или заблокированный
+stderr не задерживают обработчики и опрос элжура. Если очередь переполнена, запись отбрасывается.
+
+Частые события ограничиваются до постановки в очередь:
+- записи с extra={'event': ...} из LOG_SAMPLE_RATES записываются с заданной вероятностью (кроме предупреждений
+  и ошибок), в записи сохраняется sample_rate;
+- записи с extra={'chat_id': ...} - не больше LOG_USER_LIMIT за LOG_USER_WINDOW секунд на пользователя (кроме
+  ошибок), число пропущенных записей попадает в поле suppressed первой записи следующего окна.
+
+Файл лога пишется текстом или, при LOG_FORMAT = json, строкой JSON на запись с полями time, level, logger, message
+и полями extra (chat_id, event, trace_id, ...).
+"""
+import atexit
+import copy
+import logging
+import random
+import time
+from datetime import datetime
+from logging.handlers import QueueHandler, QueueListener
+from queue import Queue, Full
+from threading import Lock
+from typing import Any, Dict, List, Optional
+
+import tracing
+from codec import dumps
+from constants import LOG_FORMAT, LOG_QUEUE_SIZE, LOG_USER_LIMIT, LOG_USER_WINDOW, LOG_SAMPLE_RATES
+from metrics import registry
+
+TEXT_FORMAT = '%(asctime)s - %(name)s - %(levelname)s - %(message)s'
+STREAM_LOGGERS = ('BOT', 'CachedTelegramEljur')  # логгеры, которые дублируются в stderr
+STANDARD_FIELDS = set(vars(logging.makeLogRecord({}))) | {'message', 'asctime'}
+
+log_records_dropped_total = registry.counter('log_records_dropped_total',
+                                             'Записи лога, отброшенные до записи: sampled, rate_limited, queue_full',
+                                             ('reason',))
+
+_listener: Optional[QueueListener] = None
+_handler: Optional[logging.Handler] = None
+
+
+class JsonFormatter(logging.Formatter):
+    def format(self, record: logging.LogRecord) -> str:
+        item = {'time': datetime.fromtimestamp(record.created).isoformat(timespec='milliseconds'),
+                'level': record.levelname, 'logger': record.name, 'message': record.getMessage()}
+        for key, value in vars(record).items():
+            if key not in STANDARD_FIELDS and value is not None:
+                item[key] = value if isinstance(value, (str, int, float, bool)) else str(value)
+        if record.exc_info and not record.exc_text:
+            record.exc_text = self.formatException(record.exc_info)
+        if record.exc_text:
+            item['exception'] = record.exc_text
+        return dumps(item)
+
+
+class EventFilter(logging.Filter):
+    """
+    Прореживание частых событий и ограничение числа записей об одном пользователе
+    """
+
+    def __init__(self, sample_rates: Dict[str, float] = None, limit: int = LOG_USER_LIMIT,
+                 window: float = LOG_USER_WINDOW):
+        super().__init__()
+        self.sample_rates = LOG_SAMPLE_RATES if sample_rates is None else sample_rates
+        self.limit = limit
+        self.window = window
+        self._users: Dict[Any, List[float]] = dict()  # chat_id -> [начало окна, записей в окне, пропущено]
+        self._lock = Lock()
+
+    def filter(self, record: logging.LogRecord) -> bool:
+        event = getattr(record, 'event', None)
+        if event in self.sample_rates and record.levelno < logging.WARNING:
+            if random.random() >= self.sample_rates[event]:
+                log_records_dropped_total.inc(reason='sampled')
+                return False
+            record.sample_rate = self.sample_rates[event]
+        chat_id = getattr(record, 'chat_id', None)
+        if chat_id is None or record.levelno >= logging.ERROR:
+            return True
+        now = time.monotonic()
+        with self._lock:
+            state = self._users.get(chat_id)
+            if state is None or now - state[0] >= self.window:
+                suppressed = state[2] if state else 0
+                state = self._users[chat_id] = [now, 0, 0]
+                if suppressed:
+                    record.suppressed = suppressed
+            if state[1] >= self.limit:
+                state[2] += 1
+                log_records_dropped_total.inc(reason='rate_limited')
+                return False
+            state[1] += 1
+        return True
+
+
+class QueueLogHandler(QueueHandler):
+    """
+    Передает записи фоновому потоку. В потоке, создавшем запись, только подставляются аргументы сообщения
+    и запоминается трасса, остальное форматирование выполняется при записи
+    """
+
+    def prepare(self, record: logging.LogRecord) -> logging.LogRecord:
+        record = copy.copy(record)
+        record.msg = record.getMessage()
+        record.args = None
+        if record.exc_info:  # traceback держит кадры стека, в очередь передается текст
+            record.exc_text = logging.Formatter().formatException(record.exc_info)
+            record.exc_info = None
+        active = tracing.current()
+        if active is not None:
+            record.trace_id = active.trace.trace_id
+        return record
+
+    def enqueue(self, record: logging.LogRecord) -> None:
+        try:
+            self.queue.put_nowait(record)
+        except Full:
+            log_records_dropped_total.inc(reason='queue_full')
+
+
+def setup(path: str, level: int = logging.INFO, fmt: str = LOG_FORMAT, stream: bool = True) -> None:
+    """
+    Направляет записи всех логгеров через очередь в файл path и, для STREAM_LOGGERS, в stderr
+    :param path: файл лога
+    :param level: минимальный уровень записей
+    :param fmt: формат файла лога: text или json
+    :param stream: дублировать записи STREAM_LOGGERS в stderr
+    """
+    global _listener, _handler
+    stop()
+    file_handler = logging.FileHandler(path, encoding='utf-8')
+    file_handler.setFormatter(JsonFormatter() if fmt == 'json' else logging.Formatter(TEXT_FORMAT))
+    handlers = [file_handler]
+    if stream:
+        stream_handler = logging.StreamHandler()
+        stream_handler.setFormatter(logging.Formatter(TEXT_FORMAT))
+        stream_handler.addFilter(lambda record: record.name in STREAM_LOGGERS)
+        handlers.append(stream_handler)
+    queue = Queue(LOG_QUEUE_SIZE)
+    _handler = QueueLogHandler(queue)
+    _handler.addFilter(EventFilter())
+    _listener = QueueListener(queue, *handlers, respect_handler_level=True)
+    _listener.start()
+    root = logging.getLogger()
+    root.addHandler(_handler)
+    root.setLevel(level)
+    logging.getLogger('requests').setLevel(logging.WARNING)
+
+
+def stop() -> None:
+    """
+    Дописывает записи из очереди и отключает обработчик, установленный setup
+    """
+    global _listener, _handler
+    if _handler is not None:
+        logging.getLogger().removeHandler(_handler)
+        _handler = None
+    if _listener is not None:
+        _listener.stop()
+        for handler in _listener.handlers:
+            handler.close()
+        _listener = None
+
+
+atexit.register(stop)
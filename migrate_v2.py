@@ -0,0 +1,100 @@
+"""
+Перенос сообщений из схемы v1 (коллекция messages) в компактную схему v2 (коллекция messages_v2).
+
+Документы читаются пачками по _id и записываются неупорядоченным bulk_write. После каждой пачки
+_id последнего перенесенного документа сохраняется в коллекции migrations, поэтому прерванный перенос
+продолжается с места остановки. Сообщения, уже записанные ботом в v2, не перезаписываются, но получают из v1
+то, чего в них нет: отметку избранного и полный текст (вместе с подготовленным текстом, получателями и вложениями).
+
+Бот не запускается, пока в v1 есть сообщения, а перенос не завершен (database.migration_pending).
+
+Запуск: python migrate_v2.py [--batch 1000] [--drop-legacy]
+"""
+import argparse
+import logging
+import time
+from typing import Dict, Any, Optional
+
+from pymongo import UpdateOne
+
+from database import db, legacy_messages, messages, migrations, MESSAGES_V2_MIGRATION
+from storage import pack, plain_field
+
+logger = logging.getLogger('migrate_v2')
+MIGRATION = MESSAGES_V2_MIGRATION
+FULL_FIELDS = {'t', 'h', 'rs', 'fl'}  # поля полного сообщения (короткие имена без признака сжатия)
+
+
+def collection_size(name: str) -> Optional[Dict[str, Any]]:
+    """
+    :return: размер данных и индексов коллекции или None, если база не поддерживает collStats
+    """
+    try:
+        stats = db.command('collStats', name)
+    except Exception:
+        return None
+    return {key: stats.get(key, 0) for key in ('count', 'size', 'storageSize', 'totalIndexSize', 'avgObjSize')}
+
+
+def migrate(batch_size: int = 1000) -> int:
+    """
+    Переносит сообщения из v1 в v2
+    :param batch_size: документов в одной пачке
+    :return: количество перенесенных за этот запуск документов
+    """
+    state = migrations.find_one({'_id': MIGRATION}) or {}
+    last_id = state.get('last_id')
+    moved = 0
+    begin = time.time()
+    while True:
+        query = {'_id': {'$gt': last_id}} if last_id is not None else {}
+        batch = list(legacy_messages.find(query).sort('_id', 1).limit(batch_size))
+        if not batch:
+            break
+        operations = []
+        for document in batch:
+            packed = pack(document)
+            packed.pop('_id', None)
+            key = {'c': packed.pop('c'), 'f': packed.pop('f'), 'i': packed.pop('i')}
+            operations.append(UpdateOne(key, {'$setOnInsert': packed}, upsert=True))
+            # документ мог быть записан ботом до переноса - дополняется тем, чего в нем нет
+            full = {short: value for short, value in packed.items() if plain_field(short) in FULL_FIELDS}
+            if full:
+                operations.append(UpdateOne({**key, 't': {'$exists': False}, 'tz': {'$exists': False}},
+                                            {'$set': full}))
+            if 'sr' in packed:
+                operations.append(UpdateOne({**key, 'sr': {'$exists': False}}, {'$set': {'sr': packed['sr']}}))
+        messages.bulk_write(operations, ordered=False)
+        last_id = batch[-1]['_id']
+        moved += len(batch)
+        migrations.update_one({'_id': MIGRATION}, {'$set': {'last_id': last_id}, '$inc': {'moved': len(batch)}},
+                              upsert=True)
+        logger.info('Перенесено %s сообщений (%d в секунду)', moved, moved / max(time.time() - begin, 1e-3))
+    migrations.update_one({'_id': MIGRATION}, {'$set': {'finished': time.time()}}, upsert=True)
+    return moved
+
+
+def report() -> None:
+    before, after = collection_size(legacy_messages.name), collection_size(messages.name)
+    if not before or not after:
+        logger.info('Размеры коллекций недоступны (collStats не поддерживается)')
+        return
+    for key in ('size', 'storageSize', 'totalIndexSize', 'avgObjSize'):
+        saved = 1 - after[key] / before[key] if before[key] else 0
+        logger.info('%s: %s -> %s (%.0f%% экономии)', key, before[key], after[key], saved * 100)
+
+
+if __name__ == '__main__':
+    logging.basicConfig(format='%(asctime)s - %(name)s - %(levelname)s - %(message)s', level=logging.INFO)
+    parser = argparse.ArgumentParser(description='Перенос сообщений в компактную схему v2')
+    parser.add_argument('--batch', type=int, default=1000, help='документов в одной пачке')
+    parser.add_argument('--drop-legacy', action='store_true', help='удалить коллекцию v1 после переноса')
+    args = parser.parse_args()
+    migrate(batch_size=args.batch)
+    report()
+    if args.drop_legacy:
+        if legacy_messages.estimated_document_count() > messages.collection.estimated_document_count():
+            logger.error('В v2 меньше документов, чем в v1 - коллекция v1 не удалена')
+        else:
+            legacy_messages.drop()
+            logger.info('Коллекция v1 удалена')
@@ -0,0 +1,143 @@
+import logging
+import time
+from queue import Queue
+from threading import Lock, Thread, Timer
+from typing import Dict, Set
+
+from telegram import Bot, TelegramError
+
+from CachedTelegramEljur import CachedTelegramEljur
+from constants import MessageFolder, ONBOARDING_PAGE_DELAY, ONBOARDING_PROGRESS_INTERVAL, ONBOARDING_RETRY_DELAY, \
+    ONBOARDING_RETRIES
+from dbstats import operation
+from metrics import registry, handler_seconds, telegram_send_failures_total
+
+logger = logging.getLogger('CachedTelegramEljur')
+
+FOLDER_NAMES = {MessageFolder.INBOX: 'входящих', MessageFolder.SENT: 'отправленных'}
+
+
+class Progress:
+    """
+    Сообщение пользователю о ходе первичной загрузки, обновляется не чаще ONBOARDING_PROGRESS_INTERVAL
+    """
+
+    def __init__(self, bot: Bot, chat_id: int, message_id: int):
+        self.bot = bot
+        self.chat_id = chat_id
+        self.message_id = message_id
+        self.loaded: Dict[str, int] = dict()
+        self.total: Dict[str, int] = dict()
+        self._shown = 0.0
+
+    def _counts(self) -> str:
+        return ', '.join(f'{FOLDER_NAMES[folder]} {self.loaded[folder]} из {self.total[folder]}'
+                         for folder in self.loaded)
+
+    def _edit(self, text: str) -> None:
+        try:
+            self.bot.edit_message_text(text, chat_id=self.chat_id, message_id=self.message_id)
+        except TelegramError as e:
+            telegram_send_failures_total.inc(method='edit_message_text')
+            logger.warning('Не удалось обновить ход загрузки для %s: %s', self.chat_id, e,
+                           extra={'chat_id': self.chat_id})
+
+    def page(self, folder: str, loaded: int, total: int) -> None:
+        """
+        Вызывается после записи каждой страницы. Пауза между страницами оставляет элжур и базу
+        обработчикам пользователей
+        """
+        self.loaded[folder] = loaded
+        self.total[folder] = total
+        if time.monotonic() - self._shown >= ONBOARDING_PROGRESS_INTERVAL:
+            self._shown = time.monotonic()
+            self._edit(f'⏳ Загружаю историю сообщений: {self._counts()}. Бот уже можно использовать')
+        time.sleep(ONBOARDING_PAGE_DELAY)
+
+    def finish(self) -> None:
+        self._edit(f'✅ История сообщений загружена: {self._counts() or "сообщений нет"}')
+
+    def fail(self, retry: bool) -> None:
+        self._edit('Не удалось загрузить всю историю сообщений, ' +
+                   ('загрузка продолжится позже' if retry else 'попробуйте позднее'))
+
+
+class Onboarding:
+    """
+    Фоновая первичная загрузка сообщений новых пользователей. Обработчик входа загружает только первую страницу
+    входящих, остальное загружается здесь в одном потоке, чтобы не занимать потоки диспетчера и пулов
+    """
+
+    def __init__(self):
+        self._queue = Queue()
+        self._queued: Set[int] = set()
+        self._lock = Lock()
+        self._started = False
+        registry.gauge('onboarding_queue_depth', 'Пользователи, ожидающие фоновой первичной загрузки',
+                       function=lambda: self._queue.qsize())
+
+    def _start(self) -> None:
+        with self._lock:
+            if self._started:
+                return
+            self._started = True
+        Thread(target=self._work, daemon=True, name='Onboarding').start()
+
+    def start(self, bot: Bot, ejuser: CachedTelegramEljur, message_id: int, attempt: int = 1) -> bool:
+        """
+        Ставит полную загрузку сообщений пользователя в очередь
+        :param bot: бот для сообщений о ходе загрузки
+        :param ejuser: пользователь
+        :param message_id: сообщение, в котором показывается ход загрузки
+        :param attempt: номер попытки, прерванная загрузка продолжается с контрольной точки
+        :return: False, если загрузка пользователя уже в очереди
+        """
+        with self._lock:
+            if ejuser.chat_id in self._queued:
+                return False
+            self._queued.add(ejuser.chat_id)
+        self._queue.put((bot, ejuser, message_id, attempt))
+        self._start()
+        return True
+
+    def _retry(self, progress: Progress, bot: Bot, ejuser: CachedTelegramEljur, message_id: int,
+               attempt: int) -> None:
+        """
+        Сообщает о неудачной загрузке и, если попытки не исчерпаны, через ONBOARDING_RETRY_DELAY ставит загрузку
+        в очередь снова - она продолжится с контрольной точки
+        """
+        retry = attempt < ONBOARDING_RETRIES
+        progress.fail(retry=retry)
+        if retry:
+            timer = Timer(ONBOARDING_RETRY_DELAY, self.start, args=[bot, ejuser, message_id, attempt + 1])
+            timer.daemon = True
+            timer.start()
+
+    def _work(self) -> None:
+        while True:
+            bot, ejuser, message_id, attempt = self._queue.get()
+            progress = Progress(bot, ejuser.chat_id, message_id)
+            try:
+                with operation('onboarding'), handler_seconds.time(handler='onboarding'):
+                    begin = time.time()
+                    # идущая проверка новых сообщений не пропускает загрузку: она начнется после проверки
+                    ejuser.download_messages_preview(check_new_only=False, folder=MessageFolder.INBOX,
+                                                     on_page=progress.page, wait=True)
+                if ejuser.user_data('sync_checkpoint'):  # загрузка прервана, например отклонен токен
+                    logger.warning('Первичная загрузка сообщений %s прервана (попытка %s): %s', ejuser.chat_id,
+                                   attempt, progress.loaded)
+                    self._retry(progress, bot, ejuser, message_id, attempt)
+                else:
+                    logger.info('Первичная загрузка сообщений %s завершена за %.1f с: %s', ejuser.chat_id,
+                                time.time() - begin, progress.loaded)
+                    progress.finish()
+            except Exception:
+                logger.exception('Ошибка первичной загрузки сообщений %s (попытка %s)', ejuser.chat_id, attempt)
+                self._retry(progress, bot, ejuser, message_id, attempt)
+            finally:
+                with self._lock:
+                    self._queued.discard(ejuser.chat_id)
+                self._queue.task_done()
+
+
+onboarding = Onboarding()
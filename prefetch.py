@@ -0,0 +1,111 @@
+import logging
+from itertools import count
+from queue import PriorityQueue
+from threading import Lock, Thread
+from typing import Iterable, Tuple, Dict, Union
+
+from CachedTelegramEljur import CachedTelegramEljur
+from circuit import EljurUnavailable
+from constants import PREFETCH_THREADS, PrefetchPriority
+from dbstats import operation, charged, current_budget
+from summary import MessageSummary
+
+logger = logging.getLogger('CachedTelegramEljur')
+
+
+class Prefetcher:
+    """
+    Очередь загрузки полных сообщений с приоритетами: в первую очередь загружаются сообщения, которые пользователь
+    вероятнее всего откроет (текущая и следующая страница списка, соседние сообщения цепочки).
+    Непрочитанные сообщения не загружаются - запрос getmessageinfo отмечает сообщение прочитанным в элжуре
+    """
+
+    def __init__(self, workers: int = PREFETCH_THREADS):
+        self._queue = PriorityQueue()
+        self._queued: Dict[Tuple[int, str, str], int] = dict()  # сообщение -> лучший приоритет в очереди
+        self._order = count()
+        self._lock = Lock()
+        self._workers = workers
+        self._started = False
+
+    def _start(self) -> None:
+        with self._lock:
+            if self._started:
+                return
+            self._started = True
+        for i in range(self._workers):
+            Thread(target=self._work, daemon=True, name=f'Prefetch-{i}').start()
+
+    def promote(self, ejuser: CachedTelegramEljur, items: Iterable[Union[MessageSummary, dict]], priority: int) -> int:
+        """
+        Ставит загрузку полных сообщений в очередь с приоритетом priority (меньше - раньше). Сообщение, уже стоящее
+        в очереди с большим приоритетом, ставится заново, прежняя запись пропускается
+        :param ejuser: пользователь
+        :param items: сообщения (MessageSummary или словари с полями id, folder, unread)
+        :param priority: приоритет из PrefetchPriority
+        :return: количество поставленных в очередь сообщений
+        """
+        added = 0
+        for msg in items:
+            if isinstance(msg, MessageSummary):
+                if msg.unread or msg.cached:
+                    continue
+                key = (ejuser.chat_id, msg.folder, msg.id)
+            elif msg.get('unread') or 'text' in msg:
+                continue
+            else:
+                key = (ejuser.chat_id, msg['folder'], msg['id'])
+            with self._lock:
+                if self._queued.get(key, priority + 1) <= priority:
+                    continue
+                self._queued[key] = priority
+            self._queue.put((priority, next(self._order), key, ejuser, current_budget()))
+            added += 1
+        if added:
+            self._start()
+        return added
+
+    def promote_page(self, ejuser: CachedTelegramEljur, folder: str, page: int, limit: int = 6) -> int:
+        """
+        Ставит в очередь сообщения показанной страницы списка и следующей за ней
+        """
+        msgs = ejuser.msg_cache[folder]
+        offset = limit * (page - 1)
+        return self.promote(ejuser, msgs[offset:offset + limit], PrefetchPriority.PAGE) + \
+            self.promote(ejuser, msgs[offset + limit:offset + 2 * limit], PrefetchPriority.NEXT_PAGE)
+
+    @property
+    def depth(self) -> int:
+        return self._queue.qsize()
+
+    def wait_idle(self) -> None:
+        """
+        Ждет, пока очередь предзагрузки не опустеет и загрузки не завершатся
+        """
+        self._queue.join()
+
+    def _work(self) -> None:
+        while True:
+            priority, _, key, ejuser, budget = self._queue.get()
+            chat_id, folder, msg_id = key
+            with self._lock:
+                stale = self._queued.get(key) != priority  # сообщение повышено в приоритете или уже загружено
+            if stale:
+                self._queue.task_done()
+                continue
+            try:
+                with operation('prefetch'), charged(budget):
+                    ejuser.get_message(msg_id=msg_id, force_folder=folder, only_cache=True)
+            except EljurUnavailable:
+                logger.debug('Элжур недоступен, сообщение %s для %s не предзагружено', msg_id, chat_id,
+                             extra={'chat_id': chat_id})
+            except Exception as e:
+                logger.warning('Не удалось предзагрузить сообщение %s для %s: %s', msg_id, chat_id, e,
+                               extra={'chat_id': chat_id})
+            finally:
+                with self._lock:
+                    self._queued.pop(key, None)
+                self._queue.task_done()
+
+
+prefetcher = Prefetcher()
@@ -0,0 +1,65 @@
+"""
+Ограничение частоты запросов к элжуру одной школы.
+
+Для каждой школы (vendor) ведется корзина токенов: запросы расходуют по токену, токены пополняются со скоростью
+VENDOR_RATE_LIMIT в секунду, запас - не больше VENDOR_RATE_BURST. Когда токенов нет, acquire ждет. Лимит общий
+для всех пользователей школы, поэтому одновременная загрузка ящиков многих пользователей не перегружает элжур школы.
+"""
+import time
+from threading import Lock
+from typing import Dict
+
+from constants import VENDOR_RATE_LIMIT, VENDOR_RATE_BURST
+from metrics import registry
+
+rate_limit_wait_seconds = registry.histogram('eljur_rate_limit_wait_seconds',
+                                             'Ожидание разрешения на запрос к элжуру школы', ('vendor',))
+
+
+class TokenBucket:
+    def __init__(self, rate: float, burst: float):
+        self.rate = rate  # токенов в секунду
+        self.burst = burst  # максимальный запас токенов
+        self.tokens = burst
+        self.updated = time.monotonic()
+        self._lock = Lock()
+
+    def reserve(self) -> float:
+        """
+        Забирает токен, в том числе еще не накопленный
+        :return: сколько секунд нужно подождать перед запросом
+        """
+        with self._lock:
+            now = time.monotonic()
+            self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+            self.updated = now
+            self.tokens -= 1
+            return 0.0 if self.tokens >= 0 else -self.tokens / self.rate
+
+
+class VendorLimits:
+    def __init__(self, rate: float = VENDOR_RATE_LIMIT, burst: float = VENDOR_RATE_BURST):
+        self.rate = rate
+        self.burst = burst
+        self._buckets: Dict[str, TokenBucket] = dict()
+        self._lock = Lock()
+
+    def get(self, vendor: str) -> TokenBucket:
+        with self._lock:
+            if vendor not in self._buckets:
+                self._buckets[vendor] = TokenBucket(self.rate, self.burst)
+            return self._buckets[vendor]
+
+    def acquire(self, vendor: str) -> float:
+        """
+        Ждет разрешения на запрос к элжуру школы vendor
+        :return: время ожидания, секунды
+        """
+        wait = self.get(vendor).reserve()
+        rate_limit_wait_seconds.observe(wait, vendor=vendor)
+        if wait:
+            time.sleep(wait)
+        return wait
+
+
+vendor_limits = VendorLimits()
@@ -0,0 +1,107 @@
+"""
+Подготовка текста сообщения к отправке в Telegram.
+
+Текст из элжура - HTML с произвольной разметкой, а Telegram принимает только несколько тэгов. render_body за один
+проход регулярного выражения оставляет поддерживаемые тэги (без атрибутов, кроме href у ссылок), переносы строк
+вместо блочных тэгов, экранирует остальное и оформляет ссылки в тексте. Результат и строка получателей сохраняются
+в базе при кэшировании сообщения (prerender), так что открытие сообщения не требует разбора текста.
+"""
+import re
+from html import escape, unescape
+from typing import Dict, List, Any
+
+from pymorphy2 import MorphAnalyzer
+
+from constants import RECIPIENTS_PREVIEW_COUNT
+
+morph = MorphAnalyzer()
+
+TOKENS = re.compile(r'(?P<hidden><(?P<hidden_name>script|style)\b[^>]*>.*?</(?P=hidden_name)\s*>)'
+                    r'|(?P<tag><(?P<close>/?)(?P<name>[a-zA-Z][a-zA-Z0-9]*)(?P<attrs>[^<>]*)>)'
+                    r'|(?P<comment><!--.*?-->)'
+                    r'|(?P<entity>&(?:#[0-9]+|#[xX][0-9a-fA-F]+|[a-zA-Z][a-zA-Z0-9]*);)'
+                    r'|(?P<link>https?://(?:[^\s<>"\'&]|&amp;|&(?!#?[a-zA-Z0-9]+;))*[^\s<>"\'&.,;:!?)])'
+                    r'|(?P<special>[<>&])', re.DOTALL | re.IGNORECASE)
+HREF = re.compile(r'''href\s*=\s*(?:"([^"]*)"|'([^']*)'|([^\s>]+))''', re.IGNORECASE)
+INLINE_TAGS = {'b': 'b', 'strong': 'b', 'i': 'i', 'em': 'i', 'u': 'u', 'ins': 'u', 's': 's', 'strike': 's',
+               'del': 's', 'a': 'a'}  # тэги элжура -> тэги Telegram
+RENDER_VERSION = 2  # увеличивается при изменении render_body: тексты, подготовленные прежней версией, готовятся заново
+LINE_TAGS = {'br', 'p', 'div', 'li', 'tr', 'h1', 'h2', 'h3', 'h4', 'h5', 'h6'}  # заменяются переносом строки
+
+
+def render_body(text: str) -> str:
+    """
+    Переводит HTML элжура в HTML Telegram за один проход
+    :param text: текст сообщения из элжура
+    :return: текст для отправки с parse_mode=HTML
+    """
+    opened: List[str] = []  # открытые тэги Telegram, незакрытые закрываются в конце
+
+    def replace(match: re.Match) -> str:
+        kind = match.lastgroup
+        if kind == 'link':
+            link = match.group('link').replace('&amp;', '&')  # & в ссылке из HTML элжура записан как &amp;
+            return escape(link) if 'a' in opened else f'<a href="{escape(link)}">{escape(link)}</a>'
+        if kind == 'entity':
+            return escape(unescape(match.group('entity')), quote=False)
+        if kind == 'special':
+            return escape(match.group('special'), quote=False)
+        if kind in ('hidden', 'comment'):
+            return ''
+        name = match.group('name').lower()
+        if name in LINE_TAGS:
+            return '\n' if match.group('close') or name == 'br' else ''
+        tag = INLINE_TAGS.get(name)
+        if not tag:
+            return ''
+        if match.group('close'):
+            if tag not in opened:
+                return ''
+            closed = ''
+            while opened:  # закрываются и вложенные тэги, оставшиеся открытыми
+                top = opened.pop()
+                closed += f'</{top}>'
+                if top == tag:
+                    break
+            return closed
+        if tag in opened:  # Telegram не поддерживает вложенные одинаковые тэги
+            return ''
+        if tag == 'a':
+            href = HREF.search(match.group('attrs'))
+            if not href:
+                return ''
+            opened.append(tag)
+            link = unescape(next(group for group in href.groups() if group is not None))
+            return f'<a href="{escape(link)}">'
+        opened.append(tag)
+        return f'<{tag}>'
+
+    result = TOKENS.sub(replace, text)
+    return result + ''.join(f'</{tag}>' for tag in reversed(opened))
+
+
+def render_recipients(users_to: List[Dict[str, str]]) -> str:
+    """
+    Строка получателей сообщения: первые RECIPIENTS_PREVIEW_COUNT и количество остальных
+    """
+    names = []
+    for user in users_to[:RECIPIENTS_PREVIEW_COUNT]:
+        if user['middlename']:
+            names.append(f"{user['lastname']} {user['firstname'][0]}.{user['middlename'][0]}")
+        else:
+            names.append(f"{user['lastname']} {user['firstname']}")
+    yet_more = len(users_to) - RECIPIENTS_PREVIEW_COUNT
+    and_yet_more = f" и ещё {yet_more} {morph.parse('получателей')[0].make_agree_with_number(yet_more).word}" \
+        if yet_more > 0 else ''
+    return f"<i>{'Получатели' if len(users_to) > 1 else 'Получатель'}:</i> " \
+           f"{escape(', '.join(names), quote=False)}{and_yet_more}"
+
+
+def prerender(message: Dict[str, Any]) -> Dict[str, str]:
+    """
+    :param message: полное сообщение из элжура
+    :return: поля html, recipients и render_version для записи в базу вместе с сообщением
+    """
+    return {'html': render_body(message.get('text') or ''),
+            'recipients': render_recipients(message.get('user_to') or message.get('users_to') or []),
+            'render_version': RENDER_VERSION}
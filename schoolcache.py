@@ -0,0 +1,133 @@
+"""
+Кэш общих данных школы.
+
+Учебные периоды, получатели сообщений и другие справочники одинаковы для всех пользователей одной школы (vendor),
+поэтому загружаются из элжура один раз на школу и хранятся в двух уровнях: в памяти процесса (LRU с ограничением
+по количеству записей и суммарному размеру) и в коллекции school_cache, общей для всех процессов бота.
+Записи живут ttl секунд, одновременные промахи по одному ключу загружают данные из элжура один раз.
+"""
+import logging
+import time
+from collections import OrderedDict
+from datetime import datetime, timedelta
+from threading import Lock
+from typing import Any, Callable, Dict, Optional, Tuple
+
+import pymongo
+from pymongo.collection import Collection
+
+from codec import dumps, loads
+from constants import SCHOOL_CACHE_ENTRIES, SCHOOL_CACHE_MEMORY, SCHOOL_CACHE_MAX_VALUE
+from database import school_cache
+from metrics import registry
+from singleflight import SingleFlight
+
+logger = logging.getLogger('BOT')
+
+school_cache_total = registry.counter('school_cache_total', 'Обращения к кэшу данных школ: memory, mongo - попадание, '
+                                                             'miss - загрузка из элжура', ('kind', 'result'))
+
+
+class SchoolCache:
+    def __init__(self, collection: Collection, max_entries: int = SCHOOL_CACHE_ENTRIES,
+                 max_memory: int = SCHOOL_CACHE_MEMORY, max_value: int = SCHOOL_CACHE_MAX_VALUE):
+        """
+        :param collection: коллекция MongoDB для записей, общих для всех процессов
+        :param max_entries: максимум записей в памяти
+        :param max_memory: максимальный суммарный размер записей в памяти (по длине JSON), байты
+        :param max_value: записи больше не кэшируются
+        """
+        self.collection = collection
+        self.max_entries = max_entries
+        self.max_memory = max_memory
+        self.max_value = max_value
+        self._memory: Dict[str, Tuple[Any, float, int]] = OrderedDict()  # ключ -> (значение, истекает, размер)
+        self._size = 0
+        self._lock = Lock()
+        self._loading = SingleFlight()
+        self.collection.create_index('expires', expireAfterSeconds=0)
+        self.collection.create_index([('vendor', pymongo.ASCENDING), ('kind', pymongo.ASCENDING)])
+        registry.gauge('school_cache_memory_bytes', 'Размер записей кэша данных школ в памяти',
+                       function=lambda: self._size)
+
+    @staticmethod
+    def _id(vendor: str, kind: str, key: str) -> str:
+        return f'{vendor}:{kind}:{key}'
+
+    def _remember(self, cache_id: str, value: Any, expires: float, size: int) -> None:
+        with self._lock:
+            if cache_id in self._memory:
+                self._size -= self._memory.pop(cache_id)[2]
+            self._memory[cache_id] = (value, expires, size)
+            self._size += size
+            while self._memory and (len(self._memory) > self.max_entries or self._size > self.max_memory):
+                self._size -= self._memory.popitem(last=False)[1][2]
+
+    def _from_memory(self, cache_id: str) -> Tuple[bool, Any]:
+        with self._lock:
+            item = self._memory.get(cache_id)
+            if item is None:
+                return False, None
+            if item[1] <= time.time():
+                del self._memory[cache_id]
+                self._size -= item[2]
+                return False, None
+            self._memory.move_to_end(cache_id)
+            return True, item[0]
+
+    def get(self, vendor: str, kind: str, key: str, loader: Callable[[], Optional[Any]], ttl: int) -> Optional[Any]:
+        """
+        Возвращает данные школы из кэша или загружает их
+        :param vendor: домен школы
+        :param kind: вид данных (periods, receivers, ...)
+        :param key: параметры данных внутри вида
+        :param loader: загрузка данных из элжура, None не кэшируется
+        :param ttl: время жизни записи, секунды
+        :return: данные или None, если загрузить их не удалось
+        """
+        cache_id = self._id(vendor, kind, key)
+        found, value = self._from_memory(cache_id)
+        if found:
+            school_cache_total.inc(kind=kind, result='memory')
+            return value
+        value, _ = self._loading.do(cache_id, lambda: self._load(cache_id, vendor, kind, key, loader, ttl))
+        return value
+
+    def _load(self, cache_id: str, vendor: str, kind: str, key: str, loader: Callable[[], Optional[Any]],
+              ttl: int) -> Optional[Any]:
+        document = self.collection.find_one({'_id': cache_id, 'expires': {'$gt': datetime.utcnow()}},
+                                            {'value': True, 'expires': True})
+        if document:
+            school_cache_total.inc(kind=kind, result='mongo')
+            value = loads(document['value'])
+            expires = (document['expires'] - datetime.utcnow()).total_seconds() + time.time()
+            self._remember(cache_id, value, expires, len(document['value']))
+            return value
+        school_cache_total.inc(kind=kind, result='miss')
+        value = loader()
+        if value is None:
+            return None
+        encoded = dumps(value)
+        if len(encoded) > self.max_value:
+            logger.warning('Данные %s школы %s (%s байт) не помещаются в кэш', kind, vendor, len(encoded))
+            return value
+        self.collection.replace_one({'_id': cache_id},
+                                    {'vendor': vendor, 'kind': kind, 'key': key, 'value': encoded,
+                                     'expires': datetime.utcnow() + timedelta(seconds=ttl)}, upsert=True)
+        self._remember(cache_id, value, time.time() + ttl, len(encoded))
+        return value
+
+    def invalidate(self, vendor: str, kind: Optional[str] = None) -> None:
+        """
+        Удаляет данные школы из кэша
+        :param vendor: домен школы
+        :param kind: вид данных, по умолчанию все
+        """
+        prefix = f'{vendor}:{kind}:' if kind else f'{vendor}:'
+        with self._lock:
+            for cache_id in [cache_id for cache_id in self._memory if cache_id.startswith(prefix)]:
+                self._size -= self._memory.pop(cache_id)[2]
+        self.collection.delete_many({'vendor': vendor, **({'kind': kind} if kind else {})})
+
+
+school_data = SchoolCache(school_cache)
@@ -0,0 +1,108 @@
+import re
+from bisect import bisect_left
+from html import unescape
+from threading import RLock
+from typing import Dict, Set, Tuple, List, Iterable
+
+from utility import clean_html
+
+TOKEN = re.compile(r'\w+', re.UNICODE)
+MIN_TOKEN_LENGTH = 2
+MessageKey = Tuple[str, str]  # (папка, id сообщения)
+
+
+def tokenize(text: str) -> Set[str]:
+    """
+    Разбивает текст на слова для индекса: нижний регистр, ё -> е, без слишком коротких слов
+    """
+    return {token for token in TOKEN.findall(text.lower().replace('ё', 'е')) if len(token) >= MIN_TOKEN_LENGTH}
+
+
+def stem(token: str) -> str:
+    """
+    Грубое отсечение окончания слова запроса, чтобы "физика" находила "физике" и "физики"
+    """
+    if len(token) > 4:
+        return token[:max(4, len(token) - 2)]
+    return token
+
+
+def message_text(msg: dict) -> str:
+    """
+    Текст сообщения для индекса: тема, отправитель, получатели и текст (или его начало, если текст ещё не загружен)
+    """
+    parts = [msg.get('subject', '')]
+    for user in [msg.get('user_from')] + (msg.get('users_to') or []):
+        if user:
+            parts.extend(user.get(field) or '' for field in ('lastname', 'firstname', 'middlename'))
+    parts.append(unescape(clean_html(msg.get('text') or msg.get('short_text') or '')))
+    return ' '.join(parts)
+
+
+class SearchIndex:
+    """
+    Инвертированный индекс сообщений одного пользователя по теме, отправителю и тексту.
+    Пополняется по мере загрузки сообщений, поиск - по префиксам слов запроса
+    """
+
+    def __init__(self):
+        self._postings: Dict[str, Set[MessageKey]] = dict()
+        self._dates: Dict[MessageKey, str] = dict()
+        self._tokens: List[str] = []
+        self._dirty = False
+        self._lock = RLock()
+
+    def __len__(self) -> int:
+        return len(self._dates)
+
+    def add(self, msg: dict) -> None:
+        """
+        Добавляет сообщение в индекс или дополняет его новыми полями (например, загруженным текстом)
+        :param msg: сообщение, обязательно с полями folder и id
+        """
+        key = (msg['folder'], msg['id'])
+        tokens = tokenize(message_text(msg))
+        with self._lock:
+            if msg.get('date'):
+                self._dates[key] = msg['date']
+            else:
+                self._dates.setdefault(key, '')
+            for token in tokens:
+                postings = self._postings.get(token)
+                if postings is None:
+                    self._postings[token] = postings = set()
+                    self._dirty = True
+                postings.add(key)
+
+    def add_many(self, msgs: Iterable[dict]) -> None:
+        for msg in msgs:
+            self.add(msg)
+
+    def _matching(self, prefix: str) -> Set[MessageKey]:
+        result = set()
+        position = bisect_left(self._tokens, prefix)
+        while position < len(self._tokens) and self._tokens[position].startswith(prefix):
+            result |= self._postings[self._tokens[position]]
+            position += 1
+        return result
+
+    def search(self, query: str) -> List[MessageKey]:
+        """
+        Ищет сообщения, содержащие все слова запроса (по префиксу)
+        :param query: поисковый запрос
+        :return: ключи (папка, id) найденных сообщений, новые сначала
+        """
+        words = sorted(tokenize(query), key=len, reverse=True)
+        if not words:
+            return []
+        with self._lock:
+            if self._dirty:
+                self._tokens = sorted(self._postings)
+                self._dirty = False
+            found = None
+            for word in words:
+                matching = self._matching(stem(word))
+                found = matching if found is None else found & matching
+                if not found:
+                    return []
+            return sorted(found, key=lambda key: self._dates.get(key, ''), reverse=True)
@@ -0,0 +1,51 @@
+from threading import Lock, Event
+from typing import Callable, Dict, Hashable, Any, Tuple
+
+
+class _Call:
+    def __init__(self):
+        self.done = Event()
+        self.result: Any = None
+        self.error: Any = None
+
+
+class SingleFlight:
+    """
+    Объединение одинаковых одновременных вызовов: пока выполняется вызов с ключом key,
+    остальные вызовы с тем же ключом не выполняются, а дожидаются его результата (или исключения)
+    """
+
+    def __init__(self):
+        self._calls: Dict[Hashable, _Call] = dict()
+        self._lock = Lock()
+
+    def do(self, key: Hashable, func: Callable[[], Any]) -> Tuple[Any, bool]:
+        """
+        :param key: ключ вызова
+        :param func: вызов
+        :return: (результат, получен ли результат чужого вызова)
+        """
+        with self._lock:
+            call = self._calls.get(key)
+            leader = call is None
+            if leader:
+                call = self._calls[key] = _Call()
+        if not leader:
+            call.done.wait()
+            if call.error is not None:
+                raise call.error
+            return call.result, True
+        try:
+            call.result = func()
+        except BaseException as e:
+            call.error = e
+            raise
+        finally:
+            with self._lock:
+                del self._calls[key]
+            call.done.set()
+        return call.result, False
+
+    @property
+    def in_flight(self) -> int:
+        return len(self._calls)
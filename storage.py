@@ -0,0 +1,326 @@
+"""
+Компактная схема v2 коллекции сообщений.
+
+Документы хранятся с короткими именами полей, дата - как BSON date, длинные тексты сжимаются.
+Вместо строки-хэша (chat_id, folder, id) используется составной уникальный индекс.
+CompactCollection переводит документы, фильтры и обновления между полной и короткой формой,
+поэтому остальной код работает с привычными именами полей eljur.
+"""
+import zlib
+from datetime import datetime
+from typing import Dict, Any, Optional, List, Iterable, Union
+
+import pymongo
+from bson import Binary
+from pymongo import UpdateOne, UpdateMany
+
+from constants import MESSAGE_COMPRESS_THRESHOLD
+
+try:
+    import zstandard
+    _zstd_compressor = zstandard.ZstdCompressor(level=6)
+    _zstd_decompressor = zstandard.ZstdDecompressor()
+except ImportError:
+    zstandard = None
+
+DATE_FORMAT = '%Y-%m-%d %H:%M:%S'
+
+FIELDS = {
+    'chat_id': 'c',
+    'folder': 'f',
+    'id': 'i',
+    'subject': 's',
+    'short_text': 'st',
+    'date': 'd',
+    'unread': 'u',
+    'with_files': 'wf',
+    'user_from': 'uf',
+    'users_to': 'ut',
+    'user_to': 'rt',
+    'text': 't',
+    'files': 'fl',
+    'starred': 'sr',
+    'html': 'h',  # текст, подготовленный для Telegram (render.prerender)
+    'recipients': 'rs',  # строка получателей для вывода сообщения
+    'render_version': 'rv',  # версия render_body, которой подготовлен html
+}
+USER_FIELDS = {'name': 'n', 'firstname': 'fn', 'lastname': 'ln', 'middlename': 'mn'}
+FILE_FIELDS = {'filename': 'n', 'link': 'l'}
+NESTED = {'uf': USER_FIELDS, 'ut': USER_FIELDS, 'rt': USER_FIELDS, 'fl': FILE_FIELDS}
+COMPRESSED = {'t', 'h'}  # поля, которые сжимаются при превышении MESSAGE_COMPRESS_THRESHOLD
+DROPPED = {'hash'}  # поля схемы v1, которые больше не хранятся
+
+SHORT_FIELDS = {short: full for full, short in FIELDS.items()}
+SHORT_NESTED = {field: {short: full for full, short in mapping.items()} for field, mapping in NESTED.items()}
+
+
+def compress(text: str) -> Binary:
+    """
+    Сжимает текст: zstd, если установлен пакет zstandard, иначе zlib. Первый байт - признак алгоритма
+    """
+    raw = text.encode('utf-8')
+    if zstandard:
+        return Binary(b's' + _zstd_compressor.compress(raw))
+    return Binary(b'z' + zlib.compress(raw, 6))
+
+
+def decompress(blob: bytes) -> str:
+    codec, payload = blob[:1], blob[1:]
+    if codec == b's':
+        return _zstd_decompressor.decompress(payload).decode('utf-8')
+    return zlib.decompress(payload).decode('utf-8')
+
+
+def _pack_nested(short: str, value: Any) -> Any:
+    mapping = NESTED[short]
+    if isinstance(value, list):
+        return [_pack_nested(short, item) for item in value]
+    if isinstance(value, dict):
+        if value and all(key.startswith('$') for key in value):
+            return {op: _pack_nested(short, item) for op, item in value.items()}
+        return {mapping.get(key, key): item for key, item in value.items()}
+    return value
+
+
+def _pack_date(value: Any) -> Any:
+    if isinstance(value, str):
+        try:
+            return datetime.strptime(value, DATE_FORMAT)
+        except ValueError:
+            return value
+    if isinstance(value, list):
+        return [_pack_date(item) for item in value]
+    if isinstance(value, dict):
+        return {key: _pack_date(item) for key, item in value.items()}
+    return value
+
+
+def pack_field(key: str, value: Any, compress_text: bool = True) -> (str, Any):
+    """
+    Переводит одно поле в короткую форму
+    :return: (короткое имя, значение)
+    """
+    head, _, tail = key.partition('.')
+    short = FIELDS.get(head, head)
+    if tail:
+        nested = NESTED.get(short, {})
+        return f"{short}.{'.'.join(nested.get(part, part) for part in tail.split('.'))}", value
+    if short in NESTED:
+        value = _pack_nested(short, value)
+    elif short == 'd':
+        value = _pack_date(value)
+    elif short in COMPRESSED and compress_text and isinstance(value, str) and \
+            len(value) > MESSAGE_COMPRESS_THRESHOLD:
+        return f'{short}z', compress(value)
+    return short, value
+
+
+def pack(document: Dict[str, Any]) -> Dict[str, Any]:
+    """
+    Переводит документ сообщения в компактную форму
+    """
+    result = dict()
+    for key, value in document.items():
+        if key in DROPPED:
+            continue
+        short, value = pack_field(key, value)
+        result[short] = value
+    return result
+
+
+def unpack(document: Optional[Dict[str, Any]]) -> Optional[Dict[str, Any]]:
+    """
+    Переводит компактный документ в формат eljur
+    """
+    if document is None:
+        return None
+    result = dict()
+    for key, value in document.items():
+        if key.endswith('z') and key[:-1] in COMPRESSED:
+            key, value = key[:-1], decompress(value)
+        full = SHORT_FIELDS.get(key, key)
+        if key in SHORT_NESTED:
+            mapping = SHORT_NESTED[key]
+            if isinstance(value, list):
+                value = [{mapping.get(k, k): v for k, v in item.items()} if isinstance(item, dict) else item
+                         for item in value]
+            elif isinstance(value, dict):
+                value = {mapping.get(k, k): v for k, v in value.items()}
+        elif key == 'd' and isinstance(value, datetime):
+            value = value.strftime(DATE_FORMAT)
+        result[full] = value
+    return result
+
+
+def pack_filter(query: Optional[Dict[str, Any]]) -> Dict[str, Any]:
+    """
+    Переводит фильтр MongoDB (в том числе $or/$and) в короткие имена полей
+    """
+    if not query:
+        return {}
+    result = dict()
+    for key, value in query.items():
+        if key in ('$or', '$and', '$nor'):
+            result[key] = [pack_filter(item) for item in value]
+        elif key.startswith('$'):
+            result[key] = value
+        elif FIELDS.get(key) in COMPRESSED and isinstance(value, dict) and set(value) == {'$exists'}:
+            # текст может храниться как сжатым, так и несжатым
+            short = FIELDS[key]
+            if value['$exists']:
+                result.setdefault('$and', []).append({'$or': [{short: value}, {f'{short}z': value}]})
+            else:
+                result[short] = value
+                result[f'{short}z'] = value
+        else:
+            short, value = pack_field(key, value, compress_text=False)
+            result[short] = value
+    return result
+
+
+def plain_field(short: str) -> str:
+    """
+    :return: короткое имя поля без признака сжатия (tz -> t)
+    """
+    return short[:-1] if short.endswith('z') and short[:-1] in COMPRESSED else short
+
+
+def pack_update(update: Dict[str, Any]) -> Dict[str, Any]:
+    """
+    Переводит обновление ($set, $unset, $setOnInsert, ...) в короткие имена полей.
+    Сжатый текст заменяет несжатый и наоборот, $unset удаляет обе формы. Поля, которые меняют $set или $unset,
+    исключаются из $setOnInsert (иначе MongoDB отклонит обновление из-за конфликта путей)
+    :raises ValueError: одно и то же поле и в $set, и в $unset
+    """
+    if any(not operator.startswith('$') for operator in update):
+        return pack(update)
+    result = dict()
+    for operator, fields in update.items():
+        result.setdefault(operator, {}).update(pack(fields))
+    to_set, to_unset = result.get('$set', {}), result.get('$unset', {})
+    for short in list(to_unset):
+        if plain_field(short) in COMPRESSED:
+            to_unset[plain_field(short)] = to_unset[f'{plain_field(short)}z'] = ''
+    conflicts = {plain_field(short) for short in to_set} & {plain_field(short) for short in to_unset}
+    if conflicts:
+        raise ValueError(f'Поля {sorted(conflicts)} одновременно в $set и $unset')
+    for short in list(to_set):
+        if short in COMPRESSED:
+            result.setdefault('$unset', {})[f'{short}z'] = ''
+        elif plain_field(short) != short:
+            result.setdefault('$unset', {})[plain_field(short)] = ''
+    if '$setOnInsert' in result:
+        changed = {plain_field(short) for short in [*to_set, *result.get('$unset', {})]}
+        on_insert = {short: value for short, value in result['$setOnInsert'].items()
+                     if plain_field(short) not in changed}
+        if on_insert:
+            result['$setOnInsert'] = on_insert
+        else:
+            del result['$setOnInsert']
+    return result
+
+
+def pack_sort(key_or_list: Union[str, List], direction: Optional[int] = None) -> List:
+    if isinstance(key_or_list, str):
+        return [(pack_field(key_or_list, None)[0], direction or pymongo.ASCENDING)]
+    return [(pack_field(key, None)[0], order) for key, order in key_or_list]
+
+
+def update_one_op(query: Dict[str, Any], update: Dict[str, Any], upsert: bool = False) -> UpdateOne:
+    return UpdateOne(pack_filter(query), pack_update(update), upsert=upsert)
+
+
+def update_many_op(query: Dict[str, Any], update: Dict[str, Any]) -> UpdateMany:
+    return UpdateMany(pack_filter(query), pack_update(update))
+
+
+class CompactCursor:
+    def __init__(self, cursor):
+        self._cursor = cursor
+
+    def sort(self, key_or_list, direction: Optional[int] = None) -> 'CompactCursor':
+        self._cursor = self._cursor.sort(pack_sort(key_or_list, direction))
+        return self
+
+    def limit(self, limit: int) -> 'CompactCursor':
+        self._cursor = self._cursor.limit(limit)
+        return self
+
+    def skip(self, skip: int) -> 'CompactCursor':
+        self._cursor = self._cursor.skip(skip)
+        return self
+
+    def batch_size(self, batch_size: int) -> 'CompactCursor':
+        self._cursor = self._cursor.batch_size(batch_size)
+        return self
+
+    def __iter__(self):
+        for document in self._cursor:
+            yield unpack(document)
+
+
+class CompactCollection:
+    """
+    Коллекция сообщений в схеме v2 с интерфейсом pymongo.Collection в полных именах полей eljur.
+    Для bulk_write операции создаются функциями update_one_op/update_many_op
+    """
+
+    def __init__(self, collection):
+        self.collection = collection
+
+    @property
+    def name(self) -> str:
+        return self.collection.name
+
+    @staticmethod
+    def _projection(projection: Optional[Dict[str, Any]]) -> Optional[Dict[str, Any]]:
+        if projection is None:
+            return None
+        result = dict()
+        for key, value in projection.items():
+            short = pack_field(key, None)[0]
+            result[short] = value
+            if short in COMPRESSED:
+                result[f'{short}z'] = value
+        return result
+
+    def ensure_indexes(self) -> None:
+        self.collection.create_index([('c', pymongo.ASCENDING), ('f', pymongo.ASCENDING), ('i', pymongo.ASCENDING)],
+                                     unique=True, name='chat_folder_id')
+        self.collection.create_index([('c', pymongo.ASCENDING), ('f', pymongo.ASCENDING), ('d', pymongo.DESCENDING)],
+                                     name='chat_folder_date')
+
+    def find(self, query: Optional[Dict[str, Any]] = None, projection: Optional[Dict[str, Any]] = None) \
+            -> CompactCursor:
+        return CompactCursor(self.collection.find(pack_filter(query), self._projection(projection)))
+
+    def find_one(self, query: Optional[Dict[str, Any]] = None, projection: Optional[Dict[str, Any]] = None) \
+            -> Optional[Dict[str, Any]]:
+        return unpack(self.collection.find_one(pack_filter(query), self._projection(projection)))
+
+    def find_one_and_update(self, query: Dict[str, Any], update: Dict[str, Any], **kwargs) -> Optional[Dict[str, Any]]:
+        return unpack(self.collection.find_one_and_update(pack_filter(query), pack_update(update), **kwargs))
+
+    def update_one(self, query: Dict[str, Any], update: Dict[str, Any], upsert: bool = False):
+        return self.collection.update_one(pack_filter(query), pack_update(update), upsert=upsert)
+
+    def update_many(self, query: Dict[str, Any], update: Dict[str, Any]):
+        return self.collection.update_many(pack_filter(query), pack_update(update))
+
+    def insert_one(self, document: Dict[str, Any]):
+        return self.collection.insert_one(pack(document))
+
+    def insert_many(self, documents: Iterable[Dict[str, Any]], ordered: bool = True):
+        return self.collection.insert_many([pack(document) for document in documents], ordered=ordered)
+
+    def delete_one(self, query: Dict[str, Any]):
+        return self.collection.delete_one(pack_filter(query))
+
+    def delete_many(self, query: Dict[str, Any]):
+        return self.collection.delete_many(pack_filter(query))
+
+    def count_documents(self, query: Dict[str, Any], **kwargs) -> int:
+        return self.collection.count_documents(pack_filter(query), **kwargs)
+
+    def bulk_write(self, requests: List, ordered: bool = True):
+        return self.collection.bulk_write(requests, ordered=ordered)
@@ -0,0 +1,65 @@
+from datetime import datetime
+from typing import Dict, Any, Optional
+
+from constants import MessageFolder
+from utility import load_date, format_user
+
+# поля документа сообщения, из которых строится MessageSummary (проекция для запросов списка)
+SUMMARY_PROJECTION = {'_id': False, 'id': True, 'folder': True, 'date': True, 'subject': True, 'unread': True,
+                      'with_files': True, 'user_from': True, 'users_to': True, 'user_to': True}
+
+
+def thread_subject(subject: str) -> str:
+    """
+    Тема цепочки сообщений: тема без префикса ответа
+    """
+    return subject[4:] if subject.startswith('Re: ') else subject
+
+
+class MessageSummary:
+    """
+    Краткое представление сообщения для списков (кэш в памяти, страницы сообщений, поиск, избранное).
+    Хранит только то, что нужно для вывода строки списка: без _id, вложенных словарей пользователей и текста
+    """
+    __slots__ = ('id', 'folder', 'timestamp', 'subject', 'correspondent', 'counterpart', 'unread', 'with_files',
+                 'cached')
+
+    def __init__(self, msg_id: str, folder: str, timestamp: float, subject: str, correspondent: str,
+                 counterpart: Optional[str], unread: bool, with_files: bool, cached: bool):
+        self.id = msg_id
+        self.folder = folder
+        self.timestamp = timestamp  # дата сообщения, секунды
+        self.subject = subject
+        self.correspondent = correspondent  # отправитель входящего или получатели отправленного для вывода
+        self.counterpart = counterpart  # id собеседника в элжуре, по нему и теме определяется цепочка
+        self.unread = unread
+        self.with_files = with_files
+        self.cached = cached  # текст сообщения загружен в базу
+
+    @classmethod
+    def from_document(cls, document: Dict[str, Any], cached: Optional[bool] = None) -> 'MessageSummary':
+        """
+        :param document: сообщение в формате элжура (из базы или из ответа getmessages)
+        :param cached: загружен ли текст, по умолчанию - есть ли текст в документе
+        """
+        folder = document['folder']
+        user_from = document.get('user_from')
+        if folder == MessageFolder.INBOX:
+            correspondent = format_user(user_from) if user_from else ''
+        else:
+            recipients = document.get('user_to') or ([user_from] if user_from else document.get('users_to') or [])
+            correspondent = format_user(recipients[0]) if recipients else ''
+            if len(document.get('users_to') or []) > 1:
+                correspondent += f" и ещё {len(document['users_to']) - 1}"
+        return cls(msg_id=document['id'], folder=folder, timestamp=load_date(document['date']).timestamp(),
+                   subject=document.get('subject') or '', correspondent=correspondent,
+                   counterpart=user_from.get('name') if user_from else None,
+                   unread=bool(document.get('unread')), with_files=bool(document.get('with_files')),
+                   cached='text' in document if cached is None else cached)
+
+    @property
+    def date(self) -> datetime:
+        return datetime.fromtimestamp(self.timestamp)
+
+    def __repr__(self) -> str:
+        return f'MessageSummary({self.folder}, {self.id}, {self.subject!r})'
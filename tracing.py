@@ -0,0 +1,379 @@
+"""
+Трассировка обработки обновлений и фоновых задач.
+
+Каждый обработчик Telegram и фоновая задача (см. eljurbot.instrument) открывают корневой span, а команды MongoDB
+(TraceListener), запросы к элжуру (Eljur._request) и вызовы Bot API (TracedRequest) внутри него записываются
+дочерними span'ами. Так по трассе видно, на что ушло время обработки: на базу, элжур или Telegram.
+
+Трассы целиком записываются с вероятностью TRACE_SAMPLE_RATE, а трассы дольше TRACE_SLOW_THRESHOLD - всегда,
+вместе со строкой в лог с разбивкой времени. Запись выполняется фоновым потоком: в файл TRACE_FILE (строка JSON
+на трассу) или, если задан OTLP_ENDPOINT, в коллектор OpenTelemetry по OTLP/HTTP (JSON).
+"""
+import logging
+import os
+import random
+import threading
+import time
+from contextlib import contextmanager
+from functools import wraps
+from queue import Queue, Full, Empty
+from typing import Any, Callable, Dict, Iterator, List, Optional
+
+import requests
+from pymongo import monitoring
+from telegram import Update
+from telegram.utils.request import Request
+
+from codec import dumps
+from constants import TRACE_SAMPLE_RATE, TRACE_SLOW_THRESHOLD, TRACE_FILE, OTLP_ENDPOINT, TRACE_MAX_SPANS, \
+    TRACE_QUEUE_SIZE
+from metrics import registry
+
+logger = logging.getLogger('BOT')
+_local = threading.local()
+
+traces_total = registry.counter('traces_total', 'Завершенные трассы: записанные (sampled, slow) и пропущенные',
+                                ('result',))
+traces_dropped_total = registry.counter('traces_dropped_total', 'Трассы, не записанные из-за переполнения очереди')
+
+SPAN_KINDS = {'internal': 1, 'client': 3}  # виды span'ов OTLP: корневые - internal, обращения к сервисам - client
+
+
+class Trace:
+    __slots__ = ('trace_id', 'sampled', 'spans', 'dropped', '_lock')
+
+    def __init__(self, sampled: bool):
+        self.trace_id = os.urandom(16).hex()
+        self.sampled = sampled
+        self.spans: List[Span] = []
+        self.dropped = 0  # span'ы сверх TRACE_MAX_SPANS
+        self._lock = threading.Lock()
+
+    def add(self, span: 'Span') -> bool:
+        with self._lock:
+            if len(self.spans) >= TRACE_MAX_SPANS:
+                self.dropped += 1
+                return False
+            self.spans.append(span)
+            return True
+
+
+class Span:
+    __slots__ = ('trace', 'span_id', 'parent_id', 'name', 'kind', 'start', 'end', 'attrs', 'error')
+
+    def __init__(self, trace: Trace, name: str, kind: str, parent: Optional['Span'], attrs: Dict[str, Any]):
+        self.trace = trace
+        self.span_id = os.urandom(8).hex()
+        self.parent_id = parent.span_id if parent else None
+        self.name = name
+        self.kind = kind  # root, mongo, eljur, telegram или internal
+        self.start = time.time_ns()
+        self.end = 0
+        self.attrs = attrs
+        self.error: Optional[str] = None
+
+    def set(self, key: str, value: Any) -> None:
+        self.attrs[key] = value
+
+    def finish(self, error: Optional[BaseException] = None) -> None:
+        self.end = time.time_ns()
+        if error is not None:
+            self.error = type(error).__name__
+
+    @property
+    def duration(self) -> float:
+        """
+        :return: длительность, секунды
+        """
+        return (self.end - self.start) / 1e9
+
+
+def current() -> Optional[Span]:
+    """
+    :return: открытый span текущего потока или None, если поток не выполняет трассируемую операцию
+    """
+    return getattr(_local, 'span', None)
+
+
+def start_span(name: str, kind: str = 'internal', **attrs) -> Optional[Span]:
+    """
+    Открывает дочерний span текущего (без смены текущего span'а потока, для событий, которые начинаются и
+    заканчиваются в разных вызовах)
+    :return: span или None, если трасса не ведется
+    """
+    parent = current()
+    if parent is None:
+        return None
+    span = Span(parent.trace, name, kind, parent, attrs)
+    return span if parent.trace.add(span) else None
+
+
+@contextmanager
+def span(name: str, kind: str = 'internal', **attrs) -> Iterator[Optional[Span]]:
+    """
+    Дочерний span текущего на время блока. Вне трассируемой операции ничего не записывает
+    """
+    child = start_span(name, kind, **attrs)
+    if child is None:
+        yield None
+        return
+    previous, _local.span = _local.span, child
+    try:
+        yield child
+    except BaseException as e:
+        child.finish(e)
+        raise
+    else:
+        child.finish()
+    finally:
+        _local.span = previous
+
+
+@contextmanager
+def root(name: str, **attrs) -> Iterator[Span]:
+    """
+    Корневой span обновления или фоновой задачи; внутри уже открытой трассы - дочерний
+    """
+    if current() is not None:
+        with span(name, **attrs) as child:
+            yield child
+        return
+    trace = Trace(sampled=random.random() < TRACE_SAMPLE_RATE)
+    top = Span(trace, name, 'root', None, attrs)
+    trace.add(top)
+    _local.span = top
+    try:
+        yield top
+    except BaseException as e:
+        top.finish(e)
+        raise
+    else:
+        top.finish()
+    finally:
+        _local.span = None
+        exporter.finished(trace)
+
+
+def traced(func: Callable, name: Optional[str] = None) -> Callable:
+    """
+    Оборачивает обработчик Telegram или задачу корневым span'ом
+    :param func: обработчик
+    :param name: имя span'а, по умолчанию имя функции
+    """
+    name = name or func.__name__
+
+    @wraps(func)
+    def wrapper(*args, **kwargs):
+        attrs = dict()
+        if args and isinstance(args[0], Update):
+            attrs['update_id'] = args[0].update_id
+            if args[0].effective_chat:
+                attrs['chat_id'] = args[0].effective_chat.id
+        elif len(args) == 1 and getattr(args[0], 'job', None) is not None:  # задача JobQueue
+            attrs['job'] = args[0].job.name
+        with root(name, **attrs):
+            return func(*args, **kwargs)
+
+    return wrapper
+
+
+def bind(func: Callable) -> Callable:
+    """
+    Переносит текущую трассу в другой поток, чтобы обращения оттуда записывались в нее
+    """
+    parent = current()
+
+    @wraps(func)
+    def wrapper(*args, **kwargs):
+        previous = getattr(_local, 'span', None)
+        _local.span = parent
+        try:
+            return func(*args, **kwargs)
+        finally:
+            _local.span = previous
+
+    return wrapper
+
+
+class TraceListener(monitoring.CommandListener):
+    """
+    Слушатель команд pymongo: записывает каждую команду MongoDB span'ом текущей трассы
+    """
+
+    def __init__(self):
+        self._pending: Dict[int, Span] = {}
+
+    def started(self, event: monitoring.CommandStartedEvent) -> None:
+        collection = event.command.get(event.command_name)
+        child = start_span(f'mongo {event.command_name}', 'mongo', command=event.command_name,
+                           collection=collection if isinstance(collection, str) else None)
+        if child is not None:
+            self._pending[event.request_id] = child
+
+    def succeeded(self, event: monitoring.CommandSucceededEvent) -> None:
+        child = self._pending.pop(event.request_id, None)
+        if child is not None:
+            child.finish()
+
+    def failed(self, event: monitoring.CommandFailedEvent) -> None:
+        child = self._pending.pop(event.request_id, None)
+        if child is not None:
+            child.finish()
+            child.error = event.failure.get('codeName') or 'CommandFailed'
+
+
+listener = TraceListener()
+
+
+class TracedRequest(Request):
+    """
+    Соединение с Bot API, которое записывает каждый вызов метода span'ом текущей трассы
+    """
+
+    def post(self, url: str, data: Dict[str, Any], timeout: float = None):
+        with span(f'telegram {url.rsplit("/", 1)[-1]}', 'telegram', method=url.rsplit('/', 1)[-1]):
+            return super().post(url, data, timeout=timeout)
+
+
+def breakdown(spans: List[Span]) -> Dict[str, Dict[str, float]]:
+    """
+    :return: количество и суммарное время дочерних span'ов по виду {mongo: {count: n, seconds: t}, ...}
+    """
+    result: Dict[str, Dict[str, float]] = dict()
+    for item in spans:
+        if item.kind in ('root', 'internal') or not item.end:
+            continue
+        kind = result.setdefault(item.kind, {'count': 0, 'seconds': 0.0})
+        kind['count'] += 1
+        kind['seconds'] += item.duration
+    return result
+
+
+def to_json(trace: Trace, slow: bool) -> Dict[str, Any]:
+    top = trace.spans[0]
+    return {
+        'trace_id': trace.trace_id,
+        'name': top.name,
+        'start': top.start // 1000,  # микросекунды unix time
+        'duration_ms': round(top.duration * 1000, 3),
+        'slow': slow,
+        'error': top.error,
+        'attrs': top.attrs,
+        'dropped_spans': trace.dropped,
+        'spans': [{'span_id': item.span_id, 'parent_id': item.parent_id, 'name': item.name, 'kind': item.kind,
+                   'offset_ms': round((item.start - top.start) / 1e6, 3),
+                   'duration_ms': round(item.duration * 1000, 3) if item.end else None,
+                   'attrs': item.attrs, 'error': item.error} for item in trace.spans[1:]],
+    }
+
+
+def _otlp_value(value: Any) -> Dict[str, Any]:
+    if isinstance(value, bool):
+        return {'boolValue': value}
+    if isinstance(value, int):
+        return {'intValue': str(value)}
+    if isinstance(value, float):
+        return {'doubleValue': value}
+    return {'stringValue': str(value)}
+
+
+def to_otlp(traces: List[Trace]) -> Dict[str, Any]:
+    """
+    :return: тело запроса OTLP/HTTP (JSON) к /v1/traces
+    """
+    spans = []
+    for trace in traces:
+        for item in trace.spans:
+            if not item.end:
+                continue
+            spans.append({
+                'traceId': trace.trace_id,
+                'spanId': item.span_id,
+                'parentSpanId': item.parent_id or '',
+                'name': item.name,
+                'kind': SPAN_KINDS['internal' if item.kind in ('root', 'internal') else 'client'],
+                'startTimeUnixNano': str(item.start),
+                'endTimeUnixNano': str(item.end),
+                'attributes': [{'key': key, 'value': _otlp_value(value)} for key, value in item.attrs.items()
+                               if value is not None],
+                'status': {'code': 2, 'message': item.error} if item.error else {'code': 1},
+            })
+    return {'resourceSpans': [{
+        'resource': {'attributes': [{'key': 'service.name', 'value': {'stringValue': 'eljurbot'}}]},
+        'scopeSpans': [{'scope': {'name': 'tracing'}, 'spans': spans}],
+    }]}
+
+
+class Exporter:
+    """
+    Запись завершенных трасс фоновым потоком: обработчик только ставит трассу в очередь
+    """
+
+    def __init__(self, path: str = TRACE_FILE, endpoint: Optional[str] = OTLP_ENDPOINT,
+                 queue_size: int = TRACE_QUEUE_SIZE):
+        self.path = path
+        self.endpoint = endpoint
+        self._queue: Queue = Queue(maxsize=queue_size)
+        self._thread: Optional[threading.Thread] = None
+        self._lock = threading.Lock()
+
+    def finished(self, trace: Trace) -> None:
+        top = trace.spans[0]
+        slow = top.duration >= TRACE_SLOW_THRESHOLD
+        if slow:
+            parts = ', '.join(f"{kind} {item['count']} за {item['seconds']:.2f} с"
+                              for kind, item in breakdown(trace.spans).items())
+            logger.warning('Медленная обработка %s %s: %.2f с (%s), трасса %s', top.name, top.attrs, top.duration,
+                           parts or 'без обращений', trace.trace_id)
+        if not slow and not trace.sampled:
+            traces_total.inc(result='skipped')
+            return
+        traces_total.inc(result='slow' if slow else 'sampled')
+        self._ensure_thread()
+        try:
+            self._queue.put_nowait((trace, slow))
+        except Full:
+            traces_dropped_total.inc()
+
+    def _ensure_thread(self) -> None:
+        if self._thread is None:
+            with self._lock:
+                if self._thread is None:
+                    self._thread = threading.Thread(target=self._run, daemon=True, name='Trace-Export')
+                    self._thread.start()
+
+    def _run(self) -> None:
+        while True:
+            batch = [self._queue.get()]
+            try:
+                while len(batch) < 100:
+                    batch.append(self._queue.get_nowait())
+            except Empty:
+                pass
+            try:
+                self.write(batch)
+            except Exception as e:  # запись трасс не должна останавливать поток
+                logger.warning('Не удалось записать %s трасс: %s', len(batch), e)
+            finally:
+                for _ in batch:
+                    self._queue.task_done()
+
+    def write(self, batch: List[tuple]) -> None:
+        if self.endpoint:
+            body = dumps(to_otlp([trace for trace, _ in batch])).encode('utf-8')
+            requests.post(f'{self.endpoint.rstrip("/")}/v1/traces', data=body,
+                          headers={'Content-Type': 'application/json'}, timeout=10)
+            return
+        os.makedirs(os.path.dirname(self.path) or '.', exist_ok=True)
+        with open(self.path, 'a', encoding='utf-8') as file:
+            for trace, slow in batch:
+                file.write(dumps(to_json(trace, slow)) + '\n')
+
+    def flush(self) -> None:
+        """
+        Ждет записи трасс, уже поставленных в очередь
+        """
+        self._queue.join()
+
+
+exporter = Exporter()
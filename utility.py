@@ -2,7 +2,8 @@ import hashlib
 import re
 from copy import deepcopy
 from datetime import datetime
-from typing import Dict, List
+from itertools import islice
+from typing import Dict, List, Iterable, Iterator, Any
 
 from constants import MessageFolder
 
@@ -113,3 +114,18 @@ def format_message_text(text: str) -> str:
     for link in links(text):
         text = text.replace(link, f'<a href="{link}">{link}</a>')
     return text
+
+
+def chunks(items: Iterable[Any], size: int) -> Iterator[List[Any]]:
+    """
+    Разбивает последовательность (в том числе ленивую) на списки длиной не больше size
+    :param items: элементы
+    :param size: размер списка
+    :return: итератор списков
+    """
+    iterator = iter(items)
+    while True:
+        chunk = list(islice(iterator, size))
+        if not chunk:
+            return
+        yield chunk
@@ -0,0 +1,139 @@
+import hmac
+import logging
+import signal
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+from json import loads
+from queue import Queue, Full
+from threading import Thread, Event
+from typing import Optional
+
+from telegram import Update
+from telegram.ext import Dispatcher
+
+from constants import WEBHOOK_QUEUE_SIZE
+from metrics import registry
+
+logger = logging.getLogger('BOT')
+SECRET_HEADER = 'X-Telegram-Bot-Api-Secret-Token'
+
+webhook_updates_total = registry.counter('webhook_updates_total', 'Обновления, полученные через webhook',
+                                         ('result',))
+
+
+class WebhookServer:
+    """
+    Прием обновлений Telegram через webhook.
+    HTTP-сервер проверяет секретный токен и кладет обновления в ограниченную очередь перед диспетчером.
+    Когда очередь заполнена, сервер отвечает 503 и Telegram повторяет доставку позже
+    """
+
+    def __init__(self, dispatcher: Dispatcher, secret: str, host: str = '127.0.0.1', port: int = 8443,
+                 path: str = '/telegram', queue_size: int = WEBHOOK_QUEUE_SIZE):
+        """
+        :param dispatcher: диспетчер, обрабатывающий обновления
+        :param secret: секретный токен, переданный в setWebhook
+        :param host: адрес, на котором слушает сервер
+        :param port: порт, 0 - любой свободный
+        :param path: путь, на который Telegram отправляет обновления
+        :param queue_size: размер очереди обновлений
+        """
+        self.dispatcher = dispatcher
+        self.secret = secret
+        self.path = path
+        self.updates: Queue = Queue(maxsize=queue_size)
+        self._stopped = Event()
+        self._server = ThreadingHTTPServer((host, port), self._handler_class())
+        self._server.daemon_threads = True
+        self._pump: Optional[Thread] = None
+        registry.gauge('webhook_queue_depth', 'Обновления в очереди перед диспетчером',
+                       function=lambda: self.updates.qsize())
+
+    @property
+    def port(self) -> int:
+        return self._server.server_address[1]
+
+    def _handler_class(self):
+        server = self
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = 'HTTP/1.1'
+
+            def respond(self, status: int, result: str):
+                webhook_updates_total.inc(result=result)
+                self.send_response(status)
+                self.send_header('Content-Length', '0')
+                self.end_headers()
+
+            def do_POST(self):
+                length = int(self.headers.get('Content-Length', 0))
+                body = self.rfile.read(length)
+                if self.path != server.path:
+                    self.respond(404, 'not_found')
+                    return
+                if not hmac.compare_digest(self.headers.get(SECRET_HEADER, ''), server.secret):
+                    self.respond(403, 'forbidden')
+                    return
+                try:
+                    update = loads(body)
+                except ValueError:
+                    self.respond(400, 'bad_request')
+                    return
+                try:
+                    server.updates.put_nowait(update)
+                except Full:
+                    self.respond(503, 'rejected')
+                    return
+                self.respond(200, 'accepted')
+
+            def log_message(self, *args):
+                pass
+
+        return Handler
+
+    def _process(self) -> None:
+        while not self._stopped.is_set() or not self.updates.empty():
+            update = self.updates.get()
+            if update is None:
+                break
+            try:
+                self.dispatcher.process_update(Update.de_json(update, self.dispatcher.bot))
+            except Exception:
+                logger.exception('Ошибка обработки обновления из webhook')
+            finally:
+                self.updates.task_done()
+
+    def start(self) -> None:
+        """
+        Запускает HTTP-сервер и поток, передающий обновления диспетчеру
+        """
+        Thread(target=self._server.serve_forever, daemon=True, name='Webhook').start()
+        self._pump = Thread(target=self._process, daemon=True, name='Webhook-Dispatch')
+        self._pump.start()
+        logger.info('Webhook слушает %s:%s%s', self._server.server_address[0], self.port, self.path)
+
+    def stop(self) -> None:
+        """
+        Останавливает прием обновлений и дожидается обработки уже принятых
+        """
+        self._server.shutdown()
+        self._stopped.set()
+        self.updates.put(None)
+        if self._pump:
+            self._pump.join()
+
+    def idle(self) -> None:
+        """
+        Блокирует до сигнала остановки, затем останавливает сервер, задачи и сохраняет состояние диспетчера
+        """
+        received = Event()
+        for sig in (signal.SIGINT, signal.SIGTERM, signal.SIGABRT):
+            signal.signal(sig, lambda signum, frame: received.set())
+        while not received.wait(1):
+            pass
+        logger.info('Останавливаю webhook')
+        self.stop()
+        if self.dispatcher.job_queue:
+            self.dispatcher.job_queue.stop()
+        if self.dispatcher.persistence:
+            self.dispatcher.update_persistence()
+            self.dispatcher.persistence.flush()